@@ -0,0 +1,112 @@
+from collections import deque
+
+from toro import Condition
+from tornado import gen, ioloop
+
+from flow import TokenBucket
+from logger import gen_log
+
+__all__ = ['AdmissionController']
+
+
+class AdmissionController(object):
+
+    r"""Paces session creation when the fleet reconnects at once.
+
+    Accepted connection gets a session right away while fewer than
+    `max_handshaking` sessions are not open yet and the token bucket
+    (`rate` sessions per second, `burst`) has a token. Otherwise it waits
+    in the deferred queue as a bare socket, without stream or coroutines,
+    and is admitted in order as slots and tokens free up. Connections
+    over `max_deferred`, or all excess ones when `defer` is off, are
+    closed, so are connections deferred longer than `defer_timeout`:
+    such device has most likely reconnected already.
+    Lives on the IOLoop thread only."""
+
+    def __init__(self, handler, max_handshaking=500, rate=500, burst=100,
+                 defer=True, max_deferred=10000, defer_timeout=60,
+                 io_loop=None):
+        self.handler = handler
+        self.max_handshaking = max_handshaking
+        self.defer = defer
+        self.max_deferred = max_deferred
+        self.defer_timeout = defer_timeout
+        self.io_loop = io_loop or ioloop.IOLoop.current()
+        self.bucket = TokenBucket(rate, burst, self.io_loop)
+        self.deferred = deque()     # (socket, address, deferred at)
+        self.handshaking = 0
+        self.pumping = False
+        self._slot_free = Condition(io_loop=self.io_loop)
+        self.accepted = 0
+        self.deferred_total = 0
+        self.admitted_deferred = 0
+        self.rejected = 0
+        self.expired = 0
+        self.max_defer_time = 0.
+
+    def on_accept(self, conn, address):
+        if not self.deferred and self.handshaking < self.max_handshaking \
+                and self.bucket.try_acquire():
+            self.accepted += 1
+            self.admit(conn, address)
+        elif self.defer and len(self.deferred) < self.max_deferred:
+            self.deferred_total += 1
+            self.deferred.append((conn, address, self.io_loop.time()))
+            if not self.pumping:
+                self.pumping = True
+                self.io_loop.add_future(self.pump(),
+                                        lambda future: future.result())
+        else:
+            self.rejected += 1
+            conn.close()
+
+    def admit(self, conn, address):
+        self.handshaking += 1
+        self.io_loop.add_future(self.handler(conn, address),
+                                self.on_handshake_done)
+
+    def on_handshake_done(self, future):
+        self.handshaking -= 1
+        self._slot_free.notify()
+        future.result()
+
+    @gen.coroutine
+    def pump(self):
+        try:
+            while self.deferred:
+                if self.handshaking >= self.max_handshaking:
+                    yield self._slot_free.wait()
+                    continue
+                yield self.bucket.acquire()
+                if not self.deferred:   # stopped meanwhile
+                    break
+                conn, address, deferred_at = self.deferred.popleft()
+                waited = self.io_loop.time() - deferred_at
+                if waited > self.defer_timeout:
+                    self.expired += 1
+                    conn.close()
+                    continue
+                self.max_defer_time = max(self.max_defer_time, waited)
+                self.admitted_deferred += 1
+                self.admit(conn, address)
+        finally:
+            self.pumping = False
+
+    def stop(self):
+        r"""Closes deferred connections, devices will reconnect."""
+        if self.deferred:
+            gen_log.info("ADMISSION: closing %d deferred connections",
+                         len(self.deferred))
+        while self.deferred:
+            conn, address, deferred_at = self.deferred.popleft()
+            conn.close()
+
+    def stats(self):
+        return {'handshaking': self.handshaking,
+                'queued': len(self.deferred),
+                'accepted': self.accepted,
+                'deferred': self.deferred_total,
+                'admitted_deferred': self.admitted_deferred,
+                'rejected': self.rejected,
+                'expired': self.expired,
+                'max_defer_time': self.max_defer_time}
@@ -0,0 +1,234 @@
+import os
+import sys
+import json
+import time
+import struct
+from collections import namedtuple
+
+from settings import settings
+from logger import gen_log, QueueWriter
+
+__all__ = ['Capture', 'CaptureRecord', 'read_capture', 'capture',
+           'CAPTURE_OPS']
+
+MAGIC = 'QCAP\x01'
+# time, connection id, kind, length of the data that follows
+RECORD = struct.Struct('!dIBI')
+KINDS = (OPEN, INBOUND, OUTBOUND, CLOSE) = (0, 1, 2, 3)
+KIND_NAMES = ('open', 'in', 'out', 'close')
+# command channel requests handled by `Capture`
+CAPTURE_OPS = ('capture_start', 'capture_stop', 'capture_status')
+
+CaptureRecord = namedtuple('CaptureRecord', ('time', 'conn_id', 'kind',
+                                             'data'))
+
+
+def read_capture(path):
+    r"""Yields `CaptureRecord`s of the file in the order they were
+    recorded. A record cut short by a crash ends the capture."""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a capture" % path)
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            stamp, conn_id, kind, size = RECORD.unpack(header)
+            data = f.read(size)
+            if len(data) < size:
+                return
+            yield CaptureRecord(stamp, conn_id, kind, data)
+
+
+class CaptureWriter(QueueWriter):
+
+    r"""Packs queued records into the capture file. Stops by itself once
+    the file would outgrow `max_bytes`."""
+
+    def __init__(self, path, max_bytes):
+        super(CaptureWriter, self).__init__({})
+        self.name = 'capture-writer'
+        self.path = path
+        self.max_bytes = max_bytes
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.size = len(MAGIC)
+        self.full = False
+
+    def run(self):
+        try:
+            super(CaptureWriter, self).run()
+        finally:
+            self.file.close()
+            gen_log.info("CAPTURE written to %s, %d records",
+                         self.path, self.written)
+
+    def write(self, record):
+        stamp, conn_id, kind, data = record
+        size = RECORD.size + len(data)
+        if self.size + size > self.max_bytes:
+            self.full = self.stopped = True
+            return
+        self.file.write(RECORD.pack(stamp, conn_id, kind, len(data)))
+        self.file.write(data)
+        self.size += size
+        self.written += 1
+        if not self.queue:
+            # readable up to here should the process die
+            self.file.flush()
+
+
+class Capture(object):
+
+    r"""Records traffic of the sessions of the process: frames read from
+    devices, SACKs and commands written to them, opens and closes of
+    connections, with time and connection id.
+
+    Sessions put records to the queue of `CaptureWriter` thread, so the
+    IOLoop never waits for the disk. Records over `queue_size` queued
+    ones are dropped and counted. Connections are numbered from 0 in
+    every capture, the ones open before the start get their open record
+    with the first frame."""
+
+    def __init__(self, path=None, max_bytes=None, queue_size=None):
+        self.path = path or settings.CAPTURE_DIR
+        self.max_bytes = max_bytes or settings.CAPTURE_MAX_BYTES
+        self.queue_size = queue_size or settings.CAPTURE_QUEUE_SIZE
+        self.recording = False
+        self.writer = None
+        self.started = None
+        self.conn_ids = {}      # id of the session -> connection id
+        self.next_id = 0
+        self.dropped = 0
+        self.files = []
+
+    @classmethod
+    def instance(cls):
+        """Singleton like accessor to instantiate process capture"""
+        if not hasattr(cls, "_instance"):
+            cls._instance = cls()
+        return cls._instance
+
+    @classmethod
+    def shutdown(cls, timeout=5):
+        if hasattr(cls, "_instance"):
+            cls._instance.stop(timeout)
+
+    def start(self):
+        if self.recording:
+            raise RuntimeError("Capture is already running")
+        if self.writer is not None and self.writer.is_alive():
+            raise RuntimeError("Capture is still being written")
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.started = time.time()
+        path = os.path.join(self.path, 'capture-%d-%s.qcap' % (
+            os.getpid(), time.strftime('%Y%m%d-%H%M%S',
+                                       time.localtime(self.started))))
+        self.writer = CaptureWriter(path, self.max_bytes)
+        self.writer.start()
+        self.conn_ids.clear()
+        self.next_id = 0
+        self.dropped = 0
+        self.files.append(path)
+        self.recording = True
+        gen_log.info("CAPTURE started to %s", path)
+        return self.stats()
+
+    def stop(self, timeout=0):
+        r"""Tells the writer to write what is queued and close the file,
+        waits for it up to `timeout` seconds. The command channel does not
+        wait, it runs on the IOLoop. Returns path of the file."""
+        self.recording = False
+        writer = self.writer
+        if writer is None or writer.stopped:
+            return None
+        gen_log.info("CAPTURE stopped, %d queued, %d dropped",
+                     len(writer.queue), self.dropped)
+        writer.stop(timeout)
+        return writer.path
+
+    def record(self, session, kind, data=''):
+        key = id(session)
+        conn_id = self.conn_ids.get(key)
+        if conn_id is None:
+            if kind == CLOSE or (kind != OPEN and session.is_closed()):
+                return
+            conn_id = self.conn_ids[key] = self.next_id
+            self.next_id += 1
+            if kind != OPEN:
+                self.put(conn_id, OPEN, '')
+        elif kind == CLOSE:
+            del self.conn_ids[key]
+        self.put(conn_id, kind, data)
+
+    def opened(self, session):
+        self.record(session, OPEN)
+
+    def inbound(self, session, frames):
+        for frame in frames:
+            self.record(session, INBOUND, frame)
+
+    def outbound(self, session, msg):
+        self.record(session, OUTBOUND, msg)
+
+    def closed(self, session):
+        self.record(session, CLOSE)
+
+    def put(self, conn_id, kind, data):
+        writer = self.writer
+        if writer.full:
+            self.recording = False
+            gen_log.warning("CAPTURE stopped, %s reached %d bytes",
+                            writer.path, writer.size)
+            return
+        if len(writer.queue) >= self.queue_size:
+            self.dropped += 1
+            return
+        writer.put((time.time(), conn_id, kind, data))
+
+    def handle(self, request):
+        r"""Requests of the command channel:
+            {"op": "capture_start"}
+            {"op": "capture_stop"}
+            {"op": "capture_status"}
+        """
+        op = request['op']
+        if op == 'capture_start':
+            self.start()
+        elif op == 'capture_stop':
+            self.stop()
+        elif op != 'capture_status':
+            raise ValueError("Unknown operation %s" % op)
+        return self.stats()
+
+    def stats(self):
+        writer = self.writer
+        return {'recording': self.recording,
+                'running_seconds': time.time() - self.started
+                if self.recording else 0,
+                'connections': len(self.conn_ids),
+                'records': writer.written if writer is not None else 0,
+                'bytes': writer.size if writer is not None else 0,
+                'queued': len(writer.queue) if writer is not None else 0,
+                'dropped': self.dropped,
+                'files': self.files[-5:]}
+
+
+capture = Capture.instance()
+
+
+if __name__ == '__main__':
+    # python capture.py start|stop|status
+    # python capture.py dump FILE
+    if sys.argv[1] == 'dump':
+        for record in read_capture(sys.argv[2]):
+            print '%.6f %6d %-5s %s' % (record.time, record.conn_id,
+                                        KIND_NAMES[record.kind],
+                                        record.data)
+        sys.exit()
+    from fleet import broadcast
+    if sys.argv[1] not in ('start', 'stop', 'status'):
+        sys.exit("Unknown operation %s" % sys.argv[1])
+    print json.dumps(broadcast({'op': 'capture_%s' % sys.argv[1]}),
+                     indent=2)
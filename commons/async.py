@@ -1,4 +1,42 @@
+from tornado.concurrent import Future
+
+
 def schedule_at_loop(loop, future, callback=None):
     if callable(future):
         future = future()
     loop.add_future(future, callback)
+
+
+def callback_future(fn, *args, **kwargs):
+    r"""Calls callback style `fn` and returns future of its result."""
+    future = Future()
+
+    def callback(result=None):
+        future.set_result(result)
+
+    fn(*args, callback=callback, **kwargs)
+    return future
+
+
+def with_timeout(loop, future, timeout, exc_factory):
+    r"""Returns future that follows `future` or fails with exception made
+    by `exc_factory` if it is not resolved in `timeout` seconds."""
+    result = Future()
+
+    def on_timeout():
+        if not result.done():
+            result.set_exception(exc_factory())
+
+    handle = loop.add_timeout(loop.time() + timeout, on_timeout)
+
+    def on_done(f):
+        loop.remove_timeout(handle)
+        if result.done():
+            return
+        try:
+            result.set_result(f.result())
+        except Exception as e:
+            result.set_exception(e)
+
+    loop.add_future(future, on_done)
+    return result
@@ -21,3 +21,11 @@ class StreamClosedError(Exception):
 
 class SessionRequiredError(Exception):
     pass
+
+
+class CommandTimeoutError(Exception):
+    pass
+
+
+class SessionNotFoundError(Exception):
+    pass
@@ -18,21 +18,26 @@ OBD_REPORT = 'OBD'
 DEVICE_INFORMATION_REPORT = 'INF'
 MOTION_STATE_REPORT = 'STT'  # if motion state changed
 VER_REPORT = 'VER'  # version info report
+# report that answers RTO sub command
+RTO_RESPONSES = {RTO_VER: VER_REPORT}
 # acks
 HEARTBEAT_ACK = 'HBD'
 COMMUN_CONFIG_ACK = 'SRI'
 FIXED_REPORT_ACK = 'FRI'
+OBD_CONFIG_ACK = 'OBD'
 RTO_ACK = 'RTO'
 
 REPORTS = (FIXED_REPORT, OBD_REPORT, MOTION_STATE_REPORT,
            DEVICE_INFORMATION_REPORT, VER_REPORT)
-ACKS = (HEARTBEAT_ACK, COMMUN_CONFIG_ACK, FIXED_REPORT_ACK, RTO_ACK)
+ACKS = (HEARTBEAT_ACK, COMMUN_CONFIG_ACK, FIXED_REPORT_ACK, OBD_CONFIG_ACK,
+        RTO_ACK)
 COMMANDS = (GPRS_CONFIG_CMD, COMMUN_CONFIG_CMD, TIME_ADJST_CMD,
             FIXED_REPORT_CMD, OBD_REPORT_CMD, RTO_CMD)
 
 MESSAGE_SHOULD_END_EXC = "Message should end on char '$'."
 MESSAGE_SHOULD_BE_IN_EXC = "Message should be `+ACK:GT`, `+RESP:GT`"
 UNKNOWN_MESSAGE = "Message %s is unknown to the protocol."
+FRAME_TOO_LONG_EXC = "Frame exceeds %d bytes without '$'."
 
 TCP_LONG_CONN = 3
 BUFF_HIGH_PRIORITY = 2
@@ -41,3 +46,22 @@ ASCII_FORMAT = 0
 FIXED_TIMING_REPORT_MODE = 1
 
 DISCONN_RESULT = 'disconnect'
+
+OBD_LAYOUT_CACHE_SIZE = 256   # distinct OBD report layouts kept in memory
+READ_CHUNK_SIZE = 16384       # bytes requested from the stream per read
+MAX_FRAME_SIZE = 8192         # bytes, longest frame accepted without '$'
+SESSION_MAX_PENDING = 256     # frames read and not processed per session
+ORDERED_PROCESSING = True     # emit frames of a session in arrival order
+SESSION_WINDOW = 8            # frames of a session processed at once
+OPTIMISTIC_OPEN = True        # open session by IMEI of the first frame
+TIMER_TICK = 1.0              # seconds, resolution of session timeouts
+TIMER_SLOTS = 64              # slots per level of the timing wheel
+TIMER_LEVELS = 4
+HEARTBEAT_UNIT = 60           # seconds, SRI heartbeat interval is in minutes
+IDLE_MISSED_INTERVALS = 2     # silent intervals before session is dropped
+IDLE_GRACE = 30               # seconds added to the idle timeout
+COMMAND_TIMEOUT = 30          # seconds to wait for the first ack of a command
+COMMAND_RETRIES = 2           # resends of a command without ack
+COMMAND_BACKOFF = 2           # wait for the ack grows that much per resend
+COMMAND_WINDOW = 4            # commands of a session waiting for acks
+RTO_TIMEOUT = 90              # seconds to wait for the response of RTO
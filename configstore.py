@@ -0,0 +1,193 @@
+import os
+import sys
+import json
+import errno
+
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen
+
+from logger import gen_log
+from settings import settings
+
+__all__ = ['ConfigStore']
+
+RECORD_EXT = '.json'
+
+
+def to_str(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, dict):
+        return dict((to_str(k), to_str(v)) for k, v in value.iteritems())
+    return value
+
+
+def empty_record():
+    return {'desired': {}, 'applied': {}}
+
+
+class ConfigStore(object):
+
+    r"""Configuration of devices kept on local disk, a JSON file per IMEI:
+
+        {"desired": {config key: value},
+         "applied": {command: {param: value}}}
+
+    `desired` overrides connection defaults for the device, `applied`
+    holds params of configuration commands the device acked. Files are
+    replaced by rename, so workers never see a half written record and
+    the last writer wins.
+
+    Sessions use `get`, `put` and `release`: records are cached in memory
+    while sessions reconcile them and the disk is touched by a single I/O
+    thread, so the IOLoop never blocks on it and saves of a record reach
+    the disk in order. `get` still stats the file, a record changed by
+    operator is read again."""
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.records = {}
+        self.mtimes = {}  # used by the I/O thread only
+        self._io = None
+        self.loaded = 0
+        self.saved = 0
+        self.cached = 0
+
+    @classmethod
+    def instance(cls):
+        """Singleton like accessor to instantiate config store"""
+        if not hasattr(cls, "_instance"):
+            cls._instance = cls(settings.CONFIG_STORE_PATH)
+        return cls._instance
+
+    @classmethod
+    def shutdown(cls):
+        r"""Waits for pending saves."""
+        if hasattr(cls, "_instance") and cls._instance._io is not None:
+            cls._instance._io.shutdown(wait=True)
+
+    @property
+    def io(self):
+        if self._io is None:
+            self._io = ThreadPoolExecutor(max_workers=1)
+        return self._io
+
+    def record_path(self, imei):
+        return os.path.join(self.path, imei + RECORD_EXT)
+
+    def load(self, imei):
+        try:
+            with open(self.record_path(imei)) as f:
+                record = to_str(json.load(f))
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                gen_log.warning("config of %s is not readable %s", imei, e)
+            return empty_record()
+        except ValueError as e:
+            gen_log.warning("config of %s is broken %s", imei, e)
+            return empty_record()
+        self.loaded += 1
+        for key, value in empty_record().iteritems():
+            record.setdefault(key, value)
+        return record
+
+    def save(self, imei, record):
+        self.write(imei, json.dumps(record))
+
+    def write(self, imei, data):
+        path = self.record_path(imei)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(data)
+            os.rename(tmp_path, path)
+            self.mtimes[imei] = os.stat(path).st_mtime
+        except (IOError, OSError) as e:
+            gen_log.warning("config of %s is not saved %s", imei, e)
+            return
+        self.saved += 1
+
+    def mtime(self, imei):
+        try:
+            return os.stat(self.record_path(imei)).st_mtime
+        except OSError:
+            return None
+
+    def refresh(self, imei, cached):
+        r"""Runs in the I/O thread.
+        Returns record read from disk or None when cached one is current."""
+        mtime = self.mtime(imei)
+        if cached and mtime == self.mtimes.get(imei):
+            return None
+        self.mtimes[imei] = mtime
+        return self.load(imei)
+
+    @gen.coroutine
+    def get(self, imei):
+        r"""Record of the device, from the cache unless its file changed."""
+        cached = self.records.get(imei)
+        record = yield self.io.submit(self.refresh, imei, cached is not None)
+        if record is None:
+            self.cached += 1
+        elif self.records.get(imei) is cached:
+            self.records[imei] = record
+        # else record put while the file was read is newer
+        raise gen.Return(self.records[imei])
+
+    def put(self, imei, record):
+        r"""Caches record and saves it in the I/O thread. Record is
+        serialized here, so the caller may keep changing it."""
+        self.records[imei] = record
+        self.io.submit(self.write, imei, json.dumps(record))
+
+    def release(self, imei):
+        r"""Drops record from the cache, next `get` reads the disk."""
+        if self.records.pop(imei, None) is not None:
+            self.io.submit(self.mtimes.pop, imei, None)
+
+    def set_desired(self, imei, **config):
+        record = self.load(imei)
+        record['desired'].update(config)
+        self.save(imei, record)
+        return record
+
+    def unset_desired(self, imei, *keys):
+        record = self.load(imei)
+        for key in keys:
+            record['desired'].pop(key, None)
+        self.save(imei, record)
+        return record
+
+    def forget_applied(self, imei):
+        r"""Device gets its whole configuration on the next connect."""
+        record = self.load(imei)
+        record['applied'] = {}
+        self.save(imei, record)
+        return record
+
+    def stats(self):
+        return {'loaded': self.loaded, 'saved': self.saved,
+                'cached': self.cached, 'records': len(self.records)}
+
+
+if __name__ == '__main__':
+    # python configstore.py show <IMEI>
+    # python configstore.py set <IMEI> key=value ...
+    # python configstore.py unset <IMEI> key ...
+    # python configstore.py forget <IMEI>
+    store = ConfigStore.instance()
+    op, imei, args = sys.argv[1], sys.argv[2], sys.argv[3:]
+    if op == 'show':
+        record = store.load(imei)
+    elif op == 'set':
+        record = store.set_desired(imei, **dict(arg.split('=', 1)
+                                                for arg in args))
+    elif op == 'unset':
+        record = store.unset_desired(imei, *args)
+    elif op == 'forget':
+        record = store.forget_applied(imei)
+    else:
+        sys.exit("Unknown operation %s" % op)
+    print json.dumps(record, indent=2, sort_keys=True)
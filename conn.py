@@ -1,12 +1,23 @@
-import ibmiotf.device
+from collections import OrderedDict
+
 from tornado import gen
+from tornado.iostream import StreamClosedError
 import conf
 from models import Backend, LogEntry
+from publisher import IoTPublisher, event_record
+from writer import LogWriter, log_record
+from executor import SinkExecutor
+from spool import Spool
+from configstore import ConfigStore
+from settings import settings
 import utils
-from logger import gen_log
+from logger import gen_log, frame_log, ACK, PUBLISHED
 from commons.schemas import COMMON_LOG_SCHEMA
 from commons import obd
 from commons import utils as time_utils
+from commons.exceptions import CommandTimeoutError, BadProtocolFormat, \
+    MessageNotImplemented
+from protocol import fill_serial, SERIAL_STUB
 
 DEFAULT_CONFIGURATIONS = {
     'password': '',
@@ -24,13 +35,19 @@ DEFAULT_CONFIGURATIONS = {
     'fixed_report_mode': conf.FIXED_TIMING_REPORT_MODE
 }
 
-options = {
-    "org": "qrqu70",
-    "type": "vehicle",
-    "id": "864251020002569",
-    "auth-method": "token",
-    "auth-token": "a-qrqu70-lgtfdke36o"
-}
+# connections made with the same kwargs share one config dict
+_shared_configs = {}
+
+# configuration commands kept in sync with the device, and config keys of
+# their params when the key differs from the param name
+CONFIG_COMMANDS = OrderedDict([
+    (conf.COMMUN_CONFIG_CMD, {}),
+    (conf.FIXED_REPORT_CMD, {'mode': 'fixed_report_mode'}),
+    (conf.OBD_REPORT_CMD, {'mode': 'obd_mode'}),
+])
+UNCOMPARED_PARAMS = ('password', 'serial_number')
+# devices can not connect back to these, such values are left as they are
+WILDCARD_ADDRESSES = ('', '0.0.0.0', '::')
 
 
 def extract_codes(dtc_number, raw_codes):
@@ -65,9 +82,50 @@ def extract_codes(dtc_number, raw_codes):
     return obd.DTC_CODE_SPLITTER.join(dtcs)
 
 
+def shared_config(**kwargs):
+    r"""Default configuration updated with `kwargs`. All connections with
+    the same kwargs get the same dict, it is never changed in place."""
+    key = tuple(sorted(kwargs.iteritems()))
+    config = _shared_configs.get(key)
+    if config is None:
+        config = DEFAULT_CONFIGURATIONS.copy()
+        config.update(kwargs)
+        _shared_configs[key] = config
+    return config
+
+
+def replay_record(record):
+    r"""Replays spooled record into its sink. Runs on drainer thread."""
+    if record['sink'] == 'log':
+        LogWriter.instance().add(LogEntry(**record['row']))
+    elif record['sink'] == 'iot':
+        IoTPublisher.instance().publish(record['event'], record['format'],
+                                        record['data'])
+
+
+def flush_replayed():
+    r"""Writes replayed rows, so the spool can ack them. Runs on drainer
+    thread."""
+    LogWriter.instance().flush()
+
+
+def sinks_ready():
+    r"""Whether sinks have recovered enough to take spooled records."""
+    return (LogWriter.instance().healthy and
+            not SinkExecutor.instance().is_saturated() and
+            not IoTPublisher.instance().is_full())
+
+
 class QueclinkConnection(object):
 
-    r"""High level terminal connection."""
+    r"""High level terminal connection.
+
+    `config` is shared with other connections until the device gets its
+    own values by `override_config`. Device record of the config store is
+    kept only while the configuration is being reconciled."""
+
+    __slots__ = ('_session', '__imei', 'serial_number', 'config',
+                 'own_config', 'device_config', 'reconciling')
 
     default_mil_interval = 60 * 5
 
@@ -75,13 +133,31 @@ class QueclinkConnection(object):
         self._session = session
         self.__imei = None
         self.serial_number = '0000'
-        self.config = DEFAULT_CONFIGURATIONS.copy()
-        self.config.update(kwargs)
+        self.config = shared_config(**kwargs)
+        self.own_config = False
+        self.device_config = None
+        self.reconciling = None     # templates of commands being applied
 
     @property
     def backend(self):
         return Backend.instance()
 
+    @property
+    def sinks(self):
+        return SinkExecutor.instance()
+
+    @property
+    def writer(self):
+        return LogWriter.instance()
+
+    @property
+    def spool(self):
+        return Spool.instance()
+
+    @property
+    def publisher(self):
+        return IoTPublisher.instance()
+
     @property
     def is_auth(self):
         return self._session.is_open()
@@ -127,52 +203,196 @@ class QueclinkConnection(object):
             gen_log.warning("Common Protocol hasn't conform to report %s",
                             response.header)
             raise gen.Return(None)
-        session = self.backend.get_session()
-        json_log = log_entry.json()
+        # a saturated pool holds the session here, so its flow control
+        # stops reading from the device
         try:
-            """Everything I need to do here"""
-            session.add(log_entry)
-            session.commit()
-            json_log = log_entry.json()
+            yield self.sinks.submit(self.writer.add, log_entry)
         except Exception as e:
-            session.rollback()
-        finally:
-            session.close()
-
+            gen_log.warning('failed to store report %s', e)
+            if self.spool.put(log_record(self.writer.to_row(log_entry))):
+                self._session.on_report_stored()
+        else:
+            self._session.on_report_stored()
         my_data = {'d': {
             "lat": str(log.get('latitude', None)),
             "long": str(log.get('longitude', None))
         }}
-        try:
-
-            dev = ibmiotf.device.Client(options)
-            dev.connect()
-            dev.publishEvent("gps", "json", my_data)
-            dev.disconnect()
-        except Exception as ex:
-            gen_log.info('failed to publish %s', ex)
+        if self.publisher.is_full():
+            self.spool.put(event_record("gps", "json", my_data))
+        else:
+            self.publisher.publish("gps", "json", my_data)
 
-        gen_log.info('MESSAGE PUBLISHED %s', json_log)
+        if frame_log.wanted(PUBLISHED, log_entry.imei):
+            gen_log.info('MESSAGE PUBLISHED %s', log_entry.json())
         raise gen.Return(None)
 
     @gen.coroutine
     def on_ack(self, original_msg, msg, sack):
-        gen_log.info("PROCESSED ACK: %s[ack-%s]", msg, sack)
+        frame_log.info(ACK, self.session_key,
+                       "PROCESSED ACK: %s[ack-%s]", msg, sack)
         if self.config['sack_enable'] or (msg.type == conf.ACK and
                                           msg.header == conf.HEARTBEAT_ACK):
-            self._session.send_message(sack)
+            try:
+                self._session.send_message(sack)
+            except StreamClosedError:
+                # device is gone, the session closes on its own
+                pass
         raise gen.Return(None)
 
     def verify_conn(self):
         return self._session.make_rto({'sub_cmd': conf.RTO_VER})
 
+    @property
+    def config_store(self):
+        return ConfigStore.instance()
+
+    def override_config(self, **kwargs):
+        r"""Sets config values of this device only."""
+        if all(self.config.get(key) == value
+               for key, value in kwargs.iteritems()):
+            return
+        if not self.own_config:
+            self.config = dict(self.config)
+            self.own_config = True
+        self.config.update(kwargs)
+
+    @gen.coroutine
+    def load_device_config(self):
+        if self.device_config is None:
+            self.device_config = yield self.config_store.get(self.session_key)
+            self.override_config(**self.device_config['desired'])
+            if self._session.is_closed():
+                self.config_store.release(self.session_key)
+        raise gen.Return(self.device_config)
+
+    def release_device_config(self):
+        self.device_config = None
+        if self.session_key:
+            self.config_store.release(self.session_key)
+
+    def desired_commands(self):
+        r"""Configuration commands wanted on the device. Params come from
+        desired config of the device and from connection config of
+        CONFIG_MANAGED keys, a command is managed when any of its params
+        does. Other params are sent empty, the device keeps its values.
+        Device config must be loaded.
+        Returns:
+            {command: (template, {param: value})}
+        """
+        config = dict((key, self.config[key])
+                      for key in settings.CONFIG_MANAGED if key in self.config)
+        if config.get('main_server_ip') in WILDCARD_ADDRESSES:
+            config.pop('main_server_ip', None)
+            config.pop('main_server_port', None)
+        config.update(self.device_config['desired'])
+        desired = {}
+        for cmd, aliases in CONFIG_COMMANDS.iteritems():
+            schema, reserved = self._session.CMD_LAYOUTS[cmd]
+            kv = {}
+            for param in schema.schema:
+                key = aliases.get(param, param)
+                if key in config:
+                    kv[param] = config[key]
+            if not [p for p in kv if p not in UNCOMPARED_PARAMS]:
+                continue
+            kv.setdefault('password', self.config.get('password', ''))
+            try:
+                template = self._session.blank_params(
+                    self._session.build_cmd_template(cmd, **kv),
+                    set(kv).union(UNCOMPARED_PARAMS))
+            except Exception as e:
+                gen_log.warning("bad %s config of %s: %s",
+                                cmd, self.session_key, e)
+                continue
+            _, params = self._session.parse_cmd(
+                fill_serial(template, SERIAL_STUB))
+            desired[cmd] = (template, params)
+        return desired
+
+    def changed_commands(self):
+        r"""Desired commands with params the device has not acked.
+        Empty params mean `keep` to the device and are not compared."""
+        applied = self.device_config['applied']
+        changed = {}
+        for cmd, (template, params) in self.desired_commands().iteritems():
+            acked = applied.get(cmd, {})
+            for param, value in params.iteritems():
+                if param not in UNCOMPARED_PARAMS and value and \
+                        acked.get(param) != value:
+                    changed[cmd] = template
+                    break
+        return changed
+
     @gen.coroutine
     def configure(self):
-        r"""Executes commands for device configuration.
-        Returns unique id if configuration has been successful."""
-        pass
+        r"""Sends configuration commands whose params differ from the
+        ones the device acked before.
+        Returns names of acked commands."""
+        if not settings.CONFIG_RECONCILE:
+            raise gen.Return([])
+        yield self.load_device_config()
+        changed = self.changed_commands()
+        futures = []
+        for cmd, template in changed.iteritems():
+            if self.reconciling is None:
+                self.reconciling = set()
+            self.reconciling.add(template)
+            futures.append((cmd, self._session.commands.send_prepared(
+                cmd, template)))
+        acked = []
+        for cmd, future in futures:
+            try:
+                result = yield future
+            except CommandTimeoutError as e:
+                gen_log.warning("CONFIG NOT APPLIED: %s", e)
+                continue
+            if result != conf.DISCONN_RESULT:
+                acked.append(cmd)
+        if self.reconciling is not None:
+            self.reconciling.difference_update(changed.values())
+        if not self.reconciling:
+            # operator commands read the record again
+            self.reconciling = None
+            self.release_device_config()
+        if changed:
+            gen_log.info("CONFIG OF %s: sent %s, acked %s", self.session_key,
+                         sorted(changed), sorted(acked))
+        raise gen.Return(acked)
+
+    def on_command_ack(self, message):
+        r"""Records params of acked configuration command. Command that
+        was not sent by `configure` was sent by operator, its params
+        become desired for the device."""
+        try:
+            cmd, params = self._session.parse_cmd(message)
+        except (BadProtocolFormat, MessageNotImplemented):
+            return
+        if cmd not in CONFIG_COMMANDS or not self.session_key:
+            return
+        by_operator = message[:message.rindex(',') + 1] not in \
+            (self.reconciling or ())
+        self.io_loop.add_future(
+            self.record_command_ack(cmd, params, by_operator),
+            lambda future: future.result())
+
+    @gen.coroutine
+    def record_command_ack(self, cmd, params, by_operator):
+        record = yield self.load_device_config()
+        acked = dict((param, value) for param, value in params.iteritems()
+                     if value and param not in UNCOMPARED_PARAMS)
+        record['applied'].setdefault(cmd, {}).update(acked)
+        if by_operator:
+            aliases = CONFIG_COMMANDS[cmd]
+            desired = dict((aliases.get(param, param), value)
+                           for param, value in acked.iteritems())
+            record['desired'].update(desired)
+            self.override_config(**desired)
+        self.config_store.put(self.session_key, record)
+        if not self.reconciling:
+            self.release_device_config()
 
     def on_close(self):
+        self.release_device_config()
         msg = {'imei': self.__imei,
                'conn_status': 0,
                'ts': str(time_utils.now())}
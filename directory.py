@@ -0,0 +1,241 @@
+import os
+import sys
+import json
+import glob
+import errno
+import socket
+
+from tornado import gen, iostream, netutil
+
+from commons.async import callback_future, with_timeout
+from commons.exceptions import CommandTimeoutError, SessionNotFoundError
+import conf
+from settings import settings
+from logger import frame_log, LOG_OPS
+from profiler import Profiler, PROFILE_OPS
+from capture import capture, CAPTURE_OPS
+
+__all__ = ['SessionDirectory', 'CommandChannel', 'send_command',
+           'request_worker']
+
+IMEI_DIR = 'imei'
+WORKERS_DIR = 'workers'
+LINE_END = '\n'
+
+
+def to_bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def log_to_dict(log):
+    if hasattr(log, '_asdict'):
+        return dict(log._asdict())
+    return log
+
+
+class SessionDirectory(object):
+
+    r"""IMEI -> worker map shared by all workers of the host.
+
+    Every worker owns a command socket `workers/<pid>.sock`, every open
+    session is a symlink `imei/<IMEI>` to the socket of its worker. Lookup
+    and registration are a single readlink/rename, so the map costs O(1)
+    and needs no extra process. Keep `path` on tmpfs (/dev/shm)."""
+
+    def __init__(self, path, worker_id=None):
+        self.path = path
+        self.worker_id = worker_id if worker_id is not None else os.getpid()
+        for sub in (IMEI_DIR, WORKERS_DIR):
+            try:
+                os.makedirs(os.path.join(path, sub))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self.socket_path = os.path.join(path, WORKERS_DIR,
+                                        '%s.sock' % self.worker_id)
+
+    def imei_path(self, imei):
+        return os.path.join(self.path, IMEI_DIR, str(imei))
+
+    def register(self, imei):
+        link = self.imei_path(imei)
+        tmp = '%s.%s' % (link, self.worker_id)
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.symlink(self.socket_path, tmp)
+        os.rename(tmp, link)
+
+    def unregister(self, imei):
+        r"""Removes the IMEI only if it still belongs to this worker."""
+        if self.lookup(imei) == self.socket_path:
+            try:
+                os.remove(self.imei_path(imei))
+            except OSError:
+                pass
+
+    def lookup(self, imei):
+        r"""Returns command socket of the worker that owns IMEI."""
+        try:
+            return os.readlink(self.imei_path(imei))
+        except OSError:
+            return None
+
+    def is_local(self, imei):
+        return self.lookup(imei) == self.socket_path
+
+    def workers(self):
+        r"""Command sockets of all workers of the host."""
+        return glob.glob(os.path.join(self.path, WORKERS_DIR, '*.sock'))
+
+
+class CommandChannel(object):
+
+    r"""Command forwarding channel of one worker.
+
+    Listens on the worker socket for line delimited JSON requests:
+        {"imei": "...", "cmd": "RTO", "body": {"sub_cmd": 8}}
+    and answers with {"ok": true, "result": {...}} once the device acks
+    (or responds, for RTO), or {"ok": false, "error": "..."}.
+    Requests for devices of other workers are forwarded to them."""
+
+    def __init__(self, server, directory, io_loop, timeout=30):
+        self.server = server
+        self.directory = directory
+        self.io_loop = io_loop
+        self.timeout = timeout
+        self._socket = None
+
+    def listen(self):
+        self._socket = netutil.bind_unix_socket(self.directory.socket_path)
+        netutil.add_accept_handler(self._socket, self.on_connect,
+                                   io_loop=self.io_loop)
+
+    def stop(self):
+        if self._socket is not None:
+            self.io_loop.remove_handler(self._socket.fileno())
+            self._socket.close()
+            self._socket = None
+            os.remove(self.directory.socket_path)
+
+    def on_connect(self, sock, address):
+        stream = iostream.IOStream(sock, io_loop=self.io_loop)
+        self.io_loop.add_future(self.handle_stream(stream),
+                                lambda future: future.result())
+
+    @gen.coroutine
+    def handle_stream(self, stream):
+        try:
+            while not stream.closed():
+                line = yield gen.Task(stream.read_until, LINE_END)
+                response = yield self.handle_request(line)
+                stream.write(json.dumps(response) + LINE_END)
+        except iostream.StreamClosedError:
+            pass
+
+    @gen.coroutine
+    def handle_request(self, line):
+        try:
+            request = json.loads(line)
+            if request.get('op') in LOG_OPS:
+                result = frame_log.handle(request)
+            elif request.get('op') in PROFILE_OPS:
+                result = Profiler.instance().handle(request)
+            elif request.get('op') in CAPTURE_OPS:
+                result = capture.handle(request)
+            elif 'op' in request:
+                result = self.server.fleet.handle(request)
+            else:
+                body = dict((to_bytes(k), to_bytes(v))
+                            for k, v in (request.get('body') or {}).items())
+                result = yield self.execute(to_bytes(request['imei']),
+                                            to_bytes(request['cmd']), body)
+            response = {'ok': True, 'result': result}
+        except Exception as e:
+            response = {'ok': False,
+                        'error': '%s: %s' % (type(e).__name__, e)}
+        raise gen.Return(response)
+
+    @gen.coroutine
+    def execute(self, imei, cmd, body):
+        r"""Sends command to the device wherever it is connected.
+        Returns device ack (response for RTO) as a dict."""
+        session = self.server.dongles.get(imei)
+        if session is not None:
+            if cmd == conf.RTO_CMD:
+                future = session.make_rto(body)
+            else:
+                future = session.exec_command(conf.COMMAND, cmd, body)
+            result = yield with_timeout(
+                self.io_loop, future, self.timeout,
+                lambda: CommandTimeoutError("%s to %s" % (cmd, imei)))
+            if result == conf.DISCONN_RESULT:
+                raise SessionNotFoundError("%s disconnected" % imei)
+            raise gen.Return(log_to_dict(result))
+        socket_path = self.directory.lookup(imei)
+        if socket_path is None or socket_path == self.directory.socket_path:
+            raise SessionNotFoundError("%s is not connected" % imei)
+        response = yield self.forward(socket_path, imei, cmd, body)
+        if not response['ok']:
+            raise SessionNotFoundError(response['error'])
+        raise gen.Return(response['result'])
+
+    @gen.coroutine
+    def forward(self, socket_path, imei, cmd, body):
+        stream = iostream.IOStream(
+            socket.socket(socket.AF_UNIX, socket.SOCK_STREAM),
+            io_loop=self.io_loop)
+        on_timeout = lambda: CommandTimeoutError("%s to %s" % (cmd, imei))
+        try:
+            yield with_timeout(self.io_loop,
+                               callback_future(stream.connect,
+                                               socket_path),
+                               self.timeout, on_timeout)
+            stream.write(json.dumps(
+                {'imei': imei, 'cmd': cmd, 'body': body}) + LINE_END)
+            line = yield with_timeout(self.io_loop,
+                                      callback_future(stream.read_until,
+                                                      LINE_END),
+                                      self.timeout, on_timeout)
+        finally:
+            stream.close()
+        raise gen.Return(json.loads(line))
+
+
+def request_worker(socket_path, request, timeout=30):
+    r"""Blocking client for admin tools. Sends request to the worker
+    command socket and returns the decoded response."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request) + LINE_END)
+        data = ''
+        while not data.endswith(LINE_END):
+            chunk = sock.recv(4096)
+            if not chunk:
+                raise IOError("Worker closed the channel")
+            data += chunk
+    finally:
+        sock.close()
+    return json.loads(data)
+
+
+def send_command(imei, cmd, body=None, path=None, timeout=30):
+    r"""Sends command to the worker that owns IMEI and returns the
+    decoded response."""
+    directory = SessionDirectory(path or settings.DIRECTORY_PATH, 'admin')
+    socket_path = directory.lookup(imei)
+    if socket_path is None:
+        raise SessionNotFoundError("%s is not connected" % imei)
+    return request_worker(socket_path,
+                          {'imei': imei, 'cmd': cmd, 'body': body or {}},
+                          timeout)
+
+
+if __name__ == '__main__':
+    # python directory.py <IMEI> <CMD> [param=value ...]
+    imei, cmd = sys.argv[1], sys.argv[2]
+    body = dict(arg.split('=', 1) for arg in sys.argv[3:])
+    print json.dumps(send_command(imei, cmd, body), indent=2)
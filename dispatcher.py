@@ -0,0 +1,240 @@
+import random
+import functools
+from collections import deque
+
+from tornado.concurrent import Future
+from tornado.iostream import StreamClosedError
+
+from commons.exceptions import CommandTimeoutError
+from protocol import fill_serial
+import conf
+
+__all__ = ['CommandDispatcher', 'SerialAllocator']
+
+
+def resolve(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def fail(future, exc):
+    if not future.done():
+        future.set_exception(exc)
+
+
+class SerialAllocator(object):
+
+    r"""Hands out 4 hex digit serial numbers in sequence, wrapping at FFFF
+    and skipping serials still in use. Starts at a random point, so acks
+    for the previous connection of the device do not match."""
+
+    __slots__ = ('limit', 'next_serial')
+
+    def __init__(self, start=None, limit=0x10000):
+        self.limit = limit
+        self.next_serial = random.randrange(limit) if start is None else start
+
+    def allocate(self, in_use):
+        for _ in xrange(self.limit):
+            serial = '%04X' % self.next_serial
+            self.next_serial = (self.next_serial + 1) % self.limit
+            if serial not in in_use:
+                return serial
+        raise RuntimeError("All serial numbers are in use")
+
+
+class Command(object):
+
+    __slots__ = ('header', 'body', 'future', 'response', 'template',
+                 'serial', 'message', 'attempts', 'timer')
+
+    def __init__(self, header, body, future, response=None, template=None):
+        self.header = header
+        self.body = body
+        self.future = future
+        self.response = response
+        self.template = template
+        self.serial = None
+        self.message = None
+        self.attempts = 0
+        self.timer = None
+
+
+class CommandDispatcher(object):
+
+    r"""Commands of one session.
+
+    Up to `window` commands wait for acks at once, the rest are queued.
+    Each command gets the next free serial number, unacked command is
+    resent with the same serial `retries` times, the wait for the ack
+    grows `backoff` times on every attempt. Duplicate acks of a resent
+    command are ignored.
+
+    RTO command resolves with the report it asks for. Ack is matched by
+    serial, the report carries no serial, so reports of one type are
+    given to acked RTOs in the order of their acks.
+    Queues exist only while there are commands in them."""
+
+    __slots__ = ('session', 'window', 'timeout', 'retries', 'backoff',
+                 'serials', 'in_flight', 'queue', 'responses', 'sent',
+                 'retried', 'expired')
+
+    def __init__(self, session, window=conf.COMMAND_WINDOW,
+                 timeout=conf.COMMAND_TIMEOUT, retries=conf.COMMAND_RETRIES,
+                 backoff=conf.COMMAND_BACKOFF):
+        self.session = session
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.serials = SerialAllocator()
+        self.in_flight = {}         # serial -> command waiting for ack
+        self.queue = None           # commands waiting for a slot
+        self.responses = {}         # report header -> acked RTO commands
+        self.sent = 0
+        self.retried = 0
+        self.expired = 0
+
+    def send(self, header, body, response=None):
+        r"""Sends command to the device.
+        Returns:
+            future of the ack, or of the `response` report header
+        """
+        cmd = Command(header, dict(body), Future(), response)
+        self.enqueue(cmd)
+        return cmd.future
+
+    def send_prepared(self, header, template):
+        r"""Sends command built by `build_cmd_template`. Returns future
+        of the ack."""
+        cmd = Command(header, None, Future(), template=template)
+        self.enqueue(cmd)
+        return cmd.future
+
+    def send_rto(self, body):
+        sub_cmd = int(body.get('sub_cmd', -1))
+        return self.send(conf.RTO_CMD, body,
+                         response=conf.RTO_RESPONSES.get(sub_cmd))
+
+    def enqueue(self, cmd):
+        if self.queue is None:
+            self.queue = deque()
+        self.queue.append(cmd)
+        self.pump()
+
+    def pump(self):
+        while self.queue and len(self.in_flight) < self.window:
+            cmd = self.queue.popleft()
+            if not self.queue:
+                self.queue = None
+            cmd.serial = self.serials.allocate(self.in_flight)
+            try:
+                if cmd.template is not None:
+                    cmd.message = fill_serial(cmd.template, cmd.serial)
+                else:
+                    cmd.message = self.session.build_cmd(
+                        cmd.header, serial_number=cmd.serial, **cmd.body)
+            except Exception as e:
+                fail(cmd.future, e)
+                continue
+            self.in_flight[cmd.serial] = cmd
+            self.sent += 1
+            self.transmit(cmd)
+
+    def transmit(self, cmd):
+        try:
+            self.session.send_message(cmd.message)
+        except StreamClosedError:
+            # device is gone, the session closes on its own
+            del self.in_flight[cmd.serial]
+            resolve(cmd.future, conf.DISCONN_RESULT)
+            return
+        timeout = self.timeout * self.backoff ** cmd.attempts
+        cmd.attempts += 1
+        cmd.timer = self.session.timers.call_later(
+            timeout, functools.partial(self.on_timeout, cmd))
+
+    def on_timeout(self, cmd):
+        if self.in_flight.get(cmd.serial) is not cmd:
+            return
+        if cmd.attempts <= self.retries and not self.session.is_closed():
+            self.retried += 1
+            self.transmit(cmd)
+            return
+        del self.in_flight[cmd.serial]
+        self.expired += 1
+        fail(cmd.future, CommandTimeoutError(
+            "No ack for %s %s" % (cmd.header, cmd.serial)))
+        self.pump()
+
+    def on_ack(self, ack):
+        cmd = self.in_flight.pop(ack.serial_number, None)
+        if cmd is None:     # ack of resent command or unknown serial
+            return
+        cmd.timer.cancel()
+        self.session.on_command_ack(cmd.message)
+        if cmd.response is None:
+            resolve(cmd.future, ack)
+        else:
+            self.responses.setdefault(cmd.response, deque()).append(cmd)
+            cmd.timer = self.session.timers.call_later(
+                conf.RTO_TIMEOUT, functools.partial(self.on_no_response, cmd))
+        self.pump()
+
+    def on_report(self, log):
+        r"""Passes report to the RTO waiting for it. Returns True if the
+        report is a response."""
+        waiting = self.responses.get(log.header)
+        if not waiting:
+            return False
+        cmd = waiting.popleft()
+        if not waiting:
+            del self.responses[log.header]
+        cmd.timer.cancel()
+        resolve(cmd.future, log.log)
+        return True
+
+    def on_no_response(self, cmd):
+        waiting = self.responses.get(cmd.response)
+        if waiting and cmd in waiting:
+            waiting.remove(cmd)
+            if not waiting:
+                del self.responses[cmd.response]
+            self.expired += 1
+            fail(cmd.future, CommandTimeoutError(
+                "No %s response for %s" % (cmd.response, cmd.serial)))
+
+    def pending(self):
+        r"""Sent and not acked commands as [serial, message] pairs."""
+        return [[cmd.serial, cmd.message] for cmd in self.in_flight.values()]
+
+    def adopt(self, serial, message):
+        r"""Keeps retrying command sent by the previous process, nobody
+        waits for its ack here."""
+        cmd = Command(None, None, Future())
+        cmd.serial, cmd.message, cmd.attempts = serial, message, 1
+        self.in_flight[serial] = cmd
+        cmd.timer = self.session.timers.call_later(
+            self.timeout, functools.partial(self.on_timeout, cmd))
+
+    def close(self):
+        r"""Resolves every command with DISCONN_RESULT."""
+        commands = list(self.queue or ()) + self.in_flight.values()
+        for waiting in self.responses.values():
+            commands.extend(waiting)
+        self.queue = None
+        self.in_flight.clear()
+        self.responses.clear()
+        for cmd in commands:
+            if cmd.timer is not None:
+                cmd.timer.cancel()
+            resolve(cmd.future, conf.DISCONN_RESULT)
+
+    def stats(self):
+        return {'in_flight': len(self.in_flight),
+                'queued': len(self.queue or ()),
+                'waiting_response': sum(len(waiting) for waiting
+                                        in self.responses.values()),
+                'sent': self.sent,
+                'retried': self.retried,
+                'expired': self.expired}
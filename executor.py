@@ -0,0 +1,94 @@
+import time
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from toro import Semaphore
+from tornado import gen
+
+from settings import settings
+
+__all__ = ['SinkExecutor']
+
+
+class SinkExecutor(object):
+
+    r"""Bounded thread pool for blocking sink I/O (database, publisher).
+
+    `submit` returns a future that resolves on the IOLoop. At most
+    `max_pending` jobs are queued or running, when the limit is hit
+    `submit` waits for a free slot, so callers that yield it are slowed
+    down instead of piling up jobs in memory.
+
+    Measured per job:
+        stall time - waiting for a free slot on the IOLoop
+        wait time  - waiting in the pool queue for a worker thread
+    """
+
+    def __init__(self, workers=4, max_pending=1000, io_loop=None):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._slots = Semaphore(max_pending, io_loop=io_loop)
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.stall_time = 0.
+        self.wait_time = 0.
+        self.max_wait_time = 0.
+
+    @classmethod
+    def instance(cls):
+        """Singleton like accessor to instantiate executor object"""
+        if not hasattr(cls, "_instance"):
+            cls._instance = cls(workers=settings.SINK_WORKERS,
+                                max_pending=settings.SINK_MAX_PENDING)
+        return cls._instance
+
+    @classmethod
+    def shutdown(cls, wait=True):
+        if hasattr(cls, "_instance"):
+            cls._instance._pool.shutdown(wait=wait)
+
+    @gen.coroutine
+    def submit(self, fn, *args, **kwargs):
+        r"""Runs fn in the pool. Returns future with its result."""
+        stalled = time.time()
+        yield self._slots.acquire()
+        enqueued = time.time()
+        self.stall_time += enqueued - stalled
+        self.pending += 1
+        self.submitted += 1
+        try:
+            result = yield self._pool.submit(self._run, enqueued,
+                                             fn, args, kwargs)
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.pending -= 1
+            self._slots.release()
+        self.completed += 1
+        raise gen.Return(result)
+
+    def _run(self, enqueued, fn, args, kwargs):
+        wait = time.time() - enqueued
+        with self._lock:
+            self.wait_time += wait
+            self.max_wait_time = max(self.max_wait_time, wait)
+        return fn(*args, **kwargs)
+
+    def is_saturated(self):
+        return self.pending >= self.max_pending
+
+    def stats(self):
+        started = max(self.completed + self.failed, 1)
+        return {'workers': self.workers,
+                'pending': self.pending,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'stall_time': self.stall_time,
+                'avg_wait_time': self.wait_time / started,
+                'max_wait_time': self.max_wait_time}
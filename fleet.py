@@ -0,0 +1,311 @@
+import sys
+import json
+import uuid
+import fnmatch
+import functools
+from collections import deque
+
+from tornado import gen, ioloop
+
+from commons.exceptions import CommandTimeoutError
+from directory import SessionDirectory, request_worker, to_bytes
+from protocol import QueclinkProtocol
+from timewheel import TimingWheel
+from flow import TokenBucket
+import conf
+from settings import settings
+from logger import gen_log
+
+__all__ = ['DeviceSelector', 'FleetPush', 'FleetPusher',
+           'send_push', 'push_status', 'cancel_push']
+
+# device status of a push
+(PENDING, OFFLINE, SENT, TIMEOUT, ACKED) = (
+    'pending', 'offline', 'sent', 'timeout', 'acked')
+# the best one wins when statuses of the workers are merged
+STATUS_RANK = dict((status, rank) for rank, status in
+                   enumerate((OFFLINE, PENDING, TIMEOUT, SENT, ACKED)))
+
+
+class DeviceSelector(object):
+
+    r"""Devices a push is meant for: IMEIs and fnmatch patterns of IMEIs
+    (e.g. '8642510200*')."""
+
+    def __init__(self, imeis=None, patterns=None):
+        self.imeis = set(imeis or ())
+        self.patterns = list(patterns or ())
+
+    def matches(self, imei):
+        if imei in self.imeis:
+            return True
+        return any(fnmatch.fnmatchcase(imei, pattern)
+                   for pattern in self.patterns)
+
+
+class FleetPush(object):
+
+    r"""One command pushed to a group of devices and its status per
+    device. Listed IMEIs are `offline` until they connect, devices matched
+    by pattern show up as they connect."""
+
+    def __init__(self, push_id, header, template, selector, expires_at):
+        self.push_id = push_id
+        self.header = header
+        self.template = template
+        self.selector = selector
+        self.expires_at = expires_at
+        self.status = dict.fromkeys(selector.imeis, OFFLINE)
+        self.queue = deque()
+        self.pumping = False
+        self.active = True
+        self.timer = None
+
+    def summary(self, devices=False):
+        counts = dict.fromkeys(STATUS_RANK, 0)
+        for status in self.status.itervalues():
+            counts[status] += 1
+        summary = {'id': self.push_id,
+                   'cmd': self.header,
+                   'active': self.active,
+                   'expires_at': self.expires_at,
+                   'counts': counts}
+        if devices:
+            summary['devices'] = self.status
+        return summary
+
+    def state(self, now):
+        r"""The push for the process taking over, see `FleetPusher`."""
+        return {'id': self.push_id,
+                'cmd': self.header,
+                'template': self.template,
+                'imeis': list(self.selector.imeis),
+                'patterns': self.selector.patterns,
+                'ttl': self.expires_at - now,
+                'status': self.status}
+
+
+class FleetPusher(object):
+
+    r"""Pushes configuration commands to the devices of this process.
+
+    Command is validated and serialised once, each device gets it with
+    its own serial number through its command dispatcher. Sends of all
+    pushes share one token bucket. Devices that are offline or
+    do not ack get the command again when they (re)connect, until they
+    ack or the push expires.
+
+    Pushes go to the process taking the worker over with the sessions.
+    Commands in flight are not tracked there, so devices that have not
+    acked get the command again as their sessions are adopted."""
+
+    def __init__(self, server, bucket=None, io_loop=None):
+        self.server = server
+        self.io_loop = io_loop or ioloop.IOLoop.current()
+        self.bucket = bucket or TokenBucket(settings.PUSH_RATE,
+                                            settings.PUSH_BURST, self.io_loop)
+        self.builder = QueclinkProtocol()
+        self.pushes = {}
+
+    def push(self, cmd, body, imeis=None, patterns=None, ttl=None,
+             push_id=None):
+        r"""Starts push of command to matching devices. Invalid command
+        raises right away. Returns FleetPush."""
+        template = self.builder.build_cmd_template(cmd, **body)
+        ttl = ttl or settings.PUSH_TTL
+        push = FleetPush(push_id or uuid.uuid4().hex, cmd, template,
+                         DeviceSelector(imeis, patterns),
+                         self.io_loop.time() + ttl)
+        self.pushes[push.push_id] = push
+        push.timer = TimingWheel.instance().call_later(
+            ttl, functools.partial(self.cancel, push.push_id))
+        for imei in self.server.dongles.keys():
+            if push.selector.matches(imei):
+                self.enqueue(push, imei)
+        gen_log.info("PUSH %s of %s to %d devices online",
+                     push.push_id, cmd, len(push.queue))
+        return push
+
+    def detach(self):
+        r"""States of the pushes for `restore` in another process."""
+        now = self.io_loop.time()
+        return [push.state(now) for push in self.pushes.itervalues()]
+
+    def restore(self, states):
+        r"""Continues pushes of the previous process. Call it before the
+        sessions are adopted."""
+        for state in states:
+            if state['ttl'] <= 0:
+                continue
+            push = FleetPush(to_bytes(state['id']), to_bytes(state['cmd']),
+                             to_bytes(state['template']),
+                             DeviceSelector(map(to_bytes, state['imeis']),
+                                            map(to_bytes, state['patterns'])),
+                             self.io_loop.time() + state['ttl'])
+            for imei, status in state['status'].iteritems():
+                # the previous process waited for the ack
+                push.status[to_bytes(imei)] = OFFLINE \
+                    if status in (PENDING, SENT) else to_bytes(status)
+            self.pushes[push.push_id] = push
+            push.timer = TimingWheel.instance().call_later(
+                state['ttl'], functools.partial(self.cancel, push.push_id))
+        if states:
+            gen_log.info("PUSH %d taken over", len(self.pushes))
+
+    def cancel(self, push_id):
+        push = self.pushes.pop(push_id, None)
+        if push is not None:
+            push.active = False
+            push.queue.clear()
+            push.timer.cancel()
+        return push
+
+    def on_session_open(self, imei):
+        for push in self.pushes.itervalues():
+            if push.status.get(imei) != ACKED and push.selector.matches(imei):
+                self.enqueue(push, imei)
+
+    def enqueue(self, push, imei):
+        if push.status.get(imei) in (PENDING, SENT):
+            return
+        push.status[imei] = PENDING
+        push.queue.append(imei)
+        if not push.pumping:
+            push.pumping = True
+            self.io_loop.add_future(self.pump(push),
+                                    lambda future: future.result())
+
+    @gen.coroutine
+    def pump(self, push):
+        try:
+            while push.queue:
+                yield self.bucket.acquire()
+                if not push.queue:  # cancelled meanwhile
+                    break
+                imei = push.queue.popleft()
+                session = self.server.dongles.get(imei)
+                if session is None or not session.is_open():
+                    push.status[imei] = OFFLINE
+                    continue
+                push.status[imei] = SENT
+                self.io_loop.add_future(
+                    session.commands.send_prepared(push.header,
+                                                   push.template),
+                    functools.partial(self.on_result, push, imei))
+        finally:
+            push.pumping = False
+
+    def on_result(self, push, imei, future):
+        try:
+            result = future.result()
+        except CommandTimeoutError:
+            push.status[imei] = TIMEOUT
+            return
+        if result == conf.DISCONN_RESULT:
+            push.status[imei] = OFFLINE
+        else:
+            push.status[imei] = ACKED
+
+    def handle(self, request):
+        r"""Fleet requests of the command channel:
+            {"op": "push", "cmd": "FRI", "body": {...}, "imeis": [...],
+             "patterns": [...], "ttl": 3600, "id": "..."}
+            {"op": "push_status", "id": "...", "devices": true}
+            {"op": "push_cancel", "id": "..."}
+        """
+        op = request['op']
+        if op == 'push':
+            body = dict((to_bytes(k), to_bytes(v))
+                        for k, v in (request.get('body') or {}).items())
+            push = self.push(to_bytes(request['cmd']), body,
+                             imeis=map(to_bytes, request.get('imeis') or []),
+                             patterns=map(to_bytes,
+                                          request.get('patterns') or []),
+                             ttl=request.get('ttl'),
+                             push_id=request.get('id'))
+        elif op == 'push_status':
+            push = self.pushes.get(request['id'])
+        elif op == 'push_cancel':
+            push = self.cancel(request['id'])
+        else:
+            raise ValueError("Unknown operation %s" % op)
+        if push is None:
+            return None
+        return push.summary(devices=request.get('devices', False))
+
+
+def merge_summaries(summaries):
+    r"""Status of a push on the whole host from statuses of the workers."""
+    summaries = [summary for summary in summaries if summary]
+    if not summaries:
+        return None
+    devices = {}
+    for summary in summaries:
+        for imei, status in summary['devices'].iteritems():
+            if STATUS_RANK[status] > STATUS_RANK.get(devices.get(imei), -1):
+                devices[imei] = status
+    counts = dict.fromkeys(STATUS_RANK, 0)
+    for status in devices.itervalues():
+        counts[status] += 1
+    merged = dict(summaries[0])
+    merged.update({'active': any(s['active'] for s in summaries),
+                   'counts': counts, 'devices': devices})
+    return merged
+
+
+def broadcast(request, path=None, timeout=30):
+    r"""Sends request to every worker of the host, returns results."""
+    directory = SessionDirectory(path or settings.DIRECTORY_PATH, 'admin')
+    results = []
+    for socket_path in directory.workers():
+        try:
+            response = request_worker(socket_path, request, timeout)
+        except (IOError, OSError) as e:
+            gen_log.warning("worker %s is not available %s", socket_path, e)
+            continue
+        if not response['ok']:
+            raise ValueError(response['error'])
+        results.append(response['result'])
+    return results
+
+
+def send_push(cmd, body, imeis=None, patterns=None, ttl=None, path=None):
+    r"""Starts push on all workers. Returns push id."""
+    push_id = uuid.uuid4().hex
+    broadcast({'op': 'push', 'id': push_id, 'cmd': cmd, 'body': body,
+               'imeis': imeis or [], 'patterns': patterns or [],
+               'ttl': ttl}, path)
+    return push_id
+
+
+def push_status(push_id, path=None):
+    return merge_summaries(broadcast(
+        {'op': 'push_status', 'id': push_id, 'devices': True}, path))
+
+
+def cancel_push(push_id, path=None):
+    return merge_summaries(broadcast(
+        {'op': 'push_cancel', 'id': push_id, 'devices': True}, path))
+
+
+if __name__ == '__main__':
+    # python fleet.py push <CMD> [param=value ...] [imei=<IMEI> ...]
+    #                          [pattern=<GLOB> ...] [ttl=<seconds>]
+    # python fleet.py status|cancel <push id>
+    if sys.argv[1] == 'push':
+        body, imeis, patterns, ttl = {}, [], [], None
+        for arg in sys.argv[3:]:
+            key, value = arg.split('=', 1)
+            if key == 'imei':
+                imeis.append(value)
+            elif key == 'pattern':
+                patterns.append(value)
+            elif key == 'ttl':
+                ttl = int(value)
+            else:
+                body[key] = value
+        print send_push(sys.argv[2], body, imeis, patterns, ttl)
+    elif sys.argv[1] == 'status':
+        print json.dumps(push_status(sys.argv[2]), indent=2)
+    elif sys.argv[1] == 'cancel':
+        print json.dumps(cancel_push(sys.argv[2]), indent=2)
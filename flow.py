@@ -0,0 +1,237 @@
+import time
+from collections import deque
+
+from toro import Condition
+from tornado import gen, ioloop
+from tornado.concurrent import Future
+
+from settings import settings
+
+__all__ = ['FlowControl', 'Sequencer', 'TokenBucket']
+
+
+class FlowControl(object):
+
+    r"""Counts frames read from sockets and not processed yet.
+
+    Session keeps its own counter with process wide one as a parent.
+    Once any of them reaches its limit, `wait` blocks the reader, socket
+    is not read anymore and TCP flow control slows the device down.
+    Lives on the IOLoop thread only."""
+
+    __slots__ = ('limit', 'parent', 'pending', 'max_pending', 'stalls',
+                 'stall_time', 'closed', 'io_loop', '_cond')
+
+    def __init__(self, limit, parent=None, io_loop=None):
+        self.limit = limit
+        self.parent = parent
+        self.pending = 0
+        self.max_pending = 0
+        self.stalls = 0
+        self.stall_time = 0.
+        self.closed = False
+        self.io_loop = io_loop
+        self._cond = None   # created by the first waiter
+
+    @classmethod
+    def instance(cls):
+        """Singleton like accessor to instantiate process flow control"""
+        if not hasattr(cls, "_instance"):
+            cls._instance = cls(settings.PROCESS_MAX_PENDING)
+        return cls._instance
+
+    def _wait(self):
+        if self._cond is None:
+            self._cond = Condition(io_loop=self.io_loop)
+        return self._cond.wait()
+
+    def _notify_all(self):
+        if self._cond is not None:
+            self._cond.notify_all()
+
+    def is_full(self):
+        if self.pending >= self.limit:
+            return True
+        return self.parent is not None and self.parent.is_full()
+
+    def acquire(self, n=1):
+        if self.closed:
+            return
+        self.pending += n
+        self.max_pending = max(self.max_pending, self.pending)
+        if self.parent is not None:
+            self.parent.acquire(n)
+
+    def release(self, n=1):
+        if self.closed:
+            return
+        was_full = self.pending >= self.limit
+        self.pending -= n
+        if self.parent is not None:
+            self.parent.release(n)
+        if was_full and self.pending < self.limit or self.pending <= 0:
+            self._notify_all()
+
+    @gen.coroutine
+    def wait(self):
+        r"""Resolves once there is room for more frames."""
+        if not self.is_full():
+            return
+        started = time.time()
+        self.stalls += 1
+        while not self.closed and self.is_full():
+            if self.pending >= self.limit:
+                yield self._wait()
+            else:
+                yield self.parent.wait()
+        self.stall_time += time.time() - started
+
+    @gen.coroutine
+    def join(self):
+        r"""Resolves once all acquired frames are released."""
+        while not self.closed and self.pending > 0:
+            yield self._wait()
+
+    def close(self):
+        r"""Gives pending frames back to the parent."""
+        if self.closed:
+            return
+        if self.parent is not None:
+            self.parent.release(self.pending)
+        self.closed = True
+        self._notify_all()
+
+    def stats(self):
+        return {'pending': self.pending,
+                'max_pending': self.max_pending,
+                'limit': self.limit,
+                'stalls': self.stalls,
+                'stall_time': self.stall_time}
+
+
+class Sequencer(object):
+
+    r"""Keeps frames of one session in arrival order.
+
+    Up to `window` frames are in flight at once. Each frame gets a
+    sequence number on `acquire`, may be parsed as soon as it arrives,
+    but has to wait for its `turn` before it updates session state and
+    goes to sinks. `done` passes the turn to the next frame.
+    Waiters for the window and for turns are kept only while there are
+    any, idle sessions hold just the counters."""
+
+    __slots__ = ('window', '_next_seq', '_turn_seq', '_turns', '_waiters',
+                 'in_flight', 'reordered')
+
+    def __init__(self, window, io_loop=None):
+        self.window = window
+        self._next_seq = 0
+        self._turn_seq = 0
+        self._turns = None      # seq -> future of its turn
+        self._waiters = None    # futures waiting for a slot in the window
+        self.in_flight = 0
+        self.reordered = 0
+
+    @gen.coroutine
+    def acquire(self):
+        r"""Waits for a free slot in the window, returns sequence number."""
+        while self.in_flight >= self.window or self._waiters:
+            if self._waiters is None:
+                self._waiters = deque()
+            future = Future()
+            self._waiters.append(future)
+            yield future
+            if self.in_flight < self.window:
+                break
+        raise gen.Return(self.take())
+
+    def take(self):
+        r"""Sequence number for callers that keep to the window
+        themselves, the slot has to be free."""
+        assert self.in_flight < self.window, "Window is full"
+        seq = self._next_seq
+        self._next_seq += 1
+        self.in_flight += 1
+        return seq
+
+    def turn(self, seq):
+        r"""Future that resolves when frames before `seq` are done."""
+        future = Future()
+        if seq == self._turn_seq:
+            future.set_result(seq)
+        else:
+            self.reordered += 1
+            if self._turns is None:
+                self._turns = {}
+            self._turns[seq] = future
+        return future
+
+    def done(self, seq):
+        assert seq == self._turn_seq, "Frame %d is done out of turn" % seq
+        self._turn_seq += 1
+        self.in_flight -= 1
+        if self._waiters:
+            self._waiters.popleft().set_result(None)
+            if not self._waiters:
+                self._waiters = None
+        if self._turns:
+            future = self._turns.pop(self._turn_seq, None)
+            if not self._turns:
+                self._turns = None
+            if future is not None:
+                future.set_result(self._turn_seq)
+
+    def stats(self):
+        return {'window': self.window,
+                'in_flight': self.in_flight,
+                'reordered': self.reordered}
+
+
+class TokenBucket(object):
+
+    r"""Rate limiter. Holds up to `burst` tokens refilled at `rate` per
+    second, `acquire` waits for a token. Waiters are served in order.
+    Lives on the IOLoop thread only."""
+
+    def __init__(self, rate, burst, io_loop=None):
+        self.rate = float(rate)
+        self.burst = burst
+        self.io_loop = io_loop or ioloop.IOLoop.current()
+        self.tokens = float(burst)
+        self.updated = self.io_loop.time()
+        self.waiters = deque()
+        self._timeout = None
+
+    def refill(self):
+        now = self.io_loop.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        r"""Takes a token if there is one and nobody waits for it."""
+        self.refill()
+        if self.waiters or self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def acquire(self):
+        future = Future()
+        self.waiters.append(future)
+        self.drain()
+        return future
+
+    def drain(self):
+        self.refill()
+        while self.waiters and self.tokens >= 1:
+            self.tokens -= 1
+            self.waiters.popleft().set_result(None)
+        if self.waiters and self._timeout is None:
+            self._timeout = self.io_loop.add_timeout(
+                self.updated + (1 - self.tokens) / self.rate,
+                self.on_timeout)
+
+    def on_timeout(self):
+        self._timeout = None
+        self.drain()
@@ -0,0 +1,204 @@
+import os
+import json
+import errno
+import base64
+import socket
+import struct
+
+from _multiprocessing import sendfd, recvfd
+from tornado import gen, netutil
+
+from logger import gen_log
+
+__all__ = ['HandoffServer', 'take_over', 'handoff_path']
+
+HANDOFF_DIR = 'handoff'
+TAKEOVER = 'TAKEOVER\n'
+DONE = 'DONE\n'
+HEADER = struct.Struct('!I')
+
+
+def handoff_path(path, worker_id=None):
+    key = 'main' if worker_id is None else worker_id
+    return os.path.join(path, HANDOFF_DIR, '%s.sock' % key)
+
+
+def set_timeout(sock, timeout):
+    r"""Blocking socket with kernel timeouts. `settimeout` would make the
+    descriptor non-blocking, which sendfd/recvfd do not handle."""
+    sock.setblocking(1)
+    value = struct.pack('ll', int(timeout), int(timeout % 1 * 1000000))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, value)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, value)
+
+
+def recv_exactly(sock, size):
+    data = ''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise IOError("Handoff peer closed the connection")
+        data += chunk
+    return data
+
+
+def encode_state(state):
+    state = dict(state)
+    state['pending'] = base64.b64encode(state['pending'])
+    return state
+
+
+def decode_state(state):
+    state = dict((str(k), v) for k, v in state.items())
+    state['imei'] = str(state['imei'])
+    state['cnt_number'] = str(state['cnt_number'])
+    state['commands'] = [[str(serial), str(message)]
+                         for serial, message in state['commands']]
+    state['pending'] = base64.b64decode(state['pending'])
+    return state
+
+
+class HandoffServer(object):
+
+    r"""Hands listening sockets and live sessions over to a new process.
+
+    A new process started for a reload connects to `path` and sends
+    TAKEOVER. The old process stops accepting, detaches every open session
+    and sends, over the same unix socket:
+        4 byte length + JSON {"listeners": [family, ...],
+                              "sessions": [[family, state], ...]}
+        file descriptors of listeners and sessions in the same order
+    Header carries pending fleet pushes too, as "pushes": [state, ...].
+    Then the old process waits for DONE and calls `on_done` to drain sinks
+    and exit.
+    Devices keep their TCP connections and are not asked to re-verify."""
+
+    def __init__(self, server, channel, path, io_loop, on_done,
+                 timeout=30):
+        self.server = server
+        self.channel = channel
+        self.path = path
+        self.io_loop = io_loop
+        self.on_done = on_done
+        self.timeout = timeout
+        self._socket = None
+
+    def listen(self):
+        try:
+            os.makedirs(os.path.dirname(self.path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self._socket = netutil.bind_unix_socket(self.path)
+        netutil.add_accept_handler(self._socket, self.on_connect,
+                                   io_loop=self.io_loop)
+
+    def stop(self):
+        if self._socket is not None:
+            self.io_loop.remove_handler(self._socket.fileno())
+            self._socket.close()
+            self._socket = None
+            os.remove(self.path)
+
+    def on_connect(self, conn, address):
+        # the listener is closed by `handle`, leave the accept loop first
+        self.io_loop.add_callback(
+            lambda: self.io_loop.add_future(self.handle(conn),
+                                            lambda future: future.result()))
+
+    @gen.coroutine
+    def handle(self, conn):
+        set_timeout(conn, self.timeout)
+        try:
+            if recv_exactly(conn, len(TAKEOVER)) != TAKEOVER:
+                conn.close()
+                return
+        except (IOError, socket.error) as e:
+            gen_log.warning("bad handoff request %s", e)
+            conn.close()
+            return
+        gen_log.info("HANDOFF: started")
+        # socket paths are free for the new process from now on
+        self.stop()
+        self.channel.stop()
+        listeners = self.server.detach_sockets()
+        detached = yield [self.detach(session)
+                          for session in self.server.dongles.values()]
+        detached = [item for item in detached if item is not None]
+        fleet = self.server.fleet
+        pushes = fleet.detach() if fleet is not None else []
+        try:
+            self.send(conn, listeners, detached, pushes)
+            if recv_exactly(conn, len(DONE)) != DONE:
+                raise IOError("Handoff was not confirmed")
+            gen_log.info("HANDOFF: passed %d sessions", len(detached))
+        except (IOError, OSError, socket.error) as e:
+            # descriptors are gone with the new process, devices reconnect
+            gen_log.error("HANDOFF: failed %s", e)
+        finally:
+            conn.close()
+            for sock in listeners:
+                sock.close()
+            for fd, family, state in detached:
+                os.close(fd)
+        self.on_done()
+
+    @gen.coroutine
+    def detach(self, session):
+        if session.stream.closed():
+            return
+        family = session.stream.socket.family
+        try:
+            fd, state = yield session.detach()
+        except Exception as e:
+            gen_log.exception(e)
+            return
+        raise gen.Return((fd, family, state))
+
+    def send(self, conn, listeners, detached, pushes):
+        header = json.dumps({
+            'listeners': [sock.family for sock in listeners],
+            'sessions': [[family, encode_state(state)]
+                         for fd, family, state in detached],
+            'pushes': pushes})
+        conn.sendall(HEADER.pack(len(header)) + header)
+        for sock in listeners:
+            sendfd(conn.fileno(), sock.fileno())
+        for fd, family, state in detached:
+            sendfd(conn.fileno(), fd)
+
+
+def take_over(path, timeout=60):
+    r"""Takes listening sockets and sessions over from the process that
+    listens on handoff `path`.
+    Returns:
+        (listeners, [(socket, state), ...], [push state, ...]) or None if
+        nobody listens
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    set_timeout(conn, timeout)
+    try:
+        conn.connect(path)
+    except socket.error:
+        conn.close()
+        return None
+    try:
+        conn.sendall(TAKEOVER)
+        size, = HEADER.unpack(recv_exactly(conn, HEADER.size))
+        header = json.loads(recv_exactly(conn, size))
+        listeners = [from_fd(recvfd(conn.fileno()), family)
+                     for family in header['listeners']]
+        sessions = [(from_fd(recvfd(conn.fileno()), family),
+                     decode_state(state))
+                    for family, state in header['sessions']]
+        conn.sendall(DONE)
+    finally:
+        conn.close()
+    return listeners, sessions, header.get('pushes', [])
+
+
+def from_fd(fd, family):
+    sock = socket.fromfd(fd, family, socket.SOCK_STREAM)
+    os.close(fd)
+    sock.setblocking(0)
+    return sock
@@ -0,0 +1,272 @@
+import os
+import sys
+import glob
+import json
+import time
+import errno
+import ctypes
+import ctypes.util
+import signal
+import multiprocessing
+
+import server
+from settings import settings
+from logger import gen_log, stop_queue_logging
+
+__all__ = ['Supervisor', 'pin_to_cpu', 'aggregate_stats']
+
+CPU_SETSIZE = 1024
+# worker that dies sooner than that is restarted with growing delay
+MIN_UPTIME = 10.0
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'server.py')
+
+
+def pin_to_cpu(cpu):
+    r"""Binds current process to a single CPU (Linux only)."""
+    ulong_bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+    mask = (ctypes.c_ulong * (CPU_SETSIZE // ulong_bits))()
+    mask[cpu // ulong_bits] = 1 << (cpu % ulong_bits)
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if libc.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)):
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+
+def merge_stats(total, stats):
+    r"""Adds numeric leaves of `stats` to `total`, `max_*` keep the
+    maximum."""
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            merge_stats(total.setdefault(key, {}), value)
+        elif isinstance(value, (int, long, float)) and \
+                not isinstance(value, bool):
+            if key.startswith('max_'):
+                total[key] = max(total.get(key, value), value)
+            else:
+                total[key] = total.get(key, 0) + value
+    return total
+
+
+def aggregate_stats(path=None):
+    r"""Sums stats dumped by the workers into one report."""
+    path = path or settings.DIRECTORY_PATH
+    workers, total = {}, {}
+    for name in glob.glob(os.path.join(path, server.STATS_DIR, '*.json')):
+        try:
+            with open(name) as f:
+                stats = json.load(f)
+        except (IOError, ValueError):
+            continue
+        stats.pop('pid', None)
+        workers[os.path.basename(name)[:-len('.json')]] = stats
+        merge_stats(total, stats)
+    return {'workers': len(workers), 'total': total, 'per_worker': workers}
+
+
+class Supervisor(object):
+
+    r"""Runs `workers` server processes on one port and keeps them alive.
+
+    Each worker has a stable id 0..workers-1, its own SO_REUSEPORT listener,
+    spool directory and command socket, so a restarted worker takes over
+    the spool and the sessions directory entries of the crashed one.
+    SIGTERM/SIGINT stop all workers, SIGUSR1 logs aggregated stats,
+    SIGUSR2 is passed to the workers and toggles their profilers.
+
+    SIGHUP reloads workers one by one: a fresh `server.py --takeover` is
+    started for each worker id, takes its listener and live sessions over,
+    and the old worker exits after draining its sinks."""
+
+    def __init__(self, port, workers=None, address='', backlog=128,
+                 cpu_affinity=False, restart_delay=1.0,
+                 max_restart_delay=30.0):
+        self.port = port
+        self.workers = workers or multiprocessing.cpu_count()
+        self.address = address
+        self.backlog = backlog
+        self.cpu_affinity = cpu_affinity
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.children = {}      # pid -> (worker id, started at)
+        self.delays = {}        # worker id -> current restart delay
+        self.pending = {}       # worker id -> restart at
+        self.restarts = 0
+        self.stopping = False
+        self.reloads = []       # worker ids waiting for reload
+        self.retiring = set()   # pids of workers being replaced
+
+    def start(self):
+        for name in glob.glob(os.path.join(settings.DIRECTORY_PATH,
+                                           server.STATS_DIR, '*.json')):
+            os.remove(name)
+        signal.signal(signal.SIGTERM, self.on_stop)
+        signal.signal(signal.SIGINT, self.on_stop)
+        signal.signal(signal.SIGUSR1, self.on_stats)
+        signal.signal(signal.SIGUSR2, self.on_profile)
+        signal.signal(signal.SIGHUP, self.on_reload)
+        for worker_id in range(self.workers):
+            self.spawn(worker_id)
+        gen_log.info("Supervisor %d started %d workers on port %d",
+                     os.getpid(), self.workers, self.port)
+        self.supervise()
+
+    def spawn(self, worker_id, takeover=False):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                if takeover:
+                    self.exec_worker(worker_id)
+                else:
+                    self.run_worker(worker_id)
+            except Exception as e:
+                gen_log.exception(e)
+                code = 1
+            finally:
+                # os._exit skips atexit, queued records are written here
+                stop_queue_logging()
+                os._exit(code)
+        self.children[pid] = (worker_id, time.time())
+
+    def prepare_worker(self, worker_id):
+        # the supervisor handles ctrl-c, stats and reload requests, the
+        # server sets its own profiling handler
+        for signum in (signal.SIGINT, signal.SIGUSR1, signal.SIGUSR2,
+                       signal.SIGHUP):
+            signal.signal(signum, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        if self.cpu_affinity:
+            pin_to_cpu(worker_id % multiprocessing.cpu_count())
+        settings.SPOOL_DIR = os.path.join(settings.SPOOL_DIR,
+                                          'worker-%d' % worker_id)
+
+    def run_worker(self, worker_id):
+        self.prepare_worker(worker_id)
+        sock = server.bind_reuseport(self.port, self.address, self.backlog)
+        server.run(self.port, worker_id=worker_id, sockets=[sock])
+
+    def exec_worker(self, worker_id):
+        r"""Starts worker from scratch, so a reload picks up new code."""
+        self.prepare_worker(worker_id)
+        os.environ['SPOOL_DIR'] = settings.SPOOL_DIR
+        os.execv(sys.executable, [sys.executable, SERVER_SCRIPT,
+                                  '--port', str(self.port),
+                                  '--worker-id', str(worker_id),
+                                  '--takeover'])
+
+    def supervise(self):
+        while self.children or self.pending:
+            self.spawn_due()
+            if self.reloads and not self.retiring:
+                self.reload_next()
+            try:
+                if self.pending:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                    if not pid:
+                        time.sleep(0.1)
+                        continue
+                else:
+                    pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD and self.pending:
+                    time.sleep(0.1)
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            self.reap(pid, status)
+        gen_log.info("Supervisor %d stopped", os.getpid())
+
+    def reap(self, pid, status):
+        if pid not in self.children:
+            return
+        worker_id, started = self.children.pop(pid)
+        if pid not in self.retiring:
+            try:
+                os.remove(server.stats_path(settings.DIRECTORY_PATH,
+                                            worker_id))
+            except OSError:
+                pass
+        if self.stopping:
+            return
+        if pid in self.retiring:
+            self.retiring.discard(pid)
+            gen_log.info("Worker %d (pid %d) is replaced", worker_id, pid)
+            return
+        if os.WIFSIGNALED(status):
+            reason = "killed by signal %d" % os.WTERMSIG(status)
+        else:
+            reason = "exited with %d" % os.WEXITSTATUS(status)
+        if time.time() - started < MIN_UPTIME:
+            delay = min(self.delays.get(worker_id, self.restart_delay / 2) * 2,
+                        self.max_restart_delay)
+        else:
+            delay = self.restart_delay
+        self.delays[worker_id] = delay
+        self.pending[worker_id] = time.time() + delay
+        gen_log.warning("Worker %d (pid %d) %s, restarting in %.1fs",
+                        worker_id, pid, reason, delay)
+
+    def spawn_due(self):
+        now = time.time()
+        for worker_id, due in self.pending.items():
+            if due <= now and not self.stopping:
+                del self.pending[worker_id]
+                self.restarts += 1
+                # replacement crashed, its successor finishes the reload
+                takeover = any(self.children[pid][0] == worker_id
+                               for pid in self.retiring)
+                self.spawn(worker_id, takeover=takeover)
+
+    def reload_next(self):
+        worker_id = self.reloads.pop(0)
+        for pid, (child_id, started) in self.children.items():
+            if child_id == worker_id:
+                self.retiring.add(pid)
+                break
+        else:
+            # crashed meanwhile, restart handles it
+            return
+        gen_log.info("Reloading worker %d", worker_id)
+        self.spawn(worker_id, takeover=True)
+
+    def on_reload(self, signum, stack):
+        if not self.stopping:
+            self.reloads = range(self.workers)
+
+    def on_stop(self, signum, stack):
+        self.stopping = True
+        self.reloads = []
+        self.pending.clear()
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def on_profile(self, signum, stack):
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGUSR2)
+            except OSError:
+                pass
+
+    def on_stats(self, signum, stack):
+        stats = aggregate_stats()
+        gen_log.info("STATS: workers %d, restarts %d, %s", stats['workers'],
+                     self.restarts, json.dumps(stats['total'], sort_keys=True))
+
+
+if __name__ == '__main__':
+    # python launcher.py         - runs the workers
+    # python launcher.py stats   - prints aggregated stats of running workers
+    if sys.argv[1:] == ['stats']:
+        print json.dumps(aggregate_stats(), indent=2, sort_keys=True)
+    else:
+        Supervisor(int(os.getenv('VCAP_APP_PORT', 9002)),
+                   workers=settings.WORKERS,
+                   backlog=settings.LISTEN_BACKLOG,
+                   cpu_affinity=settings.CPU_AFFINITY).start()
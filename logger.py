@@ -1,4 +1,12 @@
+import sys
+import time
+import json
+import atexit
 import logging
+import threading
+from collections import deque
+
+from settings import settings
 
 # gen logger
 app_logger = logging.getLogger('mobiliuz.queclink')
@@ -27,7 +35,290 @@ monitor_logger.addHandler(gen_consoleh)
 monitor_logger.propagate = False
 
 
-
 app_log = app_logger
 gen_log = gen_logger
 monitor_log = monitor_logger
+
+# categories of messages logged for every frame
+FRAME_CATEGORIES = (INCOMING, SACK, ACK, PUBLISHED) = (
+    'incoming', 'sack', 'ack', 'published')
+# command channel requests handled by `FrameLog`
+LOG_OPS = ('log_debug', 'log_sampling', 'log_status')
+# renders tracebacks of queued records
+exc_formatter = logging.Formatter()
+
+
+class QueueHandler(logging.Handler):
+
+    r"""Puts records to the queue of `QueueWriter` thread and returns at
+    once, the record is formatted and written by the thread. The message
+    is rendered before, arguments may change once the caller returns.
+    Records over `maxsize` queued ones are dropped and counted."""
+
+    def __init__(self, writer, maxsize):
+        logging.Handler.__init__(self)
+        self.writer = writer
+        self.maxsize = maxsize
+        self.dropped = 0
+
+    def createLock(self):
+        # deque is thread safe, the handler needs no lock of its own
+        self.lock = None
+
+    def emit(self, record):
+        if len(self.writer.queue) >= self.maxsize:
+            self.dropped += 1
+            return
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                # traceback holds frames of the caller, render it right away
+                record.exc_text = exc_formatter.formatException(
+                    record.exc_info)
+                record.exc_info = None
+        except Exception:
+            self.handleError(record)
+            return
+        self.writer.put(record)
+
+
+class QueueWriter(threading.Thread):
+
+    r"""Passes queued records to the handlers of the logger that made
+    them. Appending to deque takes no lock, the thread is woken up only
+    when it sleeps on the empty queue. `stop` waits until everything
+    queued before it is written."""
+
+    def __init__(self, handlers, poll_interval=0.5):
+        super(QueueWriter, self).__init__(name='log-writer')
+        self.daemon = True
+        self.handlers = handlers    # logger name -> handlers
+        self.poll_interval = poll_interval
+        self.queue = deque()
+        self.sleeping = False
+        self.stopped = False
+        self.wakeup = threading.Event()
+        self.written = 0
+
+    def put(self, record):
+        self.queue.append(record)
+        if self.sleeping:
+            self.wakeup.set()
+
+    def run(self):
+        queue = self.queue
+        while True:
+            while queue:
+                self.write(queue.popleft())
+            if self.stopped:
+                break
+            self.sleeping = True
+            if not queue:
+                self.wakeup.wait(self.poll_interval)
+            self.sleeping = False
+            self.wakeup.clear()
+
+    def write(self, record):
+        for handler in self.handlers.get(record.name, ()):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+        self.written += 1
+
+    def stop(self, timeout=None):
+        self.stopped = True
+        self.wakeup.set()
+        self.join(timeout)
+
+
+_queue_handler = None
+
+
+def start_queue_logging(maxsize=None):
+    r"""Moves handlers of the queclink loggers to the writer thread, the
+    loggers get `QueueHandler` instead. Call it in the process that logs,
+    after fork."""
+    global _queue_handler
+    if _queue_handler is not None:
+        return
+    handlers = {}
+    for logger in (app_logger, gen_logger, monitor_logger):
+        handlers[logger.name] = logger.handlers[:]
+    writer = QueueWriter(handlers)
+    handler = QueueHandler(writer, maxsize or settings.LOG_QUEUE_SIZE)
+    for logger in (app_logger, gen_logger, monitor_logger):
+        for h in handlers[logger.name]:
+            logger.removeHandler(h)
+        logger.addHandler(handler)
+    # formatters here do not use caller info, do not walk the stack for it
+    logging._srcfile = None
+    _queue_handler = handler
+    writer.start()
+    atexit.register(stop_queue_logging)
+
+
+def stop_queue_logging(timeout=5):
+    r"""Writes queued records and gives the handlers back to loggers."""
+    global _queue_handler
+    if _queue_handler is None:
+        return
+    handler, _queue_handler = _queue_handler, None
+    for logger in (app_logger, gen_logger, monitor_logger):
+        logger.removeHandler(handler)
+        for h in handler.writer.handlers[logger.name]:
+            logger.addHandler(h)
+    handler.writer.stop(timeout)
+
+
+def queue_stats():
+    if _queue_handler is None:
+        return {}
+    return {'queued': len(_queue_handler.writer.queue),
+            'written': _queue_handler.writer.written,
+            'dropped': _queue_handler.dropped}
+
+
+def parse_sampling(spec):
+    r"""Sampling of a category:
+        all - every message
+        off - none
+        1/N - every N-th message
+        N/s - at most N messages per second
+    Returns (every, rate), `every` is 0 for none, `rate` None for no
+    limit."""
+    spec = spec.strip()
+    if spec == 'all':
+        return 1, None
+    if spec == 'off':
+        return 0, None
+    count, unit = spec.split('/', 1)
+    if unit == 's':
+        return 1, int(count)
+    if count != '1':
+        raise ValueError("Bad sampling %s" % spec)
+    return max(int(unit), 1), None
+
+
+class Sampler(object):
+
+    r"""Decides whether the next message of a category is logged."""
+
+    __slots__ = ('spec', 'every', 'rate', 'count', 'window', 'in_window',
+                 'logged', 'suppressed')
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.every, self.rate = parse_sampling(spec)
+        self.count = 0
+        self.window = 0     # second the rate is counted in
+        self.in_window = 0
+        self.logged = 0
+        self.suppressed = 0
+
+    def allow(self):
+        self.count += 1
+        if not self.every or self.count % self.every:
+            self.suppressed += 1
+            return False
+        if self.rate is not None:
+            now = int(time.time())
+            if now != self.window:
+                self.window, self.in_window = now, 0
+            if self.in_window >= self.rate:
+                self.suppressed += 1
+                return False
+            self.in_window += 1
+        self.logged += 1
+        return True
+
+    def stats(self):
+        return {'sampling': self.spec,
+                'logged': self.logged,
+                'suppressed': self.suppressed}
+
+
+class FrameLog(object):
+
+    r"""Messages logged for every frame. Each category is sampled on its
+    own, before the record is made, so a suppressed message costs a
+    counter. Devices switched to debug get all their messages.
+    Lives on the IOLoop thread only."""
+
+    def __init__(self, logger, sampling=''):
+        self.logger = logger
+        self.samplers = dict((category, Sampler('all'))
+                             for category in FRAME_CATEGORIES)
+        for item in filter(None, sampling.split(',')):
+            category, spec = item.split('=', 1)
+            self.set_sampling(category.strip(), spec)
+        self.debug_imeis = set()
+
+    def set_sampling(self, category, spec):
+        if category not in self.samplers:
+            raise ValueError("Unknown category %s" % category)
+        self.samplers[category] = Sampler(spec)
+
+    def enable_debug(self, imei):
+        self.debug_imeis.add(imei)
+
+    def disable_debug(self, imei):
+        self.debug_imeis.discard(imei)
+
+    def wanted(self, category, imei=None):
+        r"""Whether to log the message, to be called once per message.
+        Lets the caller skip building arguments that are costly."""
+        if imei in self.debug_imeis:
+            return True
+        return self.samplers[category].allow()
+
+    def info(self, category, imei, msg, *args):
+        if self.wanted(category, imei):
+            self.logger.info(msg, *args)
+
+    def handle(self, request):
+        r"""Requests of the command channel:
+            {"op": "log_debug", "imei": "...", "enable": true}
+            {"op": "log_sampling", "category": "incoming", "sampling": "1/100"}
+            {"op": "log_status"}
+        """
+        op = request['op']
+        if op == 'log_debug':
+            imei = str(request['imei'])
+            if request.get('enable', True):
+                self.enable_debug(imei)
+            else:
+                self.disable_debug(imei)
+        elif op == 'log_sampling':
+            self.set_sampling(str(request['category']),
+                              str(request['sampling']))
+        elif op != 'log_status':
+            raise ValueError("Unknown operation %s" % op)
+        return self.stats()
+
+    def stats(self):
+        return {'debug': sorted(self.debug_imeis),
+                'categories': dict((category, sampler.stats())
+                                   for category, sampler
+                                   in self.samplers.iteritems()),
+                'queue': queue_stats()}
+
+
+frame_log = FrameLog(gen_logger, settings.LOG_SAMPLING)
+
+
+if __name__ == '__main__':
+    # python logger.py debug <IMEI> [on|off]
+    # python logger.py sampling <category> <all|off|1/N|N/s>
+    # python logger.py status
+    from fleet import broadcast
+    if sys.argv[1] == 'debug':
+        request = {'op': 'log_debug', 'imei': sys.argv[2],
+                   'enable': sys.argv[3:4] != ['off']}
+    elif sys.argv[1] == 'sampling':
+        request = {'op': 'log_sampling', 'category': sys.argv[2],
+                   'sampling': sys.argv[3]}
+    elif sys.argv[1] == 'status':
+        request = {'op': 'log_status'}
+    else:
+        sys.exit("Unknown operation %s" % sys.argv[1])
+    print json.dumps(broadcast(request), indent=2)
@@ -0,0 +1,186 @@
+r"""Memory of idle sessions.
+
+A server runs in its own process with sinks left out. Clients open the
+sessions, each sends one report, answers the VER request and stays
+silent:
+
+    python memory_bench.py [--sessions 5000] [--transport tornado callback]
+                           [--reconcile]
+
+Reported per session: RSS growth of the server process and Python heap
+of objects created for the sessions (sizes of new objects found by gc
+and the untracked objects they hold), with the largest types and the
+projection for 100k sessions."""
+import gc
+import sys
+import socket
+import logging
+import shutil
+import argparse
+import resource
+import tempfile
+import multiprocessing
+from collections import defaultdict
+
+from tornado import gen, ioloop
+
+from settings import settings
+from transport import TRANSPORTS
+from transport_bench import FRI, rss, imei
+
+RTO_ACK = '+ACK:GTRTO,1F0106,%s,gv500,VER,%s,20090214093254,0001$'
+VER = '+RESP:GTVER,1F0106,%s,,gv500,A1,0102,0201,20090214093254,0002$'
+PROJECTED_SESSIONS = 100000
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def heap_snapshot():
+    gc.collect()
+    return set(id(obj) for obj in gc.get_objects())
+
+
+def new_objects(baseline):
+    r"""Objects created since `baseline` snapshot."""
+    gc.collect()
+    seen = set(baseline)
+    seen.update((id(baseline), id(seen)))
+    objects = []
+    for obj in gc.get_objects():
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        objects.append(obj)
+        for ref in gc.get_referents(obj):
+            if not gc.is_tracked(ref) and id(ref) not in seen:
+                seen.add(id(ref))
+                objects.append(ref)
+    return objects
+
+
+def heap_usage(objects):
+    r"""Returns (total bytes, {type name: bytes})."""
+    by_type = defaultdict(int)
+    for obj in objects:
+        by_type[type(obj).__name__] += sys.getsizeof(obj)
+    return sum(by_type.itervalues()), by_type
+
+
+def read_command(sock):
+    data = ''
+    while not data.endswith('$'):
+        chunk = sock.recv(256)
+        if not chunk:
+            raise IOError("Server closed the connection")
+        data += chunk
+    return data
+
+
+def open_session(port, unique_id):
+    r"""Connects as a device that has just been powered on."""
+    sock = socket.create_connection(('127.0.0.1', port))
+    sock.sendall(FRI % (unique_id, 0))
+    serial = read_command(sock).rstrip('$').rsplit(',', 1)[-1]
+    sock.sendall(RTO_ACK % (unique_id, serial) + VER % unique_id)
+    return sock
+
+
+def serve(transport, control, reconcile):
+    r"""Server process. Sends its port, waits for the number of sessions,
+    sends (RSS bytes, heap bytes, {type: heap bytes}, cached config
+    records) they take."""
+    raise_fd_limit()
+    settings.CONFIG_RECONCILE = reconcile
+    if reconcile:
+        settings.CONFIG_STORE_PATH = tempfile.mkdtemp()
+    from conn import QueclinkConnection
+    from server import QueclinkServer
+    from configstore import ConfigStore
+
+    class IdleConnection(QueclinkConnection):
+
+        @gen.coroutine
+        def on_report(self, original_msg, response, sack, from_buffer=False):
+            pass
+
+    io_loop = ioloop.IOLoop.instance()
+    server = QueclinkServer(io_loop=io_loop, port=0, transport=transport,
+                            conn=IdleConnection)
+    server.listen(0, '127.0.0.1', backlog=4096)
+    control.send(server._sockets.values()[0].getsockname()[1])
+
+    @gen.coroutine
+    def main():
+        count = control.recv()
+        base_rss, baseline = rss(), heap_snapshot()
+        while len(server.dongles) < count:
+            yield gen.Task(io_loop.add_timeout, io_loop.time() + 0.05)
+        yield gen.Task(io_loop.add_timeout, io_loop.time() + 0.5)
+        objects = new_objects(baseline)
+        total, by_type = heap_usage(objects)
+        del objects
+        control.send((rss() - base_rss, total, dict(by_type),
+                      len(ConfigStore.instance().records) if reconcile
+                      else 0))
+
+    io_loop.run_sync(main)
+    if reconcile:
+        ConfigStore.shutdown()
+        shutil.rmtree(settings.CONFIG_STORE_PATH)
+
+
+def bench(transport, sessions, reconcile=False):
+    control, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve,
+                                     args=(transport, child, reconcile))
+    server.start()
+    port = control.recv()
+    control.send(sessions)
+    clients = [open_session(port, imei(n)) for n in xrange(sessions)]
+    result = control.recv()
+    for sock in clients:
+        sock.close()
+    server.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sessions', type=int, default=5000)
+    parser.add_argument('--transport', nargs='+', choices=TRANSPORTS,
+                        default=list(TRANSPORTS))
+    parser.add_argument('--top', type=int, default=8,
+                        help="largest types of the heap to show")
+    parser.add_argument('--reconcile', action='store_true',
+                        help="reconcile device configuration on connect")
+    args = parser.parse_args()
+    limit = raise_fd_limit()
+    if args.sessions * 2 + 64 > limit:
+        sys.exit("Open files limit %d is too low for %d sessions" % (
+            limit, args.sessions))
+    logging.disable(logging.INFO)
+    for transport in args.transport:
+        rss_bytes, heap_bytes, by_type, records = bench(
+            transport, args.sessions, args.reconcile)
+        print '%s: %d sessions' % (transport, args.sessions)
+        print '  RSS/session   %8d bytes, %6d MB per %dk' % (
+            rss_bytes / args.sessions,
+            rss_bytes * PROJECTED_SESSIONS / args.sessions / 2 ** 20,
+            PROJECTED_SESSIONS / 1000)
+        print '  heap/session  %8d bytes, %6d MB per %dk' % (
+            heap_bytes / args.sessions,
+            heap_bytes * PROJECTED_SESSIONS / args.sessions / 2 ** 20,
+            PROJECTED_SESSIONS / 1000)
+        top = sorted(by_type.iteritems(), key=lambda item: -item[1])
+        for name, size in top[:args.top]:
+            print '    %-28s %8d bytes' % (name, size / args.sessions)
+        if args.reconcile:
+            print '  config records cached %d' % records
+
+
+if __name__ == '__main__':
+    sys.exit(main())
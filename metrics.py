@@ -0,0 +1,267 @@
+import re
+import bisect
+import functools
+
+from tornado.httpserver import HTTPServer
+
+__all__ = ['Histogram', 'Counter', 'Family', 'Registry', 'MetricsServer',
+           'log_buckets', 'exposition']
+
+# seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+# prefix of metric names in the exposition
+NAMESPACE = 'queclink'
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+def log_buckets(lowest, highest, per_octave=2):
+    r"""Log-linear bucket bounds in the way of HDR histogram: every power
+    of two from `lowest` up to `highest` is split into `per_octave` equal
+    steps, so the error of a value is within 1/per_octave of it whatever
+    its magnitude."""
+    bounds = []
+    base = float(lowest)
+    while base < highest:
+        step = base / per_octave
+        bounds.extend(base + step * i for i in range(per_octave))
+        base *= 2
+    bounds.append(base)
+    return tuple(bounds)
+
+
+# seconds, 10us to ~10s
+STAGE_BUCKETS = log_buckets(1e-5, 10)
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n')
+
+
+def format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value))
+                             for name, value in pairs)
+
+
+class Histogram(object):
+
+    r"""Counts of observed values per bucket. Bucket `b` counts values
+    above the previous bound and up to `b`, `+Inf` the rest. Stats are
+    plain numbers, so the launcher sums histograms of the workers.
+    Sink threads observe without a lock, a rare lost count is fine."""
+
+    __slots__ = ('name', 'doc', 'bounds', 'counts', 'count', 'total',
+                 'max_value')
+
+    kind = 'histogram'
+
+    def __init__(self, name, doc='', buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.bounds = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max_value = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max_value:
+            self.max_value = value
+
+    def stats(self):
+        buckets = dict(('%g' % bound, count) for bound, count
+                       in zip(self.bounds, self.counts))
+        buckets['+Inf'] = self.counts[-1]
+        return {'count': self.count,
+                'sum': self.total,
+                'max_value': self.max_value,
+                'buckets': buckets}
+
+    def samples(self, name, labels=()):
+        r"""Lines of Prometheus text format, buckets are cumulative."""
+        lines, cumulative = [], 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (
+                name, format_labels(labels + (('le', '%g' % bound),)),
+                cumulative))
+        cumulative += self.counts[-1]
+        lines.append('%s_bucket%s %d' % (
+            name, format_labels(labels + (('le', '+Inf'),)), cumulative))
+        lines.append('%s_sum%s %r' % (name, format_labels(labels),
+                                      self.total))
+        lines.append('%s_count%s %d' % (name, format_labels(labels),
+                                        cumulative))
+        return lines
+
+
+class Counter(object):
+
+    r"""Monotonic count of events."""
+
+    __slots__ = ('name', 'doc', 'value')
+
+    kind = 'counter'
+
+    def __init__(self, name, doc=''):
+        self.name = name
+        self.doc = doc
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def stats(self):
+        return self.value
+
+    def samples(self, name, labels=()):
+        return ['%s%s %r' % (name, format_labels(labels), self.value)]
+
+
+class Family(object):
+
+    r"""Metrics of one name told apart by values of `labels`. Hot paths
+    keep nothing but a tuple lookup:
+
+        family.labels('parse', 'GTFRI').observe(seconds)
+    """
+
+    def __init__(self, name, doc, labels, factory):
+        self.name = name
+        self.doc = doc
+        self.label_names = tuple(labels)
+        self.factory = factory
+        self.children = {}      # label values -> metric
+        self.kind = factory().kind
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError("%s takes labels %s" % (
+                    self.name, ', '.join(self.label_names)))
+            child = self.children[values] = self.factory()
+        return child
+
+    def stats(self):
+        return dict((','.join(values), child.stats())
+                    for values, child in self.children.items())
+
+    def samples(self, name, labels=()):
+        lines = []
+        for values, child in sorted(self.children.items()):
+            lines.extend(child.samples(
+                name, labels + tuple(zip(self.label_names, values))))
+        return lines
+
+
+class Registry(object):
+
+    r"""Metrics of the process by name."""
+
+    def __init__(self):
+        self.metrics = {}
+
+    @classmethod
+    def instance(cls):
+        """Singleton like accessor to instantiate metrics registry"""
+        if not hasattr(cls, "_instance"):
+            cls._instance = cls()
+        return cls._instance
+
+    def get(self, name, factory):
+        if name not in self.metrics:
+            self.metrics[name] = factory()
+        return self.metrics[name]
+
+    def histogram(self, name, doc='', buckets=LATENCY_BUCKETS, labels=()):
+        r"""Histogram of `name`, `Family` of them if `labels` are given."""
+        factory = functools.partial(Histogram, name, doc, buckets)
+        if labels:
+            return self.get(name, lambda: Family(name, doc, labels, factory))
+        return self.get(name, factory)
+
+    def counter(self, name, doc='', labels=()):
+        r"""Counter of `name`, `Family` of them if `labels` are given."""
+        factory = functools.partial(Counter, name, doc)
+        if labels:
+            return self.get(name, lambda: Family(name, doc, labels, factory))
+        return self.get(name, factory)
+
+    def stats(self):
+        return dict((name, metric.stats())
+                    for name, metric in self.metrics.items())
+
+    def samples(self, labels=()):
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            name = '%s_%s' % (NAMESPACE, name)
+            lines.append('# HELP %s %s' % (name, metric.doc or name))
+            lines.append('# TYPE %s %s' % (name, metric.kind))
+            lines.extend(metric.samples(name, labels))
+        return lines
+
+
+def flatten(stats, prefix):
+    r"""Numeric leaves of nested `stats` as (name, value) pairs."""
+    pairs = []
+    for key, value in sorted(stats.items()):
+        name = '%s_%s' % (prefix, re.sub(r'[^a-zA-Z0-9_]', '_', str(key)))
+        if isinstance(value, dict):
+            pairs.extend(flatten(value, name))
+        elif isinstance(value, (int, long, float)):
+            pairs.append((name, float(value)))
+    return pairs
+
+
+def exposition(registry, labels=(), gauges=None):
+    r"""Prometheus text format of `registry` and of numeric leaves of
+    `gauges` dict, every sample gets constant `labels` pairs."""
+    lines = registry.samples(labels)
+    for name, value in flatten(gauges or {}, NAMESPACE):
+        lines.append('%s%s %r' % (name, format_labels(labels), value))
+    lines.append('')
+    return '\n'.join(lines)
+
+
+class MetricsServer(HTTPServer):
+
+    r"""Serves metrics of the process at any path. `gauges` is a callable
+    returning stats dict to export along with the registry."""
+
+    def __init__(self, gauges=None, labels=(), registry=None, io_loop=None):
+        super(MetricsServer, self).__init__(self.handle_request,
+                                            io_loop=io_loop)
+        self.gauges = gauges
+        self.const_labels = tuple(labels)
+        self.registry = registry or Registry.instance()
+        self.scrapes = 0
+
+    def handle_request(self, request):
+        self.scrapes += 1
+        body = exposition(self.registry, self.const_labels,
+                          self.gauges() if self.gauges else None)
+        request.write('HTTP/1.1 200 OK\r\nContent-Type: %s\r\n'
+                      'Content-Length: %d\r\n\r\n%s' % (
+                          CONTENT_TYPE, len(body), body))
+        request.finish()
+
+
+registry = Registry.instance()
+# frame pipeline, `header` is report or ack type of the frame, or ''
+STAGE_SECONDS = registry.histogram(
+    'stage_seconds', 'Seconds spent in a stage of the frame pipeline',
+    STAGE_BUCKETS, labels=('stage', 'header'))
+FRAMES = registry.counter('frames_total', 'Frames parsed',
+                          labels=('header',))
+FILTERED = registry.counter(
+    'frames_filtered_total', 'Reports dropped for bad GPS accuracy',
+    labels=('header',))
+RECEIVED_BYTES = registry.counter('received_bytes_total',
+                                  'Bytes read from devices')
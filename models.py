@@ -5,6 +5,7 @@ import sqlalchemy as sa
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from encoder import AlchemyEncoder
+from logger import gen_log
 from settings import settings
 
 __author__ = 'denself'
@@ -15,10 +16,22 @@ Base.json = lambda self: json.dumps(self, cls=AlchemyEncoder)
 
 
 class Backend(object):
-    def __init__(self):
-        engine = sa.create_engine(settings.DB_URL, pool_recycle=3600)
+    def __init__(self, db_url=None):
+        engine = sa.create_engine(db_url or settings.DB_URL,
+                                  pool_recycle=3600)
+        self.engine = engine
         self._session = sessionmaker(bind=engine)
-        Base.metadata.create_all(bind=engine)
+        self.tables_created = False
+        try:
+            self.create_tables()
+        except (sa.exc.OperationalError, sa.exc.InterfaceError) as e:
+            # the worker starts anyway, reports are spooled meanwhile
+            gen_log.warning("database is not available %s", e)
+
+    def create_tables(self):
+        if not self.tables_created:
+            Base.metadata.create_all(bind=self.engine)
+            self.tables_created = True
 
     @classmethod
     def instance(cls):
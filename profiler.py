@@ -0,0 +1,210 @@
+import os
+import sys
+import json
+import time
+import signal
+import cProfile
+from collections import defaultdict
+
+from tornado import ioloop
+
+from settings import settings
+from logger import gen_log
+
+__all__ = ['Profiler', 'PROFILE_OPS']
+
+MODES = (SAMPLE, PSTATS) = ('sample', 'pstats')
+# command channel requests handled by `Profiler`
+PROFILE_OPS = ('profile_start', 'profile_stop', 'profile_status')
+# frames of the pipeline, their locals tell the frame and the session
+TAGGED_FRAMES = ('terminal_message_flow', 'ordered_message_flow',
+                 'prepare_message', 'emit_message', 'on_report', 'on_ack')
+UNTAGGED = 'other'
+
+
+def frame_tags(frame):
+    r"""(report header, session key) of the pipeline method `frame`."""
+    local = frame.f_locals
+    msg = local.get('msg') or local.get('original_msg')
+    header = msg.split(',', 1)[0] if isinstance(msg, str) else None
+    return header, getattr(local.get('self'), 'session_key', None)
+
+
+def code_label(code):
+    return '%s:%s:%d' % (os.path.basename(code.co_filename), code.co_name,
+                         code.co_firstlineno)
+
+
+class Profiler(object):
+
+    r"""Profiles the IOLoop thread of the process on demand.
+
+    `sample` mode takes the stack of the main thread every `interval`
+    seconds of process CPU time from SIGPROF handler. Samples are tagged
+    by the header of the frame being processed and counted per session,
+    the dump is collapsed stacks (for flamegraph.pl or speedscope) with
+    the header as the root frame, and sessions by samples next to it.
+    `pstats` mode runs cProfile, which is exact but slows the thread
+    down several times.
+
+    Nothing is installed while the profiler is off, so it costs nothing.
+    Must be started and stopped on the main thread."""
+
+    def __init__(self, path=None, interval=None, io_loop=None):
+        self.path = path or settings.PROFILE_DIR
+        self.interval = interval or settings.PROFILE_INTERVAL
+        self.io_loop = io_loop or ioloop.IOLoop.current()
+        self.mode = None            # while running
+        self.started = None
+        self.samples = None         # (header, codes) -> count
+        self.sessions = None        # session key -> count
+        self.sampled = 0            # stats must not iterate samples
+        self.cprofile = None
+        self._timeout = None
+        self._handler = None        # SIGPROF handler to restore
+        self.dumps = []
+
+    @classmethod
+    def instance(cls):
+        """Singleton like accessor to instantiate process profiler"""
+        if not hasattr(cls, "_instance"):
+            cls._instance = cls()
+        return cls._instance
+
+    @classmethod
+    def shutdown(cls):
+        if hasattr(cls, "_instance"):
+            cls._instance.stop()
+            del cls._instance
+
+    def is_running(self):
+        return self.mode is not None
+
+    def start(self, seconds=None, mode=SAMPLE):
+        r"""Profiles for `seconds` (PROFILE_SECONDS by default), then
+        writes the dump."""
+        if mode not in MODES:
+            raise ValueError("Unknown profiling mode %s" % mode)
+        if self.is_running():
+            raise RuntimeError("Profiler is already running")
+        seconds = float(seconds or settings.PROFILE_SECONDS)
+        if mode == SAMPLE:
+            self.samples = defaultdict(int)
+            self.sessions = defaultdict(int)
+            self.sampled = 0
+            self._handler = signal.signal(signal.SIGPROF, self.on_sample)
+            # sockets of the loop must not fail with EINTR
+            signal.siginterrupt(signal.SIGPROF, False)
+            signal.setitimer(signal.ITIMER_PROF, self.interval,
+                             self.interval)
+        else:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        self.mode = mode
+        self.started = time.time()
+        self._timeout = self.io_loop.add_timeout(
+            self.io_loop.time() + seconds, self.stop)
+        gen_log.info("PROFILING (%s) for %gs", mode, seconds)
+        return self.stats()
+
+    def stop(self):
+        r"""Stops profiling and writes the dump. Returns its path."""
+        if not self.is_running():
+            return None
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        if self.mode == SAMPLE:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self._handler or signal.SIG_DFL)
+        else:
+            self.cprofile.disable()
+        try:
+            path = self.dump()
+        finally:
+            self.mode = None
+            self.samples = self.sessions = self.cprofile = None
+        gen_log.info("PROFILE written to %s", path)
+        self.dumps.append(path)
+        return path
+
+    def toggle(self):
+        r"""Starts sampling for PROFILE_SECONDS or stops it early."""
+        if self.is_running():
+            self.stop()
+        else:
+            self.start()
+
+    def on_sample(self, signum, frame):
+        codes, header, session = [], None, None
+        while frame is not None:
+            code = frame.f_code
+            codes.append(code)
+            if header is None and code.co_name in TAGGED_FRAMES:
+                header, session = frame_tags(frame)
+            frame = frame.f_back
+        self.samples[header, tuple(codes)] += 1
+        self.sampled += 1
+        if session is not None:
+            self.sessions[session] += 1
+
+    def dump(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        name = os.path.join(self.path, 'profile-%d-%s' % (
+            os.getpid(), time.strftime('%Y%m%d-%H%M%S',
+                                       time.localtime(self.started))))
+        if self.mode == PSTATS:
+            self.cprofile.dump_stats(name + '.pstats')
+            return name + '.pstats'
+        with open(name + '.collapsed', 'w') as f:
+            for (header, codes), count in sorted(self.samples.iteritems(),
+                                                 key=lambda item: -item[1]):
+                stack = [header or UNTAGGED]
+                stack.extend(code_label(code) for code in reversed(codes))
+                f.write('%s %d\n' % (';'.join(stack), count))
+        with open(name + '.sessions', 'w') as f:
+            for session, count in sorted(self.sessions.iteritems(),
+                                         key=lambda item: -item[1]):
+                f.write('%s %d\n' % (session, count))
+        return name + '.collapsed'
+
+    def handle(self, request):
+        r"""Requests of the command channel:
+            {"op": "profile_start", "seconds": 30, "mode": "sample"}
+            {"op": "profile_stop"}
+            {"op": "profile_status"}
+        """
+        op = request['op']
+        if op == 'profile_start':
+            self.start(request.get('seconds'), request.get('mode', SAMPLE))
+        elif op == 'profile_stop':
+            self.stop()
+        elif op != 'profile_status':
+            raise ValueError("Unknown operation %s" % op)
+        return self.stats()
+
+    def stats(self):
+        return {'mode': self.mode,
+                'running_seconds': time.time() - self.started
+                if self.is_running() else 0,
+                'samples': self.sampled,
+                'dumps': self.dumps[-5:]}
+
+
+if __name__ == '__main__':
+    # python profiler.py start [seconds] [sample|pstats]
+    # python profiler.py stop
+    # python profiler.py status
+    from fleet import broadcast
+    if sys.argv[1] == 'start':
+        request = {'op': 'profile_start'}
+        if sys.argv[2:]:
+            request['seconds'] = float(sys.argv[2])
+        if sys.argv[3:]:
+            request['mode'] = sys.argv[3]
+    elif sys.argv[1] in ('stop', 'status'):
+        request = {'op': 'profile_%s' % sys.argv[1]}
+    else:
+        sys.exit("Unknown operation %s" % sys.argv[1])
+    print json.dumps(broadcast(request), indent=2)
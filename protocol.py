@@ -25,6 +25,10 @@ GPS_REPORT_INFO = ('gps_accuracy', 'speed', 'heading', 'altitude',
 
 GSM_REPORT_INFO = ('mcc', 'mnc', 'lac', 'cell_id', rsrvd())
 
+OBDStaticReport = namedtuple('OBDStaticReport', (
+    'protocol_version', 'unique_id', 'gps_vin', 'device_name',
+    'report_type', 'report_mask'))
+
 PROTO_PASSWORD_SCHEMA = qq('gv500',
                            All(Length(4, 6), Match(r'^[0-9a-zA-Z]+$')))
 PROTO_TIME = qq('0000', Length(4))
@@ -32,8 +36,20 @@ PROTO_DATE = All(Match(r'^[\d]+$'), Length(min=14, max=14))
 PROTO_FLAG = lambda deflt: qq(deflt, Match(r'^[01]$'))
 
 
+SERIAL_STUB = '0000'
+
+
+def fill_serial(template, serial_number):
+    r"""Completes command made by `build_cmd_template`, serial number is
+    the last parameter of every command."""
+    return template + serial_number + conf.END_SIGN
+
+
 class CommanderMixin(object):
 
+    # mixins keep no per instance state, sessions use slots
+    __slots__ = ()
+
     PREFIX = conf.COMMAND
 
     GPRS_CFG_RESERVED = [4, 5, 6, 7]
@@ -112,6 +128,16 @@ class CommanderMixin(object):
         ('serial_number', Length(4))
     ]))
 
+    CMD_LAYOUTS = {
+        conf.GPRS_CONFIG_CMD: (GPRS_CFG_CMD_SCHEMA, GPRS_CFG_RESERVED),
+        conf.COMMUN_CONFIG_CMD: (COMMUN_CFG_CMD_SCHEMA, COMMUN_CFG_RESERVED),
+        conf.FIXED_REPORT_CMD: (FIXED_REPORT_CFG_SCHEMA,
+                                FIXED_REPORT_CFG_RESERVED),
+        conf.OBD_REPORT_CMD: (OBD_REPORT_CFG_SCHEMA, OBD_REPORT_CFG_RESERVED),
+        conf.TIME_ADJST_CMD: (TIME_ADJ_CFG_SCHEMA, TIME_ADJ_CFG_RESERVED),
+        conf.RTO_CMD: (RTO_CFG_SCHEMA, RTO_CFG_RESERVED),
+    }
+
     def build_cmd(self, cmd, **kv):
         kv = self.serialize_params(kv)
         if not cmd in conf.COMMANDS:
@@ -124,6 +150,42 @@ class CommanderMixin(object):
         params = cmder(**kv)
         return self.message_builder(conf.COMMAND, cmd, *params)
 
+    def build_cmd_template(self, cmd, **kv):
+        r"""Validates and serialises command once for many devices.
+        Returns the message without serial number, see `fill_serial`."""
+        kv['serial_number'] = SERIAL_STUB
+        msg = self.build_cmd(cmd, **kv)
+        return msg[:-len(SERIAL_STUB + conf.END_SIGN)]
+
+    def parse_cmd(self, msg):
+        r"""Reverse of `build_cmd`.
+        Returns:
+            (command, {param: value}) without reserved params
+        """
+        if not msg.startswith(conf.COMMAND):
+            raise BadProtocolFormat(conf.UNKNOWN_MESSAGE % msg)
+        cmd, _, paramstring = msg[len(conf.COMMAND):].rstrip(
+            conf.END_SIGN).partition('=')
+        if cmd not in self.CMD_LAYOUTS:
+            raise MessageNotImplemented(
+                "Command is not implemented: %s" % cmd)
+        schema, reserved = self.CMD_LAYOUTS[cmd]
+        values = [value for i, value in enumerate(paramstring.split(','))
+                  if i not in reserved]
+        return cmd, dict(zip(schema.schema.keys(), values))
+
+    def blank_params(self, template, keep):
+        r"""Empties params of command `template` that are not in `keep`,
+        the device keeps its own values of them."""
+        head, _, paramstring = template.partition('=')
+        schema, reserved = self.CMD_LAYOUTS[head[len(conf.COMMAND):]]
+        fields = iter(schema.schema.keys())
+        values = paramstring.split(',')
+        for i in range(len(values)):
+            if i not in reserved and next(fields, None) not in keep:
+                values[i] = ''
+        return head + '=' + ','.join(values)
+
     def build_bsi_params(self, **kv):
         return self.__build_params(self.GPRS_CFG_CMD_SCHEMA,
                                    self.GPRS_CFG_RESERVED,
@@ -150,7 +212,7 @@ class CommanderMixin(object):
                                    kv)
 
     def build_obd_params(self, **kv):
-        if 'obd_report_mask' in kv:
+        if isinstance(kv.get('obd_report_mask'), (list, tuple)):
             mask = kv['obd_report_mask']
             calc_mask = 0
             for cur_mask_item in mask:
@@ -191,6 +253,9 @@ class CommanderMixin(object):
 
 
 class AcknowledgerMixin(object):
+
+    __slots__ = ()
+
     GeneralAck = namedtuple(
         'GeneralAck', (
             'protocol_version', 'unique_id', 'device_name',
@@ -235,13 +300,65 @@ class AcknowledgerMixin(object):
     def ack_fri(self, *params):
         return self.__ack_general(conf.FIXED_REPORT_ACK, *params)
 
+    def ack_obd(self, *params):
+        return self.__ack_general(conf.OBD_CONFIG_ACK, *params)
+
     def __ack_general(self, header, *params):
         ack_msg = self.GeneralAck._make(params)
         return LOG_MESSAGE._make((conf.ACK, header, ack_msg))
 
 
+class OBDLayoutCache(object):
+    r"""Bounded LRU of OBD report record classes.
+
+    Layout of +RESP:GTOBD depends on the report mask only, so the record
+    class is built once per (protocol_version, report_mask, params count)
+    and reused. Params count resolves the reserved field, that some
+    firmwares put before `send_time`, at build time instead of on every
+    message."""
+
+    def __init__(self, maxsize=conf.OBD_LAYOUT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._layouts = OrderedDict()
+
+    def __len__(self):
+        return len(self._layouts)
+
+    def get(self, protocol_version, report_mask, params_cnt):
+        key = (protocol_version, int(report_mask, 16), params_cnt)
+        record = self._layouts.pop(key, None)
+        if record is None:
+            record = self.build(key[1], params_cnt)
+            if len(self._layouts) >= self.maxsize:
+                self._layouts.popitem(last=False)
+        self._layouts[key] = record
+        return record
+
+    def build(self, obd_mask, params_cnt):
+        fields = list(OBDStaticReport._fields)
+        for i, mask_item in enumerate(OBD_REPORT_MASK):
+            if (1 << i) & obd_mask:
+                if mask_item == 'gps':
+                    fields.extend(GPS_REPORT_INFO)
+                elif mask_item == 'gsm':
+                    fields.extend(GSM_REPORT_INFO)
+                else:
+                    fields.append(mask_item)
+        # TODO. temporary hotfix until queclink will answer
+        if params_cnt == len(fields) + 3:
+            fields.append(rsrvd())
+        fields.extend(('send_time', 'count_number'))
+        if params_cnt != len(fields):
+            raise TypeError(
+                "OBD report with mask %X expects %d params, got %d" % (
+                    obd_mask, len(fields), params_cnt))
+        return namedtuple('OBDReport', fields)
+
+
 class ReportProcessor(object):
 
+    __slots__ = ('require_ack', 'cur_mode')
+
     def __init__(self, *a, **kwargs):
         self.require_ack = kwargs.get('require_ack', False)
         self.cur_mode = conf.REPORT
@@ -265,6 +382,9 @@ class ReportProcessor(object):
             rsrvd(), 'mileage', 'hour_meter_count', 'analog_input_vcc', rsrvd(),
             rsrvd(), 'device_status', rsrvd(), rsrvd(), rsrvd(), 'send_time', 'count_number'))
 
+    OBDStaticReport = OBDStaticReport
+    obd_layouts = OBDLayoutCache()
+
     DeviceInformationReport = namedtuple(
         'DeviceInformationReport', (
             'protocol_version', 'unique_id', 'vin', 'device_name',
@@ -338,35 +458,12 @@ class ReportProcessor(object):
         return LOG_MESSAGE._make((self.cur_mode, conf.FIXED_REPORT, report))
 
     def process_obd_report(self, *params):
-        OBDStaticReport = namedtuple('OBDStaticReport', (
-            'protocol_version', 'unique_id', 'gps_vin', 'device_name',
-            'report_type', 'report_mask'))
-
-        obd_rep_len = len(OBDStaticReport._fields)
-        obd_report = OBDStaticReport._make(params[:obd_rep_len])
-        obd_mask = int(obd_report.report_mask, 16)
-        more_fields = []
-        for i in range(0, len(OBD_REPORT_MASK)):
-            if (1 << i) & obd_mask:
-                if OBD_REPORT_MASK[i] == 'gps':
-                    more_fields.extend(GPS_REPORT_INFO)
-                elif OBD_REPORT_MASK[i] == 'gsm':
-                    more_fields.extend(GSM_REPORT_INFO)
-                else:
-                    more_fields.append(OBD_REPORT_MASK[i])
-        # TODO. temporary hotfix until queclink will answer
-        try:
-            more_fields.extend(('send_time', 'count_number'))
-            report = namedtuple('OBDReport',
-                                OBDStaticReport._fields + tuple(more_fields))
-            report = report._make(params)
-        except TypeError:
-            more_fields.pop()
-            more_fields.pop()
-            more_fields.extend((rsrvd(), 'send_time', 'count_number'))
-            report = namedtuple('OBDReport',
-                                OBDStaticReport._fields + tuple(more_fields))
-            report = report._make(params)
+        static_len = len(self.OBDStaticReport._fields)
+        obd_report = self.OBDStaticReport._make(params[:static_len])
+        record = self.obd_layouts.get(obd_report.protocol_version,
+                                      obd_report.report_mask,
+                                      len(params))
+        report = record._make(params)
         return LOG_MESSAGE._make((self.cur_mode, conf.OBD_REPORT, report))
 
     def process_stt_report(self, *params):
@@ -391,10 +488,57 @@ class ReportProcessor(object):
         self.cur_mode = conf.REPORT
 
 
+class FrameSplitter(object):
+    r"""Splits raw stream data into `$`-terminated frames.
+
+    Every chunk read from the socket is fed as is, all complete frames
+    are returned at once and an incomplete tail is carried over to the
+    next chunk. A tail over `max_frame_size` is dropped together with
+    the rest of it up to the next `$`, `overflows` counts such tails."""
+
+    __slots__ = ('max_frame_size', 'overflows', '_tail', '_skipping')
+
+    def __init__(self, max_frame_size=conf.MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.overflows = 0
+        self._tail = ''
+        self._skipping = False
+
+    def feed(self, data):
+        r"""Returns list of complete frames found in data."""
+        if self._skipping:
+            end = data.find(conf.END_SIGN)
+            if end < 0:
+                return []
+            data = data[end + 1:]
+            self._skipping = False
+        if self._tail:
+            data = self._tail + data
+        frames = data.split(conf.END_SIGN)
+        self._tail = frames.pop()
+        if len(self._tail) > self.max_frame_size:
+            self._tail = ''
+            self._skipping = True
+            self.overflows += 1
+        return [frame + conf.END_SIGN for frame in frames]
+
+    @property
+    def pending(self):
+        r"""Number of bytes waiting for the end of the frame."""
+        return len(self._tail)
+
+    def take(self):
+        r"""Returns the incomplete tail and forgets it."""
+        tail, self._tail = self._tail, ''
+        return tail
+
+
 class QueclinkProtocol(CommanderMixin,
                        ReportProcessor,
                        AcknowledgerMixin):
 
+    __slots__ = ()
+
     def __init__(self, *a, **kw):
         super(QueclinkProtocol, self).__init__(*a, **kw)
 
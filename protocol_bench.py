@@ -0,0 +1,285 @@
+r"""Microbenchmarks of the protocol hot path.
+
+Every frame of the corpus goes through `terminal_message_flow` the way
+sessions feed it, OBD reports also through `process_obd_report` alone,
+and every command through `build_cmd`:
+
+    python protocol_bench.py [--match OBD] [--repeat 20] [--min-time 0.02]
+                             [--threshold 0.2] [--save]
+
+Reported per case: ns per frame, refs - the same time in runs of a fixed
+reference workload measured next to the case, and objects per frame -
+containers tracked by gc that the result keeps alive. Only those grow
+the young generation and trigger collections in CPython 2, which has no
+allocation tracer, transient garbage is not counted.
+
+Results are compared with protocol_bench.json, the run fails when refs
+of a case grow by more than `threshold` or it keeps more objects than
+the baseline. `--save` stores the results of the run as the baselines.
+Refs hold across load of the host and mostly across machines, ns are
+of the machine they were taken on."""
+import os
+import gc
+import sys
+import json
+import platform
+import argparse
+import timeit
+from collections import OrderedDict
+
+from protocol import QueclinkProtocol, fill_serial
+from simulator import REPORTS, VER, HEARTBEAT, RTO_ACK, COMMAND_ACK
+from transport_bench import FRI, imei
+import conf
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'protocol_bench.json')
+# objects per frame, a few dict resizes over the run are not a regression
+OBJECTS_SLACK = 0.05
+TIME = '20090214013254'
+FIELDS = {'imei': imei(1), 'time': TIME, 'count': 0x1A, 'type': '+RESP',
+          'sub_cmd': 'VER', 'serial': '0001'}
+# one GPS point of FRI, with the reserved field after cell id
+GPS_POINT = ['1', '4.3', '92', '70.0', '121.354335', '31.222073', TIME,
+             '0460', '0000', '18d8', '6141', '00']
+# OBD report groups by bit of the report mask
+OBD_DATA = ['', '1', '11814', '983A8140', '836', '0', '88', 'Inf', '', '1',
+            '0', '1', '0300', '12', '27', '']
+OBD_GPS = ['0', '0.0', '316', '843.0', '76.862894', '43.226609', TIME]
+OBD_GSM = ['0401', '0001', '08DE', '9707', '00']
+OBD_MILEAGE = ['0.0']
+
+
+def frame(*params):
+    return ','.join(params) + conf.END_SIGN
+
+
+def fri_frame(points, header=conf.REPORT):
+    return frame(header + conf.FIXED_REPORT, '1F0106', imei(1), '', 'gv500',
+                 '0', '0', str(points), *(GPS_POINT * points + [
+                     '2000.0', '12345:12:34', '', '', '80', '210100', '', '',
+                     '', TIME, '001A']))
+
+
+def fri_bicycle_frame(points):
+    return frame(conf.REPORT + conf.FIXED_REPORT, '210501', imei(1),
+                 'gv500', '0', '0', str(points), *(GPS_POINT * points + [
+                     '2000.0', '12345:12:34', '3800', '', '', '210100', '',
+                     '', '', TIME, '001A']))
+
+
+def obd_frame(mask, *groups, **kw):
+    params = ['1F0106', imei(1), '', 'gv500', '0', mask]
+    for group in groups:
+        params.extend(group)
+    # some firmwares put a reserved field before `send_time`
+    params.extend(kw.get('tail', []) + [TIME, '001A'])
+    return frame(conf.REPORT + conf.OBD_REPORT, *params)
+
+
+def obd_params(msg):
+    return msg.rstrip(conf.END_SIGN).split(',')[1:]
+
+
+FRAMES = OrderedDict([
+    ('FRI', fri_frame(1)),
+    ('FRI 4 points', fri_frame(4)),
+    ('FRI buffered', fri_frame(1, header=conf.BUFF)),
+    ('FRI bicycle', fri_bicycle_frame(1)),
+    ('FRI bicycle 4 points', fri_bicycle_frame(4)),
+    ('OBD 70FFFF', obd_frame('70FFFF', OBD_DATA, OBD_GPS, OBD_GSM,
+                             OBD_MILEAGE)),
+    ('OBD 70FFFF reserved', obd_frame('70FFFF', OBD_DATA, OBD_GPS, OBD_GSM,
+                                      OBD_MILEAGE, tail=[''])),
+    ('OBD FFFF', obd_frame('FFFF', OBD_DATA)),
+    ('OBD 700000', obd_frame('700000', OBD_GPS, OBD_GSM, OBD_MILEAGE)),
+    ('OBD 400007', obd_frame('400007', OBD_DATA[:3], OBD_MILEAGE)),
+    ('STT', REPORTS[conf.MOTION_STATE_REPORT] % FIELDS),
+    ('INF', REPORTS[conf.DEVICE_INFORMATION_REPORT] % FIELDS),
+    ('VER', VER % FIELDS),
+    ('ACK HBD', HEARTBEAT % FIELDS),
+    ('ACK RTO', RTO_ACK % FIELDS),
+    ('ACK SRI', COMMAND_ACK % dict(FIELDS, cmd=conf.COMMUN_CONFIG_ACK)),
+    ('ACK FRI', COMMAND_ACK % dict(FIELDS, cmd=conf.FIXED_REPORT_ACK)),
+    ('ACK OBD', COMMAND_ACK % dict(FIELDS, cmd=conf.OBD_CONFIG_ACK)),
+])
+
+COMMANDS = OrderedDict([
+    ('BSI', (conf.GPRS_CONFIG_CMD, {'apn': 'internet', 'apn_user_name': '',
+                                    'apn_password': ''})),
+    ('SRI', (conf.COMMUN_CONFIG_CMD, {
+        'report_mode': conf.TCP_LONG_CONN, 'main_server_ip': '203.0.113.10',
+        'main_server_port': 9000, 'heartbeat_interval': 15,
+        'sack_enable': True, 'protocol_format': conf.ASCII_FORMAT})),
+    ('FRI', (conf.FIXED_REPORT_CMD, {
+        'mode': conf.FIXED_TIMING_REPORT_MODE, 'send_interval': 30})),
+    ('OBD', (conf.OBD_REPORT_CMD, {'obd_report_mask': '70FFFF',
+                                   'obd_report_interval': 60})),
+    ('OBD mask list', (conf.OBD_REPORT_CMD, {
+        'obd_report_mask': ['vin', 'rpm', 'gps', 'gsm', 'mileage']})),
+    ('TMA', (conf.TIME_ADJST_CMD, {'sign': '+', 'hour_offset': 3,
+                                   'utc_time': TIME})),
+    ('RTO', (conf.RTO_CMD, {'sub_cmd': conf.RTO_VER})),
+])
+
+
+# input of `reference`, baselines are void once it changes
+REFERENCE_FRAME = FRI % (imei(1), 0x1A)
+
+
+def cases(protocol):
+    r"""(name, callable, args) of every benchmark."""
+    for name, msg in FRAMES.items():
+        yield 'flow ' + name, protocol.terminal_message_flow, (msg,)
+        if name.startswith(conf.OBD_REPORT):
+            yield ('process ' + name, protocol.process_obd_report,
+                   tuple(obd_params(msg)))
+    yield ('builder SACK report', protocol.message_builder,
+           (conf.SACK, conf.FIXED_REPORT, '001A'))
+    yield ('builder SACK HBD', protocol.message_builder,
+           (conf.SACK, conf.HEARTBEAT_ACK, '1F0106', '001A'))
+    for name, (cmd, kv) in COMMANDS.items():
+        yield ('command ' + name,
+               lambda cmd=cmd, kv=kv: protocol.build_cmd(
+                   cmd, serial_number='0001', **kv), ())
+    cmd, kv = COMMANDS['SRI']
+    template = protocol.build_cmd_template(cmd, **kv)
+    yield 'command SRI template', fill_serial, (template, '0001')
+
+
+def reference():
+    r"""Fixed pure Python work, the unit case times are measured in."""
+    return [field.upper() for field in REFERENCE_FRAME.split(',')]
+
+
+def timer_number(timer, min_time):
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    return number
+
+
+def measure(func, args, repeat, min_time):
+    r"""(ns, refs) per call, medians of `repeat` short runs. Each run of
+    the case follows a run of `reference`, refs is the time of the case in
+    reference runs. Speed of a shared host jumps both ways by tens of
+    percent for seconds at a time, refs stays put while ns follows it."""
+    case = timeit.Timer(lambda: func(*args))
+    ref = timeit.Timer(reference)
+    number = timer_number(case, min_time)
+    ref_number = timer_number(ref, min_time)
+    times, ratios = [], []
+    for _ in range(repeat):
+        ref_time = ref.timeit(ref_number) / ref_number
+        case_time = case.timeit(number) / number
+        times.append(case_time)
+        ratios.append(case_time / ref_time)
+    return median(times) * 1e9, median(ratios)
+
+
+def median(values):
+    return sorted(values)[len(values) // 2]
+
+
+def objects_per_call(func, args, number=1000):
+    r"""Containers tracked by gc that `number` results keep alive, per
+    result. The count of the young generation is net of deallocations."""
+    calls = range(number)
+    results = []
+    gc.collect()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        for _ in calls:
+            results.append(func(*args))
+        after = gc.get_count()[0]
+    finally:
+        gc.enable()
+    return float(after - before) / number
+
+
+def run(args):
+    protocol = QueclinkProtocol()
+    results = OrderedDict()
+    for name, func, call_args in cases(protocol):
+        if args.match and args.match not in name:
+            continue
+        # fails loudly on a broken corpus, warms caches and metric labels
+        func(*call_args)
+        ns, refs = measure(func, call_args, args.repeat, args.min_time)
+        results[name] = {
+            'ns': round(ns, 1),
+            'refs': round(refs, 3),
+            'objects': round(objects_per_call(func, call_args), 2)}
+    return results
+
+
+def compare(results, baseline, threshold):
+    r"""Prints the table, returns names of regressed cases."""
+    regressed = []
+    print '%-30s %10s %8s %8s %8s %8s' % ('case', 'ns/frame', 'refs',
+                                          'objects', 'baseline', 'change')
+    for name, result in results.items():
+        line = '%-30s %10.1f %8.3f %8.2f' % (
+            name, result['ns'], result['refs'], result['objects'])
+        base = baseline.get(name)
+        if base is None:
+            print line, '%8s' % 'new'
+            continue
+        change = result['refs'] / base['refs'] - 1
+        failed = (change > threshold or
+                  result['objects'] > base['objects'] + OBJECTS_SLACK)
+        if failed:
+            regressed.append(name)
+        print line, '%8.3f %+7.1f%%%s' % (base['refs'], change * 100,
+                                          '  REGRESSED' if failed else '')
+    return regressed
+
+
+def environment():
+    return {'python': platform.python_version(),
+            'machine': platform.machine(),
+            'processor': platform.processor()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--match', default=None,
+                        help="run cases with this in the name only")
+    parser.add_argument('--repeat', type=int, default=20,
+                        help="runs per case, the median counts")
+    parser.add_argument('--min-time', type=float, default=0.02,
+                        help="seconds of one run")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="growth of refs against the baseline that fails")
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save', action='store_true',
+                        help="store results as the new baselines")
+    args = parser.parse_args()
+
+    stored = {'cases': {}}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        if stored.get('environment') != environment():
+            print 'Baselines were taken on %s, this is %s' % (
+                stored.get('environment'), environment())
+    results = run(args)
+    regressed = compare(results, stored['cases'], args.threshold)
+
+    if args.save:
+        stored['cases'].update(results)
+        stored['environment'] = environment()
+        with open(args.baseline, 'w') as f:
+            json.dump(stored, f, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+            f.write('\n')
+        print 'Baselines saved to %s' % args.baseline
+    elif regressed:
+        print '%d of %d cases regressed past the baselines' % (
+            len(regressed), len(results))
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,224 @@
+import time
+import Queue
+import threading
+import collections
+
+from metrics import STAGE_SECONDS
+from logger import gen_log
+from settings import settings
+
+__all__ = ['IoTPublisher', 'LocalClient']
+
+
+def iot_client_factory():
+    import ibmiotf.device
+    return ibmiotf.device.Client(settings.IOT_OPTIONS)
+
+
+def event_record(event, msg_format, data):
+    return {'sink': 'iot', 'event': event, 'format': msg_format,
+            'data': data}
+
+
+class LocalClient(object):
+
+    r"""In-process stand-in for `ibmiotf.device.Client`.
+    Keeps published events in memory, can be switched offline to
+    emulate broker outage."""
+
+    events = collections.deque(maxlen=10000)
+    online = True
+
+    def __init__(self, *a, **kw):
+        self.connected = False
+
+    def connect(self):
+        if not self.online:
+            raise IOError("Local broker is offline")
+        self.connected = True
+
+    def disconnect(self):
+        self.connected = False
+
+    def publishEvent(self, event, msg_format, data, qos=0):
+        if not (self.online and self.connected):
+            return False
+        self.events.append((event, msg_format, data))
+        return True
+
+
+class PublisherWorker(threading.Thread):
+
+    r"""Owns one long-lived broker connection and publishes batches taken
+    from the shared outbound queue."""
+
+    def __init__(self, publisher, name):
+        super(PublisherWorker, self).__init__(name=name)
+        self.daemon = True
+        self.publisher = publisher
+        self.client = None
+        self.pending = []
+        self.backoff = 0
+
+    def run(self):
+        publisher = self.publisher
+        while True:
+            if not self.pending:
+                self.pending = publisher.take_batch()
+            if self.pending is None:
+                break
+            if self.pending:
+                self.send_pending()
+        self.disconnect()
+
+    def send_pending(self):
+        try:
+            if self.client is None:
+                self.connect()
+            while self.pending:
+                event, msg_format, data = self.pending[0]
+                started = time.time()
+                if not self.client.publishEvent(event, msg_format, data):
+                    raise IOError("Event %s was not published" % event)
+                STAGE_SECONDS.labels('iot_publish', event).observe(
+                    time.time() - started)
+                self.pending.pop(0)
+                self.publisher.published += 1
+            self.backoff = 0
+        except Exception as e:
+            gen_log.info('failed to publish %s', e)
+            self.disconnect()
+            if self.publisher.stopped.is_set():
+                self.publisher.dropped += len(self.pending)
+                self.pending = []
+                return
+            self.wait_backoff()
+
+    def connect(self):
+        client = self.publisher.client_factory()
+        client.connect()
+        self.client = client
+        self.publisher.connects += 1
+
+    def disconnect(self):
+        client, self.client = self.client, None
+        if client is None:
+            return
+        try:
+            client.disconnect()
+        except Exception as e:
+            gen_log.info('failed to disconnect publisher %s', e)
+
+    def wait_backoff(self):
+        publisher = self.publisher
+        self.backoff = min(max(self.backoff * 2, publisher.min_backoff),
+                           publisher.max_backoff)
+        publisher.stopped.wait(self.backoff)
+
+
+class IoTPublisher(object):
+
+    r"""Process wide publisher to IoT platform.
+
+    Reports are put to bounded outbound queue and never block the caller.
+    Pool of worker threads keeps long-lived connections, takes events
+    from the queue in micro-batches and reconnects with exponential
+    backoff. When the queue is full the oldest event is dropped.
+
+    Note: ibmiotf device client id is derived from device id, so a pool
+    larger than one needs a gateway or application type of client."""
+
+    def __init__(self, client_factory=iot_client_factory,
+                 pool_size=1, max_queue=10000, batch_size=100,
+                 min_backoff=0.5, max_backoff=30):
+        self.client_factory = client_factory
+        self.pool_size = pool_size
+        self.batch_size = batch_size
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.queue = Queue.Queue(maxsize=max_queue)
+        self.stopped = threading.Event()
+        self.workers = []
+        self.published = 0
+        self.dropped = 0
+        self.connects = 0
+
+    @classmethod
+    def instance(cls):
+        """Singleton like accessor to instantiate publisher object"""
+        if not hasattr(cls, "_instance"):
+            client_factory = iot_client_factory
+            if settings.IOT_CLIENT == 'local':
+                client_factory = LocalClient
+            cls._instance = cls(client_factory=client_factory,
+                                pool_size=settings.IOT_POOL_SIZE,
+                                max_queue=settings.IOT_MAX_QUEUE,
+                                batch_size=settings.IOT_BATCH_SIZE)
+            cls._instance.start()
+        return cls._instance
+
+    def start(self):
+        for i in range(self.pool_size):
+            worker = PublisherWorker(self, 'iot-publisher-%d' % i)
+            worker.start()
+            self.workers.append(worker)
+
+    @classmethod
+    def shutdown(cls, timeout=None):
+        if hasattr(cls, "_instance"):
+            cls._instance.stop(timeout)
+
+    def stop(self, timeout=None):
+        r"""Lets workers drain the queue and closes connections."""
+        self.stopped.set()
+        for worker in self.workers:
+            worker.join(timeout)
+        self.workers = []
+
+    def publish(self, event, msg_format, data):
+        r"""Puts event to outbound queue. Returns False if some event
+        had to be dropped to make room for this one."""
+        item = (event, msg_format, data)
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except Queue.Full:
+            pass
+        try:
+            self.queue.get_nowait()
+            self.dropped += 1
+        except Queue.Empty:
+            pass
+        try:
+            self.queue.put_nowait(item)
+        except Queue.Full:
+            self.dropped += 1
+        return False
+
+    def is_full(self):
+        return self.queue.full()
+
+    def take_batch(self):
+        r"""Blocks for the first event and takes up to `batch_size`
+        events that are already queued. Returns None once stopped and
+        drained."""
+        batch = []
+        while not batch:
+            try:
+                batch.append(self.queue.get(timeout=0.5))
+            except Queue.Empty:
+                if self.stopped.is_set():
+                    return None
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    def stats(self):
+        return {'queued': self.queue.qsize(),
+                'published': self.published,
+                'dropped': self.dropped,
+                'connects': self.connects,
+                'connected': sum(1 for w in self.workers if w.client)}
@@ -0,0 +1,489 @@
+r"""Replays traffic recorded by `capture` against a server.
+
+Every connection of the capture gets its own TCP connection to the
+server, opened, fed and closed when the recorded one was, frames of a
+connection are written in the recorded order:
+
+    python replay.py CAPTURE [CAPTURE ...] [--host 127.0.0.1] [--port 9002]
+                     [--speed 1] [--spawn] [--transport tornado]
+                     [--ack-wait 5] [--drain 5] [--server-pid PID ...]
+
+`--speed N` replays N times faster, 0 as fast as possible. With
+`--spawn` the server runs in a child process on a free port with sinks
+left out, as in transport_bench.
+
+The server keeps one session per device and closes the older one, so
+a connection opens with its first frame, once the previous connection
+of the same device is closed.
+
+The server numbers its commands anew, so a command it sends is matched
+to the first recorded command of the connection with the same header,
+and the ack the device sent to it goes out with the new serial number.
+An ack waits for its command up to `ack-wait` seconds. A connection is
+closed once the server sent it as many SACKs as in the capture, or
+after `drain` seconds.
+
+The report gives frames per second written and SACKs per second
+received, server CPU time per frame with `--server-pid` or `--spawn`,
+and divergence of SACKs: per connection the SACKs of the replay are
+compared in order with the recorded ones. Exits with 1 when they
+differ."""
+import sys
+import time
+import heapq
+import socket
+import logging
+import argparse
+import itertools
+import multiprocessing
+from collections import defaultdict, deque
+
+from tornado import ioloop, iostream
+
+from capture import read_capture, INBOUND, OUTBOUND, CLOSE
+from protocol import FrameSplitter
+from memory_bench import raise_fd_limit
+from simulator import cpu_seconds
+from transport import TRANSPORTS
+import conf
+
+# frames read from the captures and not written yet, reading pauses above
+MAX_QUEUED = 100000
+DIVERGENCE_EXAMPLES = 10
+
+
+def keyed(index, path):
+    for record in read_capture(path):
+        yield record.time, index, record
+
+
+def load(paths):
+    r"""Records of the captures merged by time, as (time, connection
+    key, kind, data). Connection key is (capture index, connection id),
+    workers of one server number connections independently."""
+    for stamp, index, record in heapq.merge(*[
+            keyed(index, path) for index, path in enumerate(paths)]):
+        yield stamp, (index, record.conn_id), record.kind, record.data
+
+
+def command_key(frame):
+    r"""(header, serial) of AT+GTRTO=gv500,8,,,,,,0001$"""
+    return (frame[len(conf.COMMAND):len(conf.COMMAND) + 3],
+            frame[:-1].rsplit(',', 1)[-1])
+
+
+def ack_key(frame):
+    r"""(header, serial) of the device ack to a command, None for
+    heartbeats and other frames. Serial number is the third parameter
+    from the end of every command ack."""
+    if not frame.startswith(conf.ACK):
+        return None
+    params = frame[:-1].split(',')
+    header = params[0][len(conf.ACK):]
+    if header == conf.HEARTBEAT_ACK or len(params) < 4:
+        return None
+    return header, params[-3]
+
+
+def take(commands, header):
+    r"""Removes and returns the first command of `header`."""
+    for command in commands:
+        if command[0] == header:
+            commands.remove(command)
+            return command
+    return None
+
+
+def device(frame):
+    r"""IMEI of a device frame, the third parameter of every report and
+    ack. None for frames of other shape."""
+    params = frame.split(',', 3)
+    return params[2] if len(params) > 3 else None
+
+
+def with_serial(frame, serial):
+    params = frame[:-1].split(',')
+    params[-3] = serial
+    return ','.join(params) + conf.END_SIGN
+
+
+class Connection(object):
+
+    r"""Recorded device connection played against the server."""
+
+    def __init__(self, replay, key):
+        self.replay = replay
+        self.io_loop = replay.io_loop
+        self.key = key
+        self.stream = None
+        self.successor = None       # next connection of the device
+        self.splitter = FrameSplitter()
+        self.connected = False
+        self.close_queued = False
+        self.closing = False        # the recorded close is reached
+        self.closed = False
+        self.queue = deque()        # frames to write, None closes
+        self.recorded = []          # SACKs of the capture
+        self.received = []          # SACKs of the replay
+        self.commands = deque()     # recorded (header, serial) not matched
+        self.sent = deque()         # (header, serial) sent by the server now
+        self.serials = {}           # recorded (header, serial) -> new serial
+        self.ack_timer = None
+        self.close_timer = None
+
+    def connect(self):
+        self.stream = iostream.IOStream(socket.socket(),
+                                        io_loop=self.io_loop)
+        self.stream.set_close_callback(self.on_close)
+        self.stream.connect(self.replay.address, self.on_connect)
+
+    def on_connect(self):
+        self.connected = True
+        self.replay.stats['connects'] += 1
+        self.stream.read_until_close(lambda data: None,
+                                     streaming_callback=self.on_data)
+        self.pump()
+
+    def feed(self, kind, data):
+        if self.closed:
+            if kind == INBOUND:
+                self.replay.stats['frames_lost'] += 1
+            return
+        if kind == INBOUND and not self.queue and self.stream is None:
+            self.replay.follow(self, device(data))
+        elif kind == CLOSE and self.stream is None and not self.queue:
+            # no frames, nothing to open
+            self.on_close()
+            return
+        if kind == INBOUND:
+            self.queue.append(data)
+            self.replay.queued += 1
+        elif kind == OUTBOUND:
+            if data.startswith(conf.SACK):
+                self.recorded.append(data)
+            elif data.startswith(conf.COMMAND):
+                recorded = command_key(data)
+                sent = take(self.sent, recorded[0])
+                if sent is None:
+                    self.commands.append(recorded)
+                else:
+                    self.serials[recorded] = sent[1]
+        elif kind == CLOSE and not self.close_queued:
+            self.close_queued = True
+            self.queue.append(None)
+        self.pump()
+
+    def pump(self):
+        if not self.connected or self.closed or self.ack_timer is not None:
+            return
+        while self.queue:
+            frame = self.queue[0]
+            if frame is None:
+                self.queue.popleft()
+                self.start_closing()
+                break
+            key = ack_key(frame)
+            if key is not None and key not in self.serials and \
+                    key in self.commands:
+                # answers a command the server has not sent yet
+                self.ack_timer = self.io_loop.add_timeout(
+                    self.io_loop.time() + self.replay.ack_wait,
+                    self.on_ack_timeout)
+                break
+            self.queue.popleft()
+            self.replay.queued -= 1
+            if key in self.serials:
+                frame = with_serial(frame, self.serials.pop(key))
+                self.replay.stats['acks_rewritten'] += 1
+            self.write(frame)
+        self.replay.on_written()
+
+    def write(self, frame):
+        self.stream.write(frame)
+        self.replay.on_frame()
+
+    def on_ack_timeout(self):
+        self.ack_timer = None
+        key = ack_key(self.queue[0])
+        self.commands.remove(key)
+        self.replay.stats['unmatched_acks'] += 1
+        self.pump()
+
+    def on_data(self, data):
+        for frame in self.splitter.feed(data):
+            if frame.startswith(conf.SACK):
+                self.received.append(frame)
+                self.replay.stats['sacks'] += 1
+                if self.closing and \
+                        len(self.received) >= len(self.recorded):
+                    self.close()
+            elif frame.startswith(conf.COMMAND):
+                self.on_command(frame)
+            else:
+                self.replay.stats['unknown_frames'] += 1
+
+    def on_command(self, frame):
+        self.replay.stats['commands'] += 1
+        sent = command_key(frame)
+        recorded = take(self.commands, sent[0])
+        if recorded is None:
+            # the recorded one may be not due yet
+            self.sent.append(sent)
+            return
+        self.serials[recorded] = sent[1]
+        if self.ack_timer is not None:
+            self.io_loop.remove_timeout(self.ack_timer)
+            self.ack_timer = None
+            self.pump()
+
+    def start_closing(self):
+        self.closing = True
+        if len(self.received) >= len(self.recorded):
+            self.close()
+        else:
+            self.close_timer = self.io_loop.add_timeout(
+                self.io_loop.time() + self.replay.drain, self.close)
+
+    def close(self):
+        if not self.closed:
+            self.stream.close()
+
+    def on_close(self):
+        self.closed = True
+        if self.stream is not None and not self.connected:
+            self.replay.stats['connect_failures'] += 1
+        elif self.connected and not self.closing:
+            self.replay.stats['dropped_by_server'] += 1
+        for timer in (self.ack_timer, self.close_timer):
+            if timer is not None:
+                self.io_loop.remove_timeout(timer)
+        self.ack_timer = self.close_timer = None
+        lost = sum(1 for frame in self.queue if frame is not None)
+        self.queue.clear()
+        self.replay.queued -= lost
+        self.replay.stats['frames_lost'] += lost
+        if self.successor is not None:
+            self.successor.connect()
+        self.replay.on_connection_closed()
+
+
+class Replay(object):
+
+    r"""Passes records of the captures to connections when they come
+    due at `speed`. Reading stops while `MAX_QUEUED` frames wait for
+    their connections, so a capture of any size replays at max speed."""
+
+    def __init__(self, records, address, speed=1, ack_wait=5, drain=5,
+                 io_loop=None):
+        self.io_loop = io_loop or ioloop.IOLoop.current()
+        self.records = records
+        self.address = address
+        self.speed = speed
+        self.ack_wait = ack_wait
+        self.drain = drain
+        self.connections = {}
+        self.devices = {}       # IMEI -> its last connection
+        self.open = 0
+        self.queued = 0
+        self.paused = False
+        self.pending = None     # record read and not due yet
+        self.exhausted = False
+        self.first_time = self.last_time = None
+        self.started = None
+        self.first_write = self.last_write = None
+        self.stats = defaultdict(int)
+
+    def start(self):
+        self.started = self.io_loop.time()
+        self.read()
+
+    def read(self):
+        while self.queued < MAX_QUEUED:
+            record = self.pending or next(self.records, None)
+            self.pending = None
+            if record is None:
+                self.on_exhausted()
+                return
+            stamp, key, kind, data = record
+            if self.first_time is None:
+                self.first_time = stamp
+            self.last_time = stamp
+            if self.speed:
+                due = self.started + (stamp - self.first_time) / self.speed
+                if due > self.io_loop.time():
+                    self.pending = record
+                    self.io_loop.add_timeout(due, self.read)
+                    return
+            self.deliver(key, kind, data)
+        self.paused = True
+
+    def deliver(self, key, kind, data):
+        conn = self.connections.get(key)
+        if conn is None:
+            if kind == CLOSE:
+                return
+            conn = self.connections[key] = Connection(self, key)
+            self.open += 1
+        conn.feed(kind, data)
+
+    def follow(self, conn, imei):
+        r"""Connects `conn` now or once the last connection of `imei`
+        closes."""
+        last = self.devices.get(imei) if imei is not None else None
+        if imei is not None:
+            self.devices[imei] = conn
+        if last is None or last.closed:
+            conn.connect()
+        else:
+            last.successor = conn
+
+    def on_exhausted(self):
+        r"""Connections still open at the end of the capture are closed
+        once their frames are written."""
+        self.exhausted = True
+        for conn in self.connections.values():
+            conn.feed(CLOSE, '')
+        self.check_done()
+
+    def on_frame(self):
+        self.last_write = self.io_loop.time()
+        if self.first_write is None:
+            self.first_write = self.last_write
+        self.stats['frames'] += 1
+
+    def on_written(self):
+        if self.paused and self.queued < MAX_QUEUED // 2:
+            self.paused = False
+            self.io_loop.add_callback(self.read)
+
+    def on_connection_closed(self):
+        self.open -= 1
+        self.on_written()
+        self.check_done()
+
+    def check_done(self):
+        if self.exhausted and not self.open:
+            self.io_loop.stop()
+
+
+def divergence(connections):
+    r"""SACKs of the replay against the recorded ones, in order per
+    connection. Returns ({outcome: count}, examples of differing ones)."""
+    counts, examples = defaultdict(int), []
+    for conn in connections:
+        for recorded, received in itertools.izip_longest(conn.recorded,
+                                                         conn.received):
+            if recorded == received:
+                counts['matched'] += 1
+            elif received is None:
+                counts['missing'] += 1
+            elif recorded is None:
+                counts['extra'] += 1
+            else:
+                counts['diverged'] += 1
+                if len(examples) < DIVERGENCE_EXAMPLES:
+                    examples.append((conn.key, recorded, received))
+    return counts, examples
+
+
+def serve(transport, control):
+    r"""Server process with sinks left out. Sends its port and runs until
+    it is terminated."""
+    from tornado import gen
+    from conn import QueclinkConnection
+    from server import QueclinkServer
+
+    class ReplayConnection(QueclinkConnection):
+
+        @gen.coroutine
+        def on_report(self, original_msg, response, sack, from_buffer=False):
+            pass
+
+    logging.disable(logging.INFO)
+    io_loop = ioloop.IOLoop.instance()
+    server = QueclinkServer(io_loop=io_loop, port=0, transport=transport,
+                            conn=ReplayConnection)
+    server.listen(0, '127.0.0.1', backlog=4096)
+    control.send(server._sockets.values()[0].getsockname()[1])
+    io_loop.start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('captures', nargs='+')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9002)
+    parser.add_argument('--speed', type=float, default=1,
+                        help="times faster than recorded, 0 - max speed")
+    parser.add_argument('--spawn', action='store_true',
+                        help="replay against a server of its own")
+    parser.add_argument('--transport', choices=TRANSPORTS,
+                        default='tornado', help="transport of --spawn")
+    parser.add_argument('--ack-wait', type=float, default=5,
+                        help="seconds an ack waits for its command")
+    parser.add_argument('--drain', type=float, default=5,
+                        help="seconds a closing connection waits for SACKs")
+    parser.add_argument('--server-pid', type=int, nargs='*', default=[],
+                        help="processes of the server to take CPU time of")
+    args = parser.parse_args()
+    raise_fd_limit()
+    server = None
+    if args.spawn:
+        control, child = multiprocessing.Pipe()
+        server = multiprocessing.Process(target=serve,
+                                         args=(args.transport, child))
+        server.daemon = True
+        server.start()
+        args.host, args.port = '127.0.0.1', control.recv()
+        args.server_pid = [server.pid]
+
+    io_loop = ioloop.IOLoop.instance()
+    replay = Replay(load(args.captures), (args.host, args.port),
+                    speed=args.speed, ack_wait=args.ack_wait,
+                    drain=args.drain, io_loop=io_loop)
+    cpu = cpu_seconds(args.server_pid)
+    started = time.time()
+    io_loop.add_callback(replay.start)
+    io_loop.start()
+    wall = time.time() - started
+    cpu = cpu_seconds(args.server_pid) - cpu
+    if server is not None:
+        server.terminate()
+        server.join()
+
+    stats = replay.stats
+    sending = (replay.last_write - replay.first_write) \
+        if replay.first_write is not None else 0
+    print '%d connections, %d frames, %.1fs recorded, replayed in %.1fs' % (
+        len(replay.connections), stats['frames'],
+        (replay.last_time or 0) - (replay.first_time or 0), wall)
+    print 'frames/s %.1f while sending, sacks/s %.1f' % (
+        stats['frames'] / sending if sending else 0, stats['sacks'] / wall)
+    if args.server_pid and stats['frames']:
+        print 'server CPU %.2fs, %.1f us per frame, %.0f frames per CPU ' \
+            'second' % (cpu, cpu / stats['frames'] * 1e6,
+                        stats['frames'] / cpu if cpu else float('inf'))
+    print 'connects %d, failed %d, dropped by server %d, frames lost %d' % (
+        stats['connects'], stats['connect_failures'],
+        stats['dropped_by_server'], stats['frames_lost'])
+    print 'commands %d, unmatched %d, acks rewritten %d, unmatched acks ' \
+        '%d, unknown frames %d' % (
+            stats['commands'], sum(len(conn.sent) for conn
+                                   in replay.connections.values()),
+            stats['acks_rewritten'], stats['unmatched_acks'],
+            stats['unknown_frames'])
+    counts, examples = divergence(replay.connections.values())
+    print 'sacks recorded %d, matched %d, diverged %d, missing %d, ' \
+        'extra %d' % (sum(len(conn.recorded)
+                          for conn in replay.connections.values()),
+                      counts['matched'], counts['diverged'],
+                      counts['missing'], counts['extra'])
+    for key, recorded, received in examples:
+        print '  connection %d/%d: recorded %s, replayed %s' % (
+            key[0], key[1], recorded, received)
+    if counts['diverged'] or counts['missing'] or counts['extra']:
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,50 @@
 import os
-
+import json
 import socket
+import argparse
 import contextlib
 import functools
 import signal
-from tornado import ioloop, netutil, process, gen, iostream
-from session import TerminalSession
-from conn import QueclinkConnection
-from logger import gen_log
+from tornado import ioloop, netutil, process, gen, iostream, stack_context
+from session import TerminalSession, CallbackSession
+from transport import SocketTransport, TRANSPORTS, CALLBACK
+from conn import QueclinkConnection, replay_record, flush_replayed, \
+    sinks_ready
+from publisher import IoTPublisher
+from writer import LogWriter
+from executor import SinkExecutor
+from spool import Spool
+from flow import FlowControl
+from directory import SessionDirectory, CommandChannel
+from handoff import HandoffServer, take_over, handoff_path
+from fleet import FleetPusher
+from admission import AdmissionController
+from timewheel import TimingWheel
+from configstore import ConfigStore
+from metrics import Registry, MetricsServer
+from profiler import Profiler
+from capture import Capture
+from settings import settings
+from logger import gen_log, monitor_log, frame_log, start_queue_logging, \
+    stop_queue_logging
+import conf
+
+STATS_DIR = 'stats'
+# python 2 socket module does not export it, value is for Linux
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+
+def bind_reuseport(port, address='', backlog=128):
+    r"""Listening socket of one worker. Every worker binds the same port
+    with SO_REUSEPORT and the kernel balances accepted connections between
+    them, so there is no accept thundering herd."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.setblocking(0)
+    sock.bind((address, port))
+    sock.listen(backlog)
+    return sock
 
 
 @contextlib.contextmanager
@@ -28,18 +65,20 @@ class RawServer(object):
         self.ipaddr = kwargs.get('ipaddr', '0.0.0.0')
         self.port = kwargs.get('port')
         self.max_buffer_size = max_buffer_size
+        self.admission = None
 
     def listen(self, port, address="", backlog=128, family=0):
         r"""Starts accepting connections on the given port."""
         sockets = netutil.bind_sockets(port, address=address,
                                        family=family, backlog=backlog)
+        self.add_sockets(sockets)
 
-        def f(conn, addr):
-            self.io_loop.add_future(
-                self.on_connect(conn, addr),
-                lambda future: future.result())
-
-        self.add_sockets(sockets, callback=f)
+    def _handle_connection(self, conn, addr):
+        if self.admission is not None:
+            self.admission.on_accept(conn, addr)
+        else:
+            self.io_loop.add_future(self.on_connect(conn, addr),
+                                    lambda future: future.result())
 
     def add_sockets(self, sockets, callback=None):
         r"""Makes this server start accepting connections on the given
@@ -50,6 +89,7 @@ class RawServer(object):
 
         if self.io_loop is None:
             self.io_loop = ioloop.IOLoop.current()
+        callback = callback or self._handle_connection
         for sock in sockets:
             self._sockets[sock.fileno()] = sock
             netutil.add_accept_handler(sock, callback, io_loop=self.io_loop)
@@ -80,10 +120,23 @@ class RawServer(object):
         sockets, self._pending_sockets = self._pending_sockets, []
         self.add_sockets(sockets)
 
+    def detach_sockets(self):
+        r"""Stops accepting connections and returns listening sockets
+        without closing them. Connections keep queueing in the backlog."""
+        sockets = self._sockets.values()
+        for fd in self._sockets:
+            self.io_loop.remove_handler(fd)
+        self._sockets = {}
+        if self.admission is not None:
+            self.admission.stop()
+        return sockets
+
     def stop(self):
         for fd, sock in self._sockets.items():
             self.io_loop.remove_handler(fd)
             sock.close()
+        if self.admission is not None:
+            self.admission.stop()
 
     @gen.coroutine
     def on_connect(self, socket, address):
@@ -93,55 +146,261 @@ class RawServer(object):
 class QueclinkServer(RawServer):
 
     def __init__(self, *a, **kw):
+        self.directory = kw.pop('directory', None)
+        self.transport = kw.pop('transport', settings.TRANSPORT)
+        self.conn_class = kw.pop('conn', QueclinkConnection)
+        assert self.transport in TRANSPORTS, \
+            "Unknown transport %s" % self.transport
         super(QueclinkServer, self).__init__(*a, **kw)
         self.dongles = {}
+        self.fleet = None
+        self.metrics = None
+
+    def make_stream(self, sock):
+        if self.transport == CALLBACK:
+            return SocketTransport(sock, io_loop=self.io_loop)
+        return iostream.IOStream(sock, io_loop=self.io_loop,
+                                 max_buffer_size=self.max_buffer_size)
+
+    def make_session(self, stream, state=None):
+        session_class = CallbackSession if self.transport == CALLBACK \
+            else TerminalSession
+        # socket handlers and timers of the session live as long as the
+        # connection, they must not hold the coroutine that accepted it
+        with stack_context.NullContext():
+            return session_class(server=self,
+                                 conn=self.conn_class,
+                                 stream=stream,
+                                 io_loop=self.io_loop,
+                                 state=state)
 
     @gen.coroutine
     def on_connect(self, sock, address):
         super(QueclinkServer, self).on_connect(sock, address)
-        stream = iostream.IOStream(sock, io_loop=self.io_loop,
-                                   max_buffer_size=self.max_buffer_size)
-        yield self.create_session(stream)
+        yield self.create_session(self.make_stream(sock))
 
     @gen.coroutine
     def create_session(self, stream):
-        session = TerminalSession(
-            server=self,
-            conn=QueclinkConnection,
-            stream=stream,
-            io_loop=self.io_loop)
+        session = self.make_session(stream)
         unique_id = yield session.open()
+        if unique_id == conf.DISCONN_RESULT:
+            return
         if unique_id in self.dongles:
             sess = self.dongles.pop(unique_id)
             sess.close()
             sess = None
             # TODO. warning
         self.dongles[unique_id] = session
+        if self.directory is not None:
+            self.directory.register(unique_id)
+        if self.fleet is not None:
+            self.fleet.on_session_open(unique_id)
+
+    def adopt_session(self, sock, state):
+        r"""Continues session handed over by the previous process."""
+        session = self.make_session(self.make_stream(sock), state)
+        self.dongles[session.session_key] = session
+        if self.directory is not None:
+            self.directory.register(session.session_key)
+        if self.fleet is not None:
+            self.fleet.on_session_open(session.session_key)
 
-    def close_session(self, unique_id):
+    def close_session(self, unique_id, session=None):
+        if session is not None and self.dongles.get(unique_id) is not session:
+            return
         self.dongles.pop(unique_id, None)
+        if self.directory is not None and unique_id:
+            self.directory.unregister(unique_id)
 
+    def stats(self):
+        return {'sessions': len(self.dongles),
+                'flow': FlowControl.instance().stats(),
+                'timers': TimingWheel.instance().stats(),
+                'config': ConfigStore.instance().stats(),
+                'admission': self.admission.stats()
+                if self.admission is not None else {}}
 
-def handle_stop(io_loop, obd_server, signum, stack):
-    r"""Properly kills the process by interrupting it first."""
+
+def shutdown(obd_server, channel, handoff):
+    r"""Stops accepting and drains sinks."""
     obd_server.stop()
+    channel.stop()
+    handoff.stop()
+    if obd_server.metrics is not None:
+        obd_server.metrics.stop()
+    TimingWheel.shutdown()
+    Spool.instance().stop_drainer()
+    SinkExecutor.shutdown(wait=True)
+    LogWriter.shutdown()
+    IoTPublisher.shutdown(timeout=5)
+    Spool.shutdown()
+    ConfigStore.shutdown()
+    Profiler.shutdown()
+    Capture.shutdown()
+    stop_queue_logging()
+
+
+def handle_stop(io_loop, obd_server, channel, handoff, signum, stack):
+    r"""Properly kills the process by interrupting it first."""
+    shutdown(obd_server, channel, handoff)
     io_loop.stop()
     io_loop.close()
     signal.signal(signal.SIGTERM, signal.SIG_DFL)
     os.kill(os.getpid(), signal.SIGTERM)
 
 
-if __name__ == '__main__':
+def handle_profile(io_loop, signum, stack):
+    r"""SIGUSR2 starts profiling for PROFILE_SECONDS, the next one stops
+    it early."""
+    io_loop.add_callback_from_signal(Profiler.instance().toggle)
+
+
+def handle_handoff(io_loop, obd_server, channel, handoff):
+    r"""Exits once sessions are passed to the new process."""
+    shutdown(obd_server, channel, handoff)
+    io_loop.stop()
+
+
+def collect_stats(server):
+    r"""Stats of the server and process wide sinks."""
+    return {'pid': os.getpid(),
+            'server': server.stats(),
+            'sinks': SinkExecutor.instance().stats(),
+            'writer': LogWriter.instance().stats(),
+            'publisher': IoTPublisher.instance().stats(),
+            'spool': Spool.instance().stats(),
+            'metrics': Registry.instance().stats(),
+            'log': frame_log.stats()}
+
+
+def collect_gauges(server):
+    r"""Stats exported along with metrics, histograms are there already."""
+    stats = collect_stats(server)
+    del stats['pid'], stats['metrics']
+    return stats
+
+
+def start_metrics(server, worker_id, io_loop):
+    r"""Serves metrics of this worker in Prometheus text format on
+    METRICS_PORT + worker id. The port is bound with SO_REUSEPORT, so the
+    process taking the worker over binds it before the old one exits."""
+    port = settings.METRICS_PORT + (worker_id or 0)
+    labels = (('worker', worker_id),) if worker_id is not None else ()
+    metrics = MetricsServer(functools.partial(collect_gauges, server),
+                            labels, io_loop=io_loop)
+    metrics.add_sockets([bind_reuseport(port, settings.METRICS_ADDRESS)])
+    monitor_log.info("metrics on %s:%d", settings.METRICS_ADDRESS, port,
+                     extra={'monitor': 'metrics'})
+    return metrics
+
+
+def stats_path(path, worker_id):
+    return os.path.join(path, STATS_DIR, '%s.json' % worker_id)
+
+
+def dump_stats(server, path):
+    r"""Writes stats of this worker for the launcher to aggregate."""
+    tmp = path + '.tmp'
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(collect_stats(server), f)
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        gen_log.warning("failed to dump stats %s", e)
+
+
+def run(port, worker_id=None, sockets=None, takeover=False, transport=None):
+    r"""Runs the server in the current process until SIGTERM.
+    `sockets` are listening sockets prepared by the caller, by default
+    the server binds the port itself. With `takeover` listening sockets
+    and sessions are taken from the running process of the same worker.
+    `transport` is `tornado` (IOStream) or `callback` (SocketTransport),
+    TRANSPORT setting by default."""
+    sessions, pushes = [], []
+    if settings.LOG_QUEUE:
+        start_queue_logging()
+    path = handoff_path(settings.DIRECTORY_PATH, worker_id)
+    if takeover:
+        inherited = take_over(path)
+        if inherited is None:
+            gen_log.warning("Nothing to take over at %s", path)
+        else:
+            sockets, sessions, pushes = inherited
     io_loop = ioloop.IOLoop.instance()
-    port = int(os.getenv('VCAP_APP_PORT', 9002))
+    directory = SessionDirectory(settings.DIRECTORY_PATH, worker_id)
     server = QueclinkServer(io_loop=io_loop, ipaddr='0.0.0.0',
-                            port=port)
-    server.listen(port)
+                            port=port, directory=directory,
+                            transport=transport or settings.TRANSPORT)
+    if settings.ADMISSION_ENABLE:
+        server.admission = AdmissionController(
+            server.on_connect,
+            max_handshaking=settings.ADMISSION_MAX_HANDSHAKING,
+            rate=settings.ADMISSION_RATE,
+            burst=settings.ADMISSION_BURST,
+            defer=settings.ADMISSION_DEFER,
+            max_deferred=settings.ADMISSION_MAX_DEFERRED,
+            defer_timeout=settings.ADMISSION_DEFER_TIMEOUT,
+            io_loop=io_loop)
+    if sockets is not None:
+        server.add_sockets(sockets)
+    elif worker_id is not None:
+        server.add_sockets([bind_reuseport(
+            port, backlog=settings.LISTEN_BACKLOG)])
+    else:
+        server.listen(port, backlog=settings.LISTEN_BACKLOG)
+    server.fleet = FleetPusher(server, io_loop=io_loop)
+    server.fleet.restore(pushes)
+    for sock, state in sessions:
+        server.adopt_session(sock, state)
+    channel = CommandChannel(server, directory, io_loop)
+    channel.listen()
+    handoff = HandoffServer(server, channel, path, io_loop, None)
+    handoff.on_done = functools.partial(handle_handoff, io_loop, server,
+                                        channel, handoff)
+    handoff.listen()
+    if settings.METRICS_PORT:
+        server.metrics = start_metrics(server, worker_id, io_loop)
+    if settings.CAPTURE:
+        Capture.instance().start()
+    # sinks are created on the IOLoop thread before the drainer uses them
+    LogWriter.instance()
+    IoTPublisher.instance()
+    Spool.instance().start_drainer(replay_record, sinks_ready,
+                                   rate=settings.SPOOL_DRAIN_RATE,
+                                   flush=flush_replayed)
+    if worker_id is not None:
+        path = stats_path(settings.DIRECTORY_PATH, worker_id)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        dump = functools.partial(dump_stats, server, path)
+        ioloop.PeriodicCallback(dump, settings.STATS_INTERVAL * 1000,
+                                io_loop=io_loop).start()
     # register signal handlers
-    handle_stop = functools.partial(handle_stop, io_loop, server)
-    signal.signal(signal.SIGTERM, handle_stop)
-    gen_log.info("Queclink Server is UP on port {}.".format(port))
+    signal.signal(signal.SIGTERM,
+                  functools.partial(handle_stop, io_loop, server, channel,
+                                    handoff))
+    signal.signal(signal.SIGUSR2, functools.partial(handle_profile, io_loop))
+    gen_log.info("Queclink Server is UP on port {} ({} transport), {} "
+                 "sessions taken over.".format(port, server.transport,
+                                               len(sessions)))
     io_loop.start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Queclink server")
+    parser.add_argument('--port', type=int,
+                        default=int(os.getenv('VCAP_APP_PORT', 9002)))
+    parser.add_argument('--worker-id', type=int, default=None,
+                        help="worker of the launcher, binds with SO_REUSEPORT")
+    parser.add_argument('--takeover', action='store_true',
+                        help="take sockets and sessions over from the "
+                             "running server (graceful reload)")
+    parser.add_argument('--transport', choices=TRANSPORTS, default=None,
+                        help="socket layer, TRANSPORT setting by default")
+    args = parser.parse_args()
+    run(args.port, worker_id=args.worker_id, takeover=args.takeover,
+        transport=args.transport)
 
 
 
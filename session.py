@@ -1,16 +1,24 @@
-import functools
+import os
+import time
+from collections import deque
 
 from toro import JoinableQueue
 from tornado.log import app_log
-from tornado.concurrent import Future
 from tornado import gen
+from tornado.concurrent import Future
 
 from commons.async import schedule_at_loop
-from protocol import QueclinkProtocol
+from protocol import QueclinkProtocol, FrameSplitter
+from flow import FlowControl, Sequencer
+from dispatcher import CommandDispatcher, resolve
+from timewheel import TimingWheel
+from metrics import Registry, STAGE_SECONDS, FRAMES, FILTERED, \
+    RECEIVED_BYTES
+from capture import capture
 import conf
-from utils import generate_random_hex
-from logger import gen_log
-from commons.exceptions import MessageNotImplemented, StreamClosedError
+from logger import gen_log, frame_log, INCOMING, SACK
+from commons.exceptions import MessageNotImplemented, StreamClosedError, \
+    CommandTimeoutError
 
 CONNECTING = 0
 OPEN = 1
@@ -18,66 +26,29 @@ CLOSING = 2
 CLOSED = 3
 
 
-class RTOManager(object):
-
-    def __init__(self, *a, **kw):
-        self.rto_cmds = {}
-        super(RTOManager, self).__init__()
-
-    def make_rto(self, body):
-        r"""It makes real time request to current connection.
-        It waits for ack, then waits for real response and returned
-        the result back. Result could be any:
-            log - depending on RTO
-            exc - MessageNotImplemented
-        Returns:
-            future promise
-        """
-
-        def callback(promise, f_rto_ack):
-            rto_ack = f_rto_ack.result()
-            if isinstance(rto_ack, str) and rto_ack == conf.DISCONN_RESULT:
-                return
-            _f = self.rto_cmds[rto_ack.sub_cmd] = promise
-            return _f
-
-        f_rto_ack = self.exec_command(conf.COMMAND, conf.RTO_CMD, body)
-        f_rto_response = Future()
-        cb = functools.partial(callback, f_rto_response)
-        self.io_loop.add_future(f_rto_ack, cb)
-        return f_rto_response
-
-    def is_pending_rto(self, header):
-        r"""Determines whether this header is pending rto request."""
-        if header in self.rto_cmds:
-            return True
-        return False
-
-    def make_rto_response(self, log):
-        r"""Make registered rto finished by setting response to future."""
-        f = self.rto_cmds.pop(log.header)
-        if f._done:
-            return f
-        if isinstance(log, Exception):
-            f.set_exception(log)
-        else:
-            f.set_result(log.log)
-        return f
-
-
-class TerminalSession(RTOManager, QueclinkProtocol):
+class TerminalSession(QueclinkProtocol):
 
     r"""Base session implementation class.
     Session is shared object and low-level code for connection.
+    Most sessions are idle most of the time, so the state is kept in
+    slots and queues and futures exist only while they are in use.
 
         Parameters
         ----------
             session_key - IMEI of device
     """
 
-    STOP_FLAG = False
+    __slots__ = ('server', 'stream', 'conn', 'session_key', 'state',
+                 'io_loop', 'job_queue', 'splitter', 'flow', 'sequencer',
+                 'cnt_number', 'held', 'timers', 'commands', 'opened',
+                 'verified', 'created_at', 'last_seen', 'report_stored',
+                 'idle_timer', 'skip_message', 'STOP_FLAG')
+
+    ORDERED = conf.ORDERED_PROCESSING
+    OPTIMISTIC = conf.OPTIMISTIC_OPEN
 
     def __init__(self, server, conn, stream, io_loop=None, *args, **kwargs):
+        state = kwargs.pop('state', None)
         self.server = server
         self.stream = stream
         self.conn = conn(self,
@@ -88,60 +59,218 @@ class TerminalSession(RTOManager, QueclinkProtocol):
         self.state = CONNECTING
         self.io_loop = io_loop
         self.stream.set_close_callback(self.socket_closed)
-        self.job_queue = JoinableQueue()
-        self.registered_cmds = {}
+        if capture.recording:
+            capture.opened(self)
+        self.job_queue = self.make_job_queue()
+        self.splitter = FrameSplitter()
+        self.flow = FlowControl(conf.SESSION_MAX_PENDING,
+                                parent=FlowControl.instance(),
+                                io_loop=io_loop)
+        self.sequencer = Sequencer(conf.SESSION_WINDOW, io_loop=io_loop)
         self.cnt_number = '0000'
+        self.held = None
+        self.timers = TimingWheel.instance()
+        self.commands = CommandDispatcher(self)
+        self.opened = Future()      # dropped once resolved
+        self.verified = False
+        self.created_at = self.last_seen = self.io_loop.time()
+        self.report_stored = False
+        self.skip_message = False
+        self.STOP_FLAG = False
+        # also bounds the wait for VER in `open`
+        self.idle_timer = self.timers.call_later(self.idle_timeout(),
+                                                 self.check_idle)
+        if state is not None:
+            self.restore(state)
         self.io_loop.add_future(self.init_workflow(),
                                 lambda future: future.result())
         super(TerminalSession, self).__init__(*args, **kwargs)
 
+    def make_job_queue(self):
+        return JoinableQueue()
+
     def is_open(self):
         return self.state == OPEN
 
     def is_closed(self):
         return self.state == CLOSED
 
-    @gen.coroutine
     def open(self):
-        """Opens the connect. According to the protocol,
-        we should first configure the device and after than
-        connection should be flagged as opened."""
-        # unique_id = yield self.conn.configure()
-        log = yield self.conn.verify_conn()
-        unique_id = log.unique_id
-        gen_log.info('CONNECTION OPENED WITH: %s' % unique_id)
-        if unique_id:
-            self.session_key = unique_id
-            self.state = OPEN
-            self.conn.on_open(unique_id)
-            raise gen.Return(unique_id)
-        raise gen.Return(conf.DISCONN_RESULT)
+        r"""Opens the connect. Device is verified by RTO VER, optimistic
+        session is opened as soon as a frame carries IMEI and the check
+        goes on in the background, failed check closes the session.
+        Returns:
+            future of IMEI, or of DISCONN_RESULT if device is not verified
+        """
+        opened = self.opened    # verify may resolve and drop it at once
+        self.io_loop.add_future(self.verify(), lambda future: future.result())
+        return opened
 
     @gen.coroutine
-    def read_message(self):
-        r"""Callbacks takes two arguments: binary data and job code."""
+    def verify(self):
+        try:
+            log = yield self.conn.verify_conn()
+        except CommandTimeoutError as e:
+            gen_log.warning("DEVICE IS NOT VERIFIED: %s", e)
+            log = None
+        if log == conf.DISCONN_RESULT:
+            self.resolve_open(conf.DISCONN_RESULT)
+            return
+        unique_id = getattr(log, 'unique_id', None)
+        if not unique_id or (self.is_open() and
+                             unique_id != self.session_key):
+            if log is not None:
+                gen_log.warning("DEVICE IS NOT VERIFIED: %s is %s",
+                                self.session_key, unique_id)
+            self.close()
+            self.resolve_open(conf.DISCONN_RESULT)
+            return
+        self.verified = True
+        self.set_open(unique_id)
+
+    def resolve_open(self, result):
+        opened, self.opened = self.opened, None
+        if opened is not None:
+            resolve(opened, result)
+
+    def set_open(self, unique_id):
+        if self.opened is None:
+            return
+        gen_log.info('CONNECTION OPENED WITH: %s' % unique_id)
+        self.session_key = unique_id
+        self.state = OPEN
+        self.conn.on_open(unique_id)
+        self.io_loop.add_future(self.conn.configure(),
+                                lambda future: future.result())
+        Registry.instance().histogram(
+            'session_open_seconds',
+            'Connect to session registration').observe(
+            self.io_loop.time() - self.created_at)
+        self.resolve_open(unique_id)
+
+    def on_report_stored(self):
+        r"""Called by connection when report has been given to the
+        writer or to the spool."""
+        if self.report_stored:
+            return
+        self.report_stored = True
+        Registry.instance().histogram(
+            'first_report_seconds',
+            'Connect to the first stored report').observe(
+            self.io_loop.time() - self.created_at)
+
+    def read_messages(self):
+        r"""Reads whatever is available on the stream. Complete frames
+        are passed to the message bus in batches as data arrives, the
+        returned future resolves after `READ_CHUNK_SIZE` bytes."""
         if self.stream.closed():
             raise StreamClosedError("Stream is closed")
-        message = yield gen.Task(self.stream.read_until, conf.END_SIGN)
-        raise gen.Return(message)
+        return gen.Task(self.stream.read_bytes, conf.READ_CHUNK_SIZE,
+                        streaming_callback=self.on_stream_data)
+
+    def on_stream_data(self, data):
+        self.last_seen = self.io_loop.time()
+        if self.held is not None:
+            # session is being handed over, data goes to the new process
+            self.held.append(data)
+            return
+        frames = self.split_frames(data)
+        if frames:
+            self.flow.acquire(len(frames))
+            self.job_queue.put(frames)
+
+    def split_frames(self, data):
+        started = time.time()
+        overflows = self.splitter.overflows
+        frames = self.splitter.feed(data)
+        STAGE_SECONDS.labels('read', '').observe(time.time() - started)
+        RECEIVED_BYTES.inc(len(data))
+        if capture.recording:
+            capture.inbound(self, frames)
+        if self.splitter.overflows and not overflows:
+            self.frame_too_long()
+        return frames
+
+    def frame_too_long(self):
+        r"""Device sends garbage, the session is closed once frames read
+        before it are handled."""
+        gen_log.warning("FRAME TOO LONG: %s, " + conf.FRAME_TOO_LONG_EXC,
+                        self.session_key, self.splitter.max_frame_size)
+        # frames of the chunk are acquired by the caller after the split
+        self.io_loop.add_callback(self.close_when_handled)
+
+    def close_when_handled(self):
+        self.io_loop.add_future(
+            self.flow.join(),
+            lambda future: self.is_closed() or self.close())
 
     @gen.coroutine
     def terminal_message_flow(self, msg):
         r"""Sets message flow"""
+        parsed = self.prepare_message(msg)
+        if parsed is None:
+            return
+        count_num = yield self.emit_message(msg, *parsed)
+        raise gen.Return(count_num)
+
+    @gen.coroutine
+    def ordered_message_flow(self, seq, msg):
+        r"""Message flow that parses the frame right away, but emits it
+        and updates `cnt_number` only in the order frames arrived."""
+        try:
+            parsed = self.prepare_message(msg)
+        except Exception as e:
+            gen_log.exception(e)
+            parsed = None
+        yield self.sequencer.turn(seq)
         try:
-            log, sack, from_buffer = super(
-                TerminalSession, self).terminal_message_flow(msg)
+            if parsed is not None:
+                count_num = yield self.emit_message(msg, *parsed)
+                if count_num is not None:
+                    self.cnt_number = count_num
+        finally:
+            self.sequencer.done(seq)
+
+    def prepare_message(self, msg):
+        r"""Parses the frame the way protocol `terminal_message_flow`
+        does, timing each stage. Returns (log, sack, from_buffer) or None
+        if message is not implemented."""
+        try:
+            started = time.time()
+            self.message_validator(msg)
+            validated = time.time()
+            pprocessor, msg_tp, params, kw = self.message_parser(
+                msg.rstrip(conf.END_SIGN))
+            parsed = time.time()
+            log, sack = pprocessor(msg_tp, *params, **kw)
+            processed = time.time()
         except MessageNotImplemented as e:  # silence exc
             gen_log.exception(e)
-            return
+            return None
+        STAGE_SECONDS.labels('validate', msg_tp).observe(validated - started)
+        STAGE_SECONDS.labels('parse', msg_tp).observe(parsed - validated)
+        STAGE_SECONDS.labels('ack' if log.type == conf.ACK else 'process',
+                             msg_tp).observe(processed - parsed)
+        FRAMES.labels(msg_tp).inc()
+        return log, sack, kw.get('from_buffer', False)
+
+    @gen.coroutine
+    def emit_message(self, msg, log, sack, from_buffer):
+        r"""Updates session state with parsed frame and passes it to
+        the connection. Returns count number of the frame."""
         count_num = log.log.count_number
+        if self.OPTIMISTIC and not self.is_open() and \
+                getattr(log.log, 'unique_id', None):
+            self.set_open(log.log.unique_id)
         if log.type == conf.ACK:
             if not log.header == conf.HEARTBEAT_ACK:
-                self.unregister_command_on_ack(log.log)
+                self.commands.on_ack(log.log)
+            started = time.time()
             yield self.conn.on_ack(msg, log, sack)
+            STAGE_SECONDS.labels('on_ack', log.header).observe(
+                time.time() - started)
         else:
-            if self.is_pending_rto(log.header):
-                self.make_rto_response(log)
+            self.commands.on_report(log)
             # bad accuracy of gps
             # may be warn by email our guys that gps accuracy is weak
             # skip message logic
@@ -151,27 +280,112 @@ class TerminalSession(RTOManager, QueclinkProtocol):
                     self.skip_message = True
                 else:
                     self.skip_message = False
-            if getattr(self, 'skip_message', False):
+            if self.skip_message:
+                FILTERED.labels(log.header).inc()
                 gen_log.info("Hey, GPS ACCURACY IS BAD")
                 return
+            started = time.time()
             yield self.conn.on_report(msg, log, sack, from_buffer=from_buffer)
+            STAGE_SECONDS.labels('on_report', log.header).observe(
+                time.time() - started)
         if not self.session_key and hasattr(log.log, 'unique_id'):
             self.session_key = log.log.unique_id
             self.state = OPEN
         raise gen.Return(count_num)
 
     def exec_command(self, msg_tp, header, body):
-        r"""Sends message to the end-point. Returns promiseable future."""
+        r"""Sends message to the end-point. Returns promiseable future
+        of the ack."""
         if not msg_tp == conf.COMMAND:
             raise
-        serial_number, cmd_future = self.register_command_for_ack()
-        body.update({'serial_number': serial_number})
-        self.send_message(self.build_cmd(header, **body))
-        return cmd_future
+        return self.commands.send(header, body)
+
+    def make_rto(self, body):
+        r"""It makes real time request to current connection.
+        Returns promiseable future of the response report (of the ack if
+        sub command has no report)."""
+        return self.commands.send_rto(body)
+
+    def on_command_ack(self, msg):
+        self.conn.on_command_ack(msg)
 
     def send_message(self, msg):
+        started = time.time()
         self.stream.write(msg)
-        gen_log.info("SACK: %s", msg)
+        if capture.recording:
+            capture.outbound(self, msg)
+        STAGE_SECONDS.labels(
+            'sack_write' if msg.startswith(conf.SACK) else 'command_write',
+            '').observe(time.time() - started)
+        frame_log.info(SACK, self.session_key, "SACK: %s", msg)
+
+    def stats(self):
+        stats = self.flow.stats()
+        stats.update(self.sequencer.stats())
+        stats['commands'] = self.commands.stats()
+        stats['queued'] = self.job_queue.qsize()
+        return stats
+
+    @gen.coroutine
+    def detach(self):
+        r"""Hands the session over to another process. Stops processing of
+        new data, waits for frames in flight and closes the session
+        keeping the connection open.
+        Returns:
+            (fd, state) - duplicate of the socket and state for `restore`
+        """
+        self.held = []
+        yield self.flow.join()
+        state = {'imei': self.session_key,
+                 'cnt_number': self.cnt_number,
+                 'commands': self.commands.pending(),
+                 'skip_message': self.skip_message}
+        fd = os.dup(self.stream.socket.fileno())
+        self.close()
+        # data consumed from the socket right before close
+        yield gen.Task(self.io_loop.add_callback)
+        state['pending'] = self.splitter.take() + ''.join(self.held) + \
+            self.unread_data()
+        raise gen.Return((fd, state))
+
+    def unread_data(self):
+        r"""Data read from the socket and not given to the session."""
+        return ''.join(self.stream._read_buffer)
+
+    def restore(self, state):
+        r"""Continues session detached by another process."""
+        self.session_key = state['imei']
+        self.cnt_number = state['cnt_number']
+        self.skip_message = state['skip_message']
+        self.state = OPEN
+        self.verified = self.report_stored = True
+        self.resolve_open(self.session_key)
+        for serial, message in state['commands']:
+            self.commands.adopt(serial, message)
+        self.conn.on_open(self.session_key)
+        self.on_stream_data(state['pending'])
+
+    def idle_timeout(self):
+        r"""Seconds of silence after which the device is considered gone.
+        Device sends heartbeat when there is nothing else to send."""
+        config = self.conn.config
+        interval = max(
+            int(config.get('heartbeat_interval') or 0) * conf.HEARTBEAT_UNIT,
+            int(config.get('send_interval') or 0))
+        return interval * conf.IDLE_MISSED_INTERVALS + conf.IDLE_GRACE
+
+    def check_idle(self):
+        if self.is_closed():
+            return
+        silent = self.io_loop.time() - self.last_seen
+        timeout = self.idle_timeout()
+        if silent < timeout:
+            self.idle_timer = self.timers.call_later(timeout - silent,
+                                                     self.check_idle)
+            return
+        gen_log.info("IDLE TIMEOUT: %s", self.session_key)
+        self.STOP_FLAG = True
+        self.close()
 
     def should_stop(self):
         return self.STOP_FLAG
@@ -187,24 +401,38 @@ class TerminalSession(RTOManager, QueclinkProtocol):
     def _tail_messagebus(self):
 
         def job_complete(f):
-            self.cnt_number = f.result()
+            try:
+                count_num = f.result()
+                if count_num is not None:
+                    self.cnt_number = count_num
+            finally:
+                self.flow.release()
 
         while True:
             if self.should_stop():
                 break
-            message = yield self.job_queue.get()
-            schedule_at_loop(self.io_loop, self.terminal_message_flow(message),
-                             job_complete)
+            messages = yield self.job_queue.get()
+            for message in messages:
+                if self.ORDERED:
+                    # waits while the window of the session is full
+                    seq = yield self.sequencer.acquire()
+                    job = self.ordered_message_flow(seq, message)
+                else:
+                    job = self.terminal_message_flow(message)
+                schedule_at_loop(self.io_loop, job, job_complete)
+                frame_log.info(INCOMING, self.session_key,
+                               "INCOMING MSG: %s", message)
             self.job_queue.task_done()
-            gen_log.info("INCOMING MSG: %s", message)
 
     @gen.coroutine
     def _tail_stream_buffer(self):
         while True:
             if self.should_stop():
                 break
-            message = yield self.read_message()
-            yield self.job_queue.put(message)
+            # stop reading while the bus is behind, TCP will slow
+            # the device down
+            yield self.flow.wait()
+            yield self.read_messages()
 
     def _handle_message_flow(self, future):
         # some other errors that I do not know yet that can
@@ -217,42 +445,103 @@ class TerminalSession(RTOManager, QueclinkProtocol):
             self.STOP_FLAG = True
             self.close()
 
-    def register_command_for_ack(self):
-        r"""Returns serial number and future promise"""
-        serial_number = ''
-        while not serial_number or serial_number in self.registered_cmds:
-            serial_number = generate_random_hex()
-        f = self.registered_cmds[serial_number] = Future()
-        return serial_number, f
-
-    def unregister_command_on_ack(self, log):
-        serial_number = log.serial_number
-        future = self.registered_cmds.pop(serial_number, None)
-        if not future:
-            return
-        if future._done:
-            return future
-        if not isinstance(log, Exception):
-            future.set_result(log)
-        else:
-            future.set_exception(log)
-
-    def unregister_commands(self):
-        if not self.is_open():
-            for evt in self.registered_cmds.keys():
-                f = self.registered_cmds.pop(evt)
-                f.set_result(conf.DISCONN_RESULT)
-            while self.registered_cmds:
-                self.registered_cmds
-
     def socket_closed(self):
+        if self.is_closed():
+            # closed by the server
+            return
         self.state = CLOSING
         self.close()
 
     def close(self):
-        self.unregister_commands()
-        self.server.close_session(self.session_key)
+        self.idle_timer.cancel()
+        self.flow.close()
+        self.commands.close()
+        self.server.close_session(self.session_key, self)
         self.conn.on_close()
         self.stream.close()
         self.state = CLOSED
+        if capture.recording:
+            capture.closed(self)
         gen_log.info("CONNECTION CLOSED: %s", self.session_key)
+
+
+class CallbackSession(TerminalSession):
+
+    r"""Session on `SocketTransport`.
+
+    Frames go from `data_received` straight to the ordered message flow,
+    without read coroutines, stream buffer and message queue on the way.
+    Up to `SESSION_WINDOW` frames are in flight, the rest wait in the
+    backlog. Reading is paused while the session or the process is over
+    its flow limit."""
+
+    __slots__ = ('backlog', 'paused')
+
+    def __init__(self, *args, **kwargs):
+        self.backlog = None     # frames over the window, while there are any
+        self.paused = False
+        super(CallbackSession, self).__init__(*args, **kwargs)
+
+    def make_job_queue(self):
+        return None
+
+    @gen.coroutine
+    def init_workflow(self):
+        self.stream.start(self)
+
+    def on_stream_data(self, data):
+        self.last_seen = self.io_loop.time()
+        if self.held is not None:
+            self.held.append(data)
+            return
+        frames = self.split_frames(data)
+        if frames:
+            self.flow.acquire(len(frames))
+            if self.backlog is None:
+                self.backlog = deque(frames)
+            else:
+                self.backlog.extend(frames)
+            self.dispatch()
+        if not self.paused and self.flow.is_full():
+            self.paused = True
+            self.stream.pause_reading()
+            self.io_loop.add_future(self.flow.wait(), self.on_flow_ready)
+
+    data_received = on_stream_data
+
+    def dispatch(self):
+        while self.backlog and \
+                self.sequencer.in_flight < self.sequencer.window:
+            seq = self.sequencer.take()
+            message = self.backlog.popleft()
+            frame_log.info(INCOMING, self.session_key,
+                           "INCOMING MSG: %s", message)
+            self.io_loop.add_future(self.ordered_message_flow(seq, message),
+                                    self.on_frame_done)
+        if not self.backlog:
+            self.backlog = None
+
+    def on_frame_done(self, future):
+        self.flow.release()
+        try:
+            future.result()
+        except Exception as e:
+            app_log.exception(e)
+        self.dispatch()
+
+    def on_flow_ready(self, future):
+        self.paused = False
+        if not self.stream.closed():
+            self.stream.resume_reading()
+
+    def unread_data(self):
+        return ''
+
+    def stats(self):
+        stats = super(CallbackSession, self).stats()
+        stats['queued'] = len(self.backlog or ())
+        return stats
+
+    def close(self):
+        self.backlog = None
+        super(CallbackSession, self).close()
@@ -20,3 +20,60 @@ settings.DB_URL = "postgresql://{0}:{1}@{2}/{3}".format(settings.DB_USER,
                                                         settings.DB_PASS,
                                                         settings.DB_HOST,
                                                         settings.DB_NAME)
+settings.PROCESS_MAX_PENDING = int(os.getenv('PROCESS_MAX_PENDING', 50000))
+settings.DB_BATCH_SIZE = int(os.getenv('DB_BATCH_SIZE', 500))
+settings.DB_FLUSH_INTERVAL = float(os.getenv('DB_FLUSH_INTERVAL', 1.0))
+settings.SINK_WORKERS = int(os.getenv('SINK_WORKERS', 4))
+settings.SINK_MAX_PENDING = int(os.getenv('SINK_MAX_PENDING', 1000))
+
+settings.IOT_OPTIONS = {
+    "org": os.getenv('IOT_ORG', 'qrqu70'),
+    "type": os.getenv('IOT_TYPE', 'vehicle'),
+    "id": os.getenv('IOT_ID', '864251020002569'),
+    "auth-method": "token",
+    "auth-token": os.getenv('IOT_AUTH_TOKEN', 'a-qrqu70-lgtfdke36o')
+}
+settings.IOT_CLIENT = os.getenv('IOT_CLIENT', 'ibmiotf')     # or 'local'
+settings.IOT_POOL_SIZE = int(os.getenv('IOT_POOL_SIZE', 1))
+settings.IOT_MAX_QUEUE = int(os.getenv('IOT_MAX_QUEUE', 10000))
+settings.IOT_BATCH_SIZE = int(os.getenv('IOT_BATCH_SIZE', 100))
+settings.SPOOL_DIR = os.getenv('SPOOL_DIR', rel('..', 'spool'))
+settings.SPOOL_SEGMENT_SIZE = int(os.getenv('SPOOL_SEGMENT_SIZE', 8 * 1024 * 1024))
+settings.SPOOL_MAX_BYTES = int(os.getenv('SPOOL_MAX_BYTES', 1024 * 1024 * 1024))
+settings.SPOOL_FSYNC = os.getenv('SPOOL_FSYNC', 'interval')   # always, interval, never
+settings.SPOOL_FSYNC_INTERVAL = float(os.getenv('SPOOL_FSYNC_INTERVAL', 1.0))
+settings.SPOOL_DRAIN_RATE = int(os.getenv('SPOOL_DRAIN_RATE', 500))    # records per second
+settings.SPOOL_QUEUE_SIZE = int(os.getenv('SPOOL_QUEUE_SIZE', 100000))    # records waiting for the disk, excess ones are dropped
+settings.DIRECTORY_PATH = os.getenv(
+    'DIRECTORY_PATH',
+    '/dev/shm/queclink' if os.path.isdir('/dev/shm') else '/tmp/queclink')
+settings.WORKERS = int(os.getenv('WORKERS', 0))     # 0 - one per CPU
+settings.CPU_AFFINITY = os.getenv('CPU_AFFINITY', '0') == '1'
+settings.STATS_INTERVAL = float(os.getenv('STATS_INTERVAL', 5.0))
+settings.PUSH_RATE = float(os.getenv('PUSH_RATE', 200))     # commands per second per process
+settings.PUSH_BURST = int(os.getenv('PUSH_BURST', 50))
+settings.PUSH_TTL = int(os.getenv('PUSH_TTL', 7 * 24 * 3600))     # seconds a push waits for offline devices
+settings.CONFIG_STORE_PATH = os.getenv('CONFIG_STORE_PATH', rel('..', 'devices'))
+settings.CONFIG_RECONCILE = os.getenv('CONFIG_RECONCILE', '0') == '1'
+settings.CONFIG_MANAGED = tuple(key for key in os.getenv('CONFIG_MANAGED', '').split(',') if key)   # connection config keys pushed to every device, e.g. heartbeat_interval,send_interval
+settings.LISTEN_BACKLOG = int(os.getenv('LISTEN_BACKLOG', 1024))   # capped by net.core.somaxconn
+settings.ADMISSION_ENABLE = os.getenv('ADMISSION_ENABLE', '1') == '1'
+settings.ADMISSION_MAX_HANDSHAKING = int(os.getenv('ADMISSION_MAX_HANDSHAKING', 500))  # sessions not open yet
+settings.ADMISSION_RATE = float(os.getenv('ADMISSION_RATE', 500))     # new sessions per second per process
+settings.ADMISSION_BURST = int(os.getenv('ADMISSION_BURST', 100))
+settings.ADMISSION_DEFER = os.getenv('ADMISSION_DEFER', '1') == '1'   # queue excess connections instead of closing
+settings.ADMISSION_MAX_DEFERRED = int(os.getenv('ADMISSION_MAX_DEFERRED', 10000))
+settings.ADMISSION_DEFER_TIMEOUT = float(os.getenv('ADMISSION_DEFER_TIMEOUT', 60))   # seconds
+settings.TRANSPORT = os.getenv('TRANSPORT', 'tornado')     # or 'callback'
+settings.LOG_QUEUE = os.getenv('LOG_QUEUE', '1') == '1'     # write logs from a background thread
+settings.LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 100000))    # records, excess ones are dropped
+settings.LOG_SAMPLING = os.getenv('LOG_SAMPLING', '')   # e.g. incoming=1/100,sack=off,published=10/s
+settings.METRICS_PORT = int(os.getenv('METRICS_PORT', 0))   # 0 - off, worker N serves on METRICS_PORT + N
+settings.METRICS_ADDRESS = os.getenv('METRICS_ADDRESS', '127.0.0.1')
+settings.PROFILE_DIR = os.getenv('PROFILE_DIR', rel('..', 'profiles'))
+settings.PROFILE_SECONDS = float(os.getenv('PROFILE_SECONDS', 30))
+settings.PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', 0.005))    # seconds of CPU time between samples
+settings.CAPTURE = os.getenv('CAPTURE', '0') == '1'   # record traffic of the sessions from the start
+settings.CAPTURE_DIR = os.getenv('CAPTURE_DIR', rel('..', 'captures'))
+settings.CAPTURE_MAX_BYTES = int(os.getenv('CAPTURE_MAX_BYTES', 1024 * 1024 * 1024))   # capture stops at this size
+settings.CAPTURE_QUEUE_SIZE = int(os.getenv('CAPTURE_QUEUE_SIZE', 100000))    # records, excess ones are dropped
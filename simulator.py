@@ -0,0 +1,457 @@
+r"""Fleet of simulated GV500 trackers for load testing the server.
+
+Every device keeps a TCP connection to the server like a real tracker:
+answers AT+GTRTO with +ACK and +RESP:GTVER, acks configuration commands,
+sends FRI/OBD/STT/INF reports at the given rates and +ACK:GTHBD
+heartbeats, and checks the SACKs the server sends back. A device that
+reconnects first sends reports it buffered while offline as +BUFF:
+
+    python simulator.py [--host 127.0.0.1] [--port 9002] [--devices 100]
+                        [--rates FRI=1,OBD=0.2,STT=0.05,INF=0.01]
+                        [--heartbeat 60] [--duration 30]
+                        [--reconnect-every 0] [--offline 5]
+                        [--processes 1] [--server-pid PID ...]
+
+Rates are reports per second of one device. The report gives achieved
+frames per second against the target, SACK and verification latency
+percentiles and, with `--server-pid`, frames per CPU second of the
+server processes, that is capacity of the server per core."""
+import os
+import sys
+import time
+import random
+import socket
+import argparse
+import functools
+import multiprocessing
+from collections import defaultdict, deque
+
+from tornado import ioloop, iostream
+
+from protocol import FrameSplitter
+from memory_bench import raise_fd_limit
+from transport_bench import imei
+import conf
+
+REPORTS = {
+    conf.FIXED_REPORT:
+        '%(type)s:GTFRI,1F0106,%(imei)s,,gv500,0,0,1,1,4.3,92,70.0,'
+        '121.354335,31.222073,%(time)s,0460,0000,18d8,6141,00,2000.0,'
+        '12345:12:34,,,80,210100,,,,%(time)s,%(count)04X$',
+    conf.OBD_REPORT:
+        '%(type)s:GTOBD,1F0106,%(imei)s,,gv500,0,70FFFF,,1,11814,983A8140,'
+        '836,0,88,Inf,,1,0,1,0300,12,27,,0,0.0,316,843.0,76.862894,'
+        '43.226609,%(time)s,0401,0001,08DE,9707,00,0.0,%(time)s,'
+        '%(count)04X$',
+    conf.MOTION_STATE_REPORT:
+        '%(type)s:GTSTT,1F0106,%(imei)s,,gv500,41,1,4.3,92,70.0,'
+        '121.354335,31.222073,%(time)s,0460,0000,18d8,6141,00,%(time)s,'
+        '%(count)04X$',
+    conf.DEVICE_INFORMATION_REPORT:
+        '%(type)s:GTINF,1F0106,%(imei)s,,gv500,21,89701010050664113980,16,'
+        '0,1,12300,,4.10,0,1,,,%(time)s,,,,,,+0800,0,%(time)s,'
+        '%(count)04X$',
+}
+VER = ('+RESP:GTVER,1F0106,%(imei)s,,gv500,A1,0102,0201,%(time)s,'
+       '%(count)04X$')
+HEARTBEAT = '+ACK:GTHBD,1F0106,%(imei)s,gv500,%(time)s,%(count)04X$'
+RTO_ACK = ('+ACK:GTRTO,1F0106,%(imei)s,gv500,%(sub_cmd)s,%(serial)s,'
+           '%(time)s,%(count)04X$')
+COMMAND_ACK = ('+ACK:GT%(cmd)s,1F0106,%(imei)s,gv500,%(serial)s,%(time)s,'
+               '%(count)04X$')
+RTO_SUB_CMDS = {str(conf.RTO_VER): 'VER'}
+PERCENTILES = (50, 90, 99, 99.9)
+CLOCK_TICKS = float(os.sysconf('SC_CLK_TCK'))
+
+
+def parse_rates(spec):
+    r"""'FRI=1,OBD=0.2' -> {'FRI': 1.0, 'OBD': 0.2}"""
+    rates = {}
+    for item in filter(None, spec.split(',')):
+        header, rate = item.split('=', 1)
+        if header not in REPORTS:
+            raise ValueError("Unknown report %s, expected one of %s" % (
+                header, ', '.join(sorted(REPORTS))))
+        rates[header] = float(rate)
+    return rates
+
+
+def percentile(values, pct):
+    r"""Nearest rank percentile of sorted `values`."""
+    if not values:
+        return 0.0
+    rank = int(round(pct / 100.0 * len(values) + 0.5)) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def cpu_seconds(pids):
+    r"""User and system CPU time the processes have used."""
+    total = 0.0
+    for pid in pids:
+        with open('/proc/%d/stat' % pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        total += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    return total
+
+
+class Clock(object):
+
+    r"""UTC timestamp of the protocol, formatted once a second."""
+
+    def __init__(self):
+        self.second = None
+        self.value = None
+
+    def now(self):
+        second = int(time.time())
+        if second != self.second:
+            self.second = second
+            self.value = time.strftime('%Y%m%d%H%M%S', time.gmtime(second))
+        return self.value
+
+
+class Device(object):
+
+    r"""Simulated tracker. Reports keep coming while it is offline, they
+    are buffered (up to `buffer_size`) and sent as +BUFF on reconnect."""
+
+    def __init__(self, fleet, unique_id):
+        self.fleet = fleet
+        self.io_loop = fleet.io_loop
+        self.unique_id = unique_id
+        self.count = random.randrange(0x10000)
+        self.stream = None
+        self.splitter = None
+        self.connected_at = None
+        self.verified = False
+        self.leaving = False
+        self.unacked = {}       # (header, count) -> sent at
+        self.buffered = deque(maxlen=fleet.buffer_size)
+        self.heartbeat_timer = None
+        self.reporting = False
+
+    def next_count(self):
+        self.count = (self.count + 1) % 0x10000
+        return self.count
+
+    def frame(self, template, **kwargs):
+        kwargs.update(imei=self.unique_id, time=self.fleet.clock.now(),
+                      count=self.next_count())
+        return template % kwargs
+
+    def is_connected(self):
+        return self.connected_at is not None and not self.stream.closed()
+
+    def connect(self):
+        self.leaving = False
+        self.stream = iostream.IOStream(socket.socket(), io_loop=self.io_loop)
+        self.stream.set_close_callback(self.on_close)
+        self.stream.connect(self.fleet.address, self.on_connect)
+
+    def on_connect(self):
+        self.connected_at = self.io_loop.time()
+        self.verified = False
+        self.splitter = FrameSplitter()
+        self.fleet.stats['connects'] += 1
+        # the first frame tells the server who is there
+        self.send_heartbeat()
+        if not self.reporting:
+            self.reporting = True
+            self.fleet.start_reports(self)
+        while self.buffered:
+            self.write(self.buffered.popleft(), 'buffered')
+        self.stream.read_until_close(lambda data: None,
+                                     streaming_callback=self.on_data)
+        self.heartbeat_timer = ioloop.PeriodicCallback(
+            self.send_heartbeat, self.fleet.heartbeat * 1000,
+            io_loop=self.io_loop)
+        self.heartbeat_timer.start()
+        if self.fleet.reconnect_every:
+            self.io_loop.add_timeout(
+                self.io_loop.time() + random.expovariate(
+                    1.0 / self.fleet.reconnect_every), self.leave)
+
+    def leave(self):
+        r"""Drops the connection as a tracker losing coverage does."""
+        if self.is_connected():
+            self.leaving = True
+            self.stream.close()
+
+    def on_close(self):
+        if self.connected_at is None:
+            self.fleet.stats['connect_failures'] += 1
+        elif not self.leaving:
+            self.fleet.stats['dropped_by_server'] += 1
+        if self.heartbeat_timer is not None:
+            self.heartbeat_timer.stop()
+            self.heartbeat_timer = None
+        if not self.leaving:
+            # the server dropped the connection before acking
+            self.fleet.stats['missing_sacks'] += len(self.unacked)
+        self.stream = self.connected_at = None
+        self.unacked.clear()
+        if not self.fleet.stopping:
+            self.io_loop.add_timeout(
+                self.io_loop.time() + self.fleet.offline, self.connect)
+
+    def write(self, frame, kind):
+        self.fleet.stats['sent_' + kind] += 1
+        self.fleet.stats['bytes_sent'] += len(frame)
+        self.stream.write(frame)
+
+    def send_report(self, header):
+        if self.is_connected():
+            frame = self.frame(REPORTS[header], type='+RESP')
+            if self.fleet.report_sacks:
+                self.unacked[header, frame[-5:-1]] = self.io_loop.time()
+            self.write(frame, header)
+        else:
+            self.buffered.append(self.frame(REPORTS[header], type='+BUFF'))
+
+    def send_heartbeat(self):
+        if self.is_connected():
+            frame = self.frame(HEARTBEAT)
+            self.unacked[conf.HEARTBEAT_ACK, frame[-5:-1]] = \
+                self.io_loop.time()
+            self.write(frame, conf.HEARTBEAT_ACK)
+
+    def on_data(self, data):
+        for frame in self.splitter.feed(data):
+            if frame.startswith(conf.SACK):
+                self.on_sack(frame)
+            elif frame.startswith(conf.COMMAND):
+                self.on_command(frame)
+            else:
+                self.fleet.stats['unknown_frames'] += 1
+
+    def on_sack(self, frame):
+        r"""+SACK:GTHBD=1F0106,00A1$ - header and count number of the
+        frame it acks."""
+        header, params = frame[len(conf.SACK):-1], ''
+        if len(header) > 4 and header[3] in '=,':
+            header, params = header[:3], header[4:]
+        sent_at = self.unacked.pop((header, params.split(',')[-1]), None)
+        if sent_at is None:
+            self.fleet.stats['bad_sacks'] += 1
+            return
+        self.fleet.stats['sacks'] += 1
+        self.fleet.latencies['sack'].append(self.io_loop.time() - sent_at)
+
+    def on_command(self, frame):
+        cmd = frame[len(conf.COMMAND):len(conf.COMMAND) + 3]
+        params = frame[len(conf.COMMAND) + 4:-1].split(',')
+        self.fleet.stats['commands'] += 1
+        if cmd == conf.RTO_CMD:
+            sub_cmd = RTO_SUB_CMDS.get(params[1], params[1])
+            self.write(self.frame(RTO_ACK, sub_cmd=sub_cmd,
+                                  serial=params[-1]), 'ack')
+            if sub_cmd == 'VER':
+                self.write(self.frame(VER), conf.VER_REPORT)
+                if not self.verified:
+                    self.verified = True
+                    self.fleet.latencies['verify'].append(
+                        self.io_loop.time() - self.connected_at)
+        else:
+            self.write(self.frame(COMMAND_ACK, cmd=cmd, serial=params[-1]),
+                       'ack')
+
+
+class Fleet(object):
+
+    r"""Devices of one simulator process on one IOLoop. Reports of a
+    device are spread evenly at the sum of `rates`, each one picked
+    by its share of the sum."""
+
+    def __init__(self, address, unique_ids, rates, heartbeat=60,
+                 reconnect_every=0, offline=5, buffer_size=1000,
+                 report_sacks=False, sack_timeout=10, connect_rate=500,
+                 io_loop=None):
+        self.io_loop = io_loop or ioloop.IOLoop.current()
+        self.address = address
+        self.rates = rates
+        self.heartbeat = heartbeat
+        self.reconnect_every = reconnect_every
+        self.offline = offline
+        self.buffer_size = buffer_size
+        self.report_sacks = report_sacks
+        self.sack_timeout = sack_timeout
+        self.connect_rate = connect_rate
+        self.clock = Clock()
+        self.devices = [Device(self, unique_id) for unique_id in unique_ids]
+        self.stats = defaultdict(int)
+        self.latencies = defaultdict(list)
+        self.stopping = False
+        total = sum(rates.itervalues())
+        self.interval = 1.0 / total if total else None
+        self.choices = []       # (cumulative share, header)
+        share = 0.0
+        for header, rate in sorted(rates.items()):
+            share += rate / total if total else 0
+            self.choices.append((share, header))
+
+    def start(self):
+        now = self.io_loop.time()
+        for i, device in enumerate(self.devices):
+            self.io_loop.add_timeout(now + i / float(self.connect_rate),
+                                     device.connect)
+
+    def start_reports(self, device):
+        if self.interval is not None:
+            self.io_loop.add_timeout(
+                self.io_loop.time() + random.uniform(0, self.interval),
+                functools.partial(self.on_report_due, device))
+
+    def on_report_due(self, device):
+        if self.stopping:
+            return
+        point = random.random()
+        for share, header in self.choices:
+            if point < share:
+                break
+        device.send_report(header)
+        self.io_loop.add_timeout(self.io_loop.time() + self.interval,
+                                 functools.partial(self.on_report_due,
+                                                   device))
+
+    def stop(self):
+        r"""Closes connections. SACKs still awaited are missing if they
+        are late by `sack_timeout`, pending otherwise."""
+        self.stopping = True
+        deadline = self.io_loop.time() - self.sack_timeout
+        for device in self.devices:
+            for sent_at in device.unacked.itervalues():
+                if sent_at < deadline:
+                    self.stats['missing_sacks'] += 1
+                else:
+                    self.stats['pending_sacks'] += 1
+            device.unacked.clear()
+            if device.stream is not None:
+                device.leaving = True
+                device.stream.close()
+
+
+def simulate(args, unique_ids, control):
+    r"""Simulator process. Runs its devices for `args.duration` seconds
+    and sends (stats, latencies, connected devices)."""
+    raise_fd_limit()
+    random.seed()
+    io_loop = ioloop.IOLoop()
+    fleet = Fleet((args.host, args.port), unique_ids,
+                  parse_rates(args.rates), heartbeat=args.heartbeat,
+                  reconnect_every=args.reconnect_every, offline=args.offline,
+                  report_sacks=args.report_sacks,
+                  sack_timeout=args.sack_timeout,
+                  connect_rate=float(args.connect_rate) / args.processes,
+                  io_loop=io_loop)
+    control.recv()
+    fleet.start()
+    io_loop.add_timeout(io_loop.time() + args.duration, io_loop.stop)
+    io_loop.start()
+    connected = sum(1 for device in fleet.devices if device.is_connected())
+    fleet.stop()
+    control.send((dict(fleet.stats), dict(fleet.latencies), connected))
+
+
+def run(args):
+    r"""Returns (stats, {kind: sorted latencies}, connected devices,
+    wall seconds, server CPU seconds)."""
+    ids = [imei(args.imei_offset + n) for n in xrange(args.devices)]
+    workers = []
+    for i in xrange(args.processes):
+        control, child = multiprocessing.Pipe()
+        worker = multiprocessing.Process(
+            target=simulate, args=(args, ids[i::args.processes], child))
+        worker.start()
+        workers.append((worker, control))
+    cpu = cpu_seconds(args.server_pid)
+    started = time.time()
+    for worker, control in workers:
+        control.send('go')
+    stats, latencies, connected = defaultdict(int), defaultdict(list), 0
+    for worker, control in workers:
+        worker_stats, worker_latencies, worker_connected = control.recv()
+        for key, value in worker_stats.iteritems():
+            stats[key] += value
+        for kind, values in worker_latencies.iteritems():
+            latencies[kind].extend(values)
+        connected += worker_connected
+        worker.join()
+    wall = time.time() - started
+    cpu = cpu_seconds(args.server_pid) - cpu
+    for values in latencies.itervalues():
+        values.sort()
+    return stats, latencies, connected, wall, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9002)
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--rates', default='FRI=1,OBD=0.2,STT=0.05,INF=0.01',
+                        help="reports per second of one device")
+    parser.add_argument('--heartbeat', type=float, default=60,
+                        help="seconds between heartbeats")
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--connect-rate', type=float, default=500,
+                        help="new connections per second")
+    parser.add_argument('--reconnect-every', type=float, default=0,
+                        help="mean seconds between reconnects of a device")
+    parser.add_argument('--offline', type=float, default=5,
+                        help="seconds a device stays offline")
+    parser.add_argument('--report-sacks', action='store_true',
+                        help="expect SACKs of reports (sack_enable)")
+    parser.add_argument('--sack-timeout', type=float, default=10,
+                        help="seconds after which a SACK is missing")
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--imei-offset', type=int, default=0)
+    parser.add_argument('--server-pid', type=int, nargs='*', default=[],
+                        help="processes of the server to take CPU time of")
+    args = parser.parse_args()
+    rates = parse_rates(args.rates)
+    limit = raise_fd_limit()
+    if args.devices / args.processes + 64 > limit:
+        sys.exit("Open files limit %d is too low for %d devices" % (
+            limit, args.devices))
+    stats, latencies, connected, wall, cpu = run(args)
+
+    reports = sum(stats['sent_' + header] for header in REPORTS)
+    frames = reports + stats['sent_buffered'] + stats['sent_ack'] + \
+        stats['sent_' + conf.VER_REPORT] + stats['sent_' + conf.HEARTBEAT_ACK]
+    print '%d devices, %d connected at the end, %.1fs' % (
+        args.devices, connected, wall)
+    print '%-10s %12s %12s' % ('frames', 'per second', 'target')
+    for header in sorted(REPORTS):
+        print '  %-8s %12.1f %12.1f' % (
+            header, stats['sent_' + header] / wall,
+            rates.get(header, 0) * args.devices)
+    print '  %-8s %12.1f' % ('buffered', stats['sent_buffered'] / wall)
+    print '  %-8s %12.1f %12.1f' % (
+        'reports', (reports + stats['sent_buffered']) / wall,
+        sum(rates.values()) * args.devices)
+    for kind in (conf.HEARTBEAT_ACK, 'ack', conf.VER_REPORT):
+        print '  %-8s %12.1f' % (kind, stats['sent_' + kind] / wall)
+    print '  %-8s %12.1f' % ('total', frames / wall)
+    print 'connects %d, failed %d, dropped by server %d, commands %d' % (
+        stats['connects'], stats['connect_failures'],
+        stats['dropped_by_server'], stats['commands'])
+    print 'sacks %d, bad %d, missing %d, pending %d, unknown frames %d' % (
+        stats['sacks'], stats['bad_sacks'], stats['missing_sacks'],
+        stats['pending_sacks'], stats['unknown_frames'])
+    print '%-10s %8s' % ('latency', 'count') + ''.join(
+        '%9s' % ('p%g' % pct) for pct in PERCENTILES) + '%9s' % 'max'
+    for kind in ('sack', 'verify'):
+        values = latencies.get(kind, [])
+        print '  %-8s %8d' % (kind, len(values)) + ''.join(
+            '%7.1fms' % (percentile(values, pct) * 1000)
+            for pct in PERCENTILES) + '%7.1fms' % (
+            (values[-1] if values else 0) * 1000)
+    if args.server_pid:
+        print 'server CPU %.2fs of %.1fs, %.0f frames per CPU second' % (
+            cpu, wall, frames / cpu if cpu else float('inf'))
+    if stats['bad_sacks'] or stats['unknown_frames']:
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
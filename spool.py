@@ -0,0 +1,335 @@
+import os
+import time
+import threading
+
+from commons.protocol import dump_msg, load_msg
+from logger import gen_log, QueueWriter
+from settings import settings
+
+__all__ = ['Spool', 'SpoolDrainer', 'SpoolWriter']
+
+FSYNC_ALWAYS = 'always'
+FSYNC_INTERVAL = 'interval'
+FSYNC_NEVER = 'never'
+
+SEGMENT_EXT = '.seg'
+CURSOR_FILE = 'cursor'
+
+
+class Spool(object):
+
+    r"""Append-only on-disk spool of records for lagging sinks.
+
+    Records are dicts encoded with `dump_msg`, one per line, into numbered
+    segment files. A segment is rotated after `segment_size` bytes, the
+    oldest segments are deleted when the spool outgrows `max_bytes`.
+    Reading position is kept in a cursor file, it is moved by `commit`
+    once the sinks have the records, so replay survives restarts (a
+    record may be replayed twice, never lost).
+
+    fsync policy:
+        always   - after every append
+        interval - at most once per `fsync_interval` seconds
+        never    - left to the OS
+
+    `append` blocks on the disk and on the drainer. The IOLoop uses `put`
+    instead, records are appended by `SpoolWriter` thread and the ones
+    over `queue_size` queued are dropped and counted.
+    """
+
+    def __init__(self, path, segment_size=8 * 1024 * 1024,
+                 max_bytes=1024 * 1024 * 1024, fsync=FSYNC_INTERVAL,
+                 fsync_interval=1.0, queue_size=100000):
+        assert fsync in (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER)
+        self.path = path
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._fd = None
+        self._synced_at = 0
+        self.drainer = None
+        self.writer = None
+        self.appended = 0
+        self.dropped = 0
+        self.replayed = 0
+        self.dropped_segments = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._segments = sorted(
+            int(name[:-len(SEGMENT_EXT)]) for name in os.listdir(path)
+            if name.endswith(SEGMENT_EXT))
+        self._sizes = dict((seq, os.path.getsize(self.segment_path(seq)))
+                           for seq in self._segments)
+        self._cursor = self.load_cursor()
+
+    @classmethod
+    def instance(cls):
+        """Singleton like accessor to instantiate spool object"""
+        if not hasattr(cls, "_instance"):
+            cls._instance = cls(settings.SPOOL_DIR,
+                                segment_size=settings.SPOOL_SEGMENT_SIZE,
+                                max_bytes=settings.SPOOL_MAX_BYTES,
+                                fsync=settings.SPOOL_FSYNC,
+                                fsync_interval=settings.SPOOL_FSYNC_INTERVAL,
+                                queue_size=settings.SPOOL_QUEUE_SIZE)
+        return cls._instance
+
+    @classmethod
+    def shutdown(cls):
+        if hasattr(cls, "_instance"):
+            cls._instance.close()
+
+    def start_drainer(self, replay, is_ready, rate=500, flush=None):
+        self.drainer = SpoolDrainer(self, replay, is_ready, rate=rate,
+                                    flush=flush)
+        self.drainer.start()
+        return self.drainer
+
+    def segment_path(self, seq):
+        return os.path.join(self.path, '%012d%s' % (seq, SEGMENT_EXT))
+
+    def load_cursor(self):
+        try:
+            with open(os.path.join(self.path, CURSOR_FILE)) as f:
+                seq, offset = f.read().split()
+            return int(seq), int(offset)
+        except (IOError, ValueError):
+            return (self._segments[0] if self._segments else 0), 0
+
+    def save_cursor(self):
+        tmp = os.path.join(self.path, CURSOR_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            f.write('%d %d' % self._cursor)
+        os.rename(tmp, os.path.join(self.path, CURSOR_FILE))
+
+    def size(self):
+        return sum(self._sizes.values())
+
+    def __len__(self):
+        r"""Number of segments waiting for replay."""
+        return len(self._segments)
+
+    def put(self, record):
+        r"""Queues record for `SpoolWriter`, never blocks. Returns False
+        if the record was dropped."""
+        if self.writer is None:
+            self.writer = SpoolWriter(self)
+            self.writer.start()
+        if len(self.writer.queue) >= self.queue_size:
+            self.dropped += 1
+            return False
+        self.writer.put(record)
+        return True
+
+    def append(self, record):
+        line = dump_msg(record) + '\n'
+        with self._lock:
+            if self._fd is None or \
+                    self._sizes[self._segments[-1]] >= self.segment_size:
+                self.rotate()
+            self._fd.write(line)
+            self._sizes[self._segments[-1]] += len(line)
+            self.appended += 1
+            if self.fsync == FSYNC_ALWAYS:
+                self.sync()
+            elif self.fsync == FSYNC_INTERVAL and \
+                    time.time() - self._synced_at >= self.fsync_interval:
+                self.sync()
+
+    def rotate(self):
+        r"""Closes active segment and opens the next one. Called under
+        lock."""
+        if self._fd is not None:
+            self.sync()
+            self._fd.close()
+            self._fd = None
+        seq = self._segments[-1] + 1 if self._segments else 1
+        self._segments.append(seq)
+        self._sizes[seq] = 0
+        self._fd = open(self.segment_path(seq), 'ab')
+        self.enforce_budget()
+
+    def enforce_budget(self):
+        while len(self._segments) > 1 and self.size() > self.max_bytes:
+            seq = self._segments.pop(0)
+            self._sizes.pop(seq)
+            os.remove(self.segment_path(seq))
+            self.dropped_segments += 1
+            gen_log.warning("spool is over budget, dropped segment %d", seq)
+            if self._cursor[0] <= seq:
+                self._cursor = (self._segments[0], 0)
+
+    def sync(self):
+        if self._fd is not None:
+            self._fd.flush()
+            if self.fsync != FSYNC_NEVER:
+                os.fsync(self._fd.fileno())
+        self._synced_at = time.time()
+
+    def read(self, limit):
+        r"""Reads up to `limit` records from the cursor on. The cursor
+        stays, records are acked by `commit`.
+        Returns:
+            [(record, cursor after it)], record is None for a broken line
+            or the end of a segment
+        """
+        with self._lock:
+            if not self._segments:
+                return []
+            seq, offset = self._cursor
+            if seq not in self._sizes:
+                seq, offset = self._segments[0], 0
+            if seq == self._segments[-1] and self._fd is not None:
+                if offset >= self._sizes[seq]:
+                    return []
+                # never read the segment that is still appended to
+                self.rotate()
+            size = self._sizes[seq]
+            index = self._segments.index(seq)
+            following = self._segments[index + 1] \
+                if index + 1 < len(self._segments) else seq + 1
+        entries = []
+        with open(self.segment_path(seq), 'rb') as f:
+            f.seek(offset)
+            while len(entries) < limit:
+                line = f.readline()
+                if not line.endswith('\n'):
+                    # end of segment or record truncated by a crash
+                    offset = size
+                    break
+                offset += len(line)
+                try:
+                    record = load_msg(line[:-1])
+                except Exception as e:
+                    gen_log.warning("skipped broken spool record %s", e)
+                    record = None
+                entries.append((record, (seq, offset)))
+        if offset >= size:
+            # the segment is read through, acking the last record removes it
+            if entries:
+                entries[-1] = (entries[-1][0], (following, 0))
+            else:
+                entries.append((None, (following, 0)))
+        return entries
+
+    def commit(self, cursor, replayed=0):
+        r"""Acks records read up to `cursor`, removes the segments that
+        have been replayed."""
+        with self._lock:
+            while self._segments and self._segments[0] < cursor[0] and \
+                    not (self._segments[0] == self._segments[-1] and
+                         self._fd is not None):
+                seq = self._segments.pop(0)
+                self._sizes.pop(seq)
+                os.remove(self.segment_path(seq))
+            self._cursor = cursor
+            self.save_cursor()
+            self.replayed += replayed
+
+    def stop_drainer(self):
+        if self.drainer is not None:
+            self.drainer.stop()
+            self.drainer = None
+
+    def close(self):
+        self.stop_drainer()
+        if self.writer is not None:
+            self.writer.stop()
+            self.writer = None
+        with self._lock:
+            if self._fd is not None:
+                self.sync()
+                self._fd.close()
+                self._fd = None
+
+    def stats(self):
+        writer = self.writer
+        return {'segments': len(self._segments),
+                'bytes': self.size(),
+                'queued': len(writer.queue) if writer is not None else 0,
+                'appended': self.appended,
+                'dropped': self.dropped,
+                'failed': writer.failed if writer is not None else 0,
+                'replayed': self.replayed,
+                'dropped_segments': self.dropped_segments}
+
+
+class SpoolWriter(QueueWriter):
+
+    r"""Appends records put on the IOLoop to the spool."""
+
+    def __init__(self, spool):
+        super(SpoolWriter, self).__init__({})
+        self.name = 'spool-writer'
+        self.spool = spool
+        self.failed = 0
+
+    def write(self, record):
+        try:
+            self.spool.append(record)
+        except Exception as e:
+            self.failed += 1
+            gen_log.warning("failed to spool record %s", e)
+        self.written += 1
+
+
+class SpoolDrainer(threading.Thread):
+
+    r"""Replays spooled records into sinks at `rate` records per second
+    while `is_ready()` says the sinks have recovered.
+
+    Replayed records are acked only after `flush()` has written them to
+    the sinks, a record whose replay failed and the ones after it are
+    replayed again in the next round."""
+
+    def __init__(self, spool, replay, is_ready, rate=500, interval=0.1,
+                 flush=None):
+        super(SpoolDrainer, self).__init__(name='spool-drainer')
+        self.daemon = True
+        self.spool = spool
+        self.replay = replay
+        self.is_ready = is_ready
+        self.flush = flush
+        self.rate = rate
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        batch_size = max(int(self.rate * self.interval), 1)
+        while not self.stopped.is_set():
+            started = time.time()
+            if self.is_ready():
+                self.drain(batch_size)
+            self.stopped.wait(max(self.interval - (time.time() - started), 0))
+
+    def drain(self, limit):
+        try:
+            entries = self.spool.read(limit)
+        except Exception as e:
+            gen_log.warning("failed to read spool %s", e)
+            return
+        cursor, replayed = None, 0
+        for record, position in entries:
+            if record is not None:
+                try:
+                    self.replay(record)
+                except Exception as e:
+                    gen_log.warning("failed to replay spool record %s", e)
+                    break
+                replayed += 1
+            cursor = position
+        if cursor is None:
+            return
+        try:
+            if self.flush is not None:
+                self.flush()
+            self.spool.commit(cursor, replayed)
+        except Exception as e:
+            gen_log.warning("failed to ack replayed spool records %s", e)
+
+    def stop(self, timeout=None):
+        self.stopped.set()
+        self.join(timeout)
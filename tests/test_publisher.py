@@ -0,0 +1,127 @@
+import time
+import collections
+import unittest
+
+from publisher import IoTPublisher, LocalClient
+
+
+class Broker(LocalClient):
+
+    r"""`LocalClient` with events and outage reset by every test."""
+
+    events = None
+    online = True
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise AssertionError("Timed out waiting for %s" % predicate)
+        time.sleep(0.01)
+
+
+class IoTPublisherTest(unittest.TestCase):
+
+    def setUp(self):
+        Broker.events = collections.deque()
+        Broker.online = True
+        self.publisher = None
+
+    def tearDown(self):
+        Broker.online = True
+        if self.publisher is not None:
+            self.publisher.stop(timeout=5)
+
+    def make_publisher(self, **kw):
+        kw.setdefault('min_backoff', 0.01)
+        kw.setdefault('max_backoff', 0.04)
+        self.publisher = IoTPublisher(client_factory=Broker, **kw)
+        return self.publisher
+
+    def publish(self, publisher, count, start=0):
+        return [publisher.publish('log', 'json', {'n': n})
+                for n in range(start, start + count)]
+
+    def published(self):
+        return [data['n'] for _, _, data in Broker.events]
+
+    def test_batches(self):
+        publisher = self.make_publisher(batch_size=2)
+        self.publish(publisher, 5)
+        self.assertEqual([len(publisher.take_batch()) for _ in range(3)],
+                         [2, 2, 1])
+
+    def test_publishes_in_order_over_one_connection(self):
+        publisher = self.make_publisher(batch_size=3)
+        self.publish(publisher, 10)
+        publisher.start()
+        wait_for(lambda: publisher.published == 10)
+        self.assertEqual(self.published(), range(10))
+        self.assertEqual(publisher.connects, 1)
+        self.assertEqual(publisher.stats()['connected'], 1)
+
+    def test_reconnects_with_backoff(self):
+        Broker.online = False
+        publisher = self.make_publisher()
+        publisher.start()
+        self.publish(publisher, 3)
+        worker = publisher.workers[0]
+        wait_for(lambda: worker.backoff == publisher.max_backoff)
+        self.assertEqual(publisher.connects, 0)
+        self.assertEqual(publisher.published, 0)
+
+        Broker.online = True
+        wait_for(lambda: publisher.published == 3)
+        self.assertEqual(self.published(), [0, 1, 2])
+        self.assertEqual(publisher.connects, 1)
+        self.assertEqual(worker.backoff, 0)
+
+    def test_broker_lost_while_connected(self):
+        publisher = self.make_publisher()
+        publisher.start()
+        self.publish(publisher, 2)
+        wait_for(lambda: publisher.published == 2)
+
+        Broker.online = False
+        self.publish(publisher, 2, start=2)
+        wait_for(lambda: publisher.workers[0].backoff > 0)
+        Broker.online = True
+        wait_for(lambda: publisher.published == 4)
+        self.assertEqual(self.published(), [0, 1, 2, 3])
+        self.assertEqual(publisher.connects, 2)
+
+    def test_full_queue_drops_oldest(self):
+        publisher = self.make_publisher(max_queue=3)
+        self.assertEqual(self.publish(publisher, 5),
+                         [True, True, True, False, False])
+        self.assertTrue(publisher.is_full())
+        self.assertEqual(publisher.dropped, 2)
+
+        publisher.start()
+        wait_for(lambda: publisher.published == 3)
+        self.assertEqual(self.published(), [2, 3, 4])
+
+    def test_stop_drains_queue(self):
+        publisher = self.make_publisher(batch_size=2)
+        publisher.start()
+        self.publish(publisher, 7)
+        publisher.stop(timeout=5)
+        self.assertEqual(self.published(), range(7))
+        self.assertEqual(publisher.stats()['connected'], 0)
+
+    def test_stop_while_offline_drops_pending(self):
+        Broker.online = False
+        publisher = self.make_publisher()
+        publisher.start()
+        self.publish(publisher, 2)
+        workers = list(publisher.workers)
+        wait_for(lambda: workers[0].backoff > 0)
+        publisher.stop(timeout=5)
+        self.assertFalse(any(worker.is_alive() for worker in workers))
+        self.assertEqual(publisher.published, 0)
+        self.assertEqual(publisher.dropped, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
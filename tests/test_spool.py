@@ -0,0 +1,102 @@
+import shutil
+import tempfile
+import unittest
+
+from spool import Spool, SpoolDrainer, FSYNC_NEVER
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.spool = self.open_spool()
+        self.replayed = []
+        self.fail_at = None
+        self.flushed = 0
+
+    def tearDown(self):
+        self.spool.close()
+        shutil.rmtree(self.path)
+
+    def open_spool(self):
+        return Spool(self.path, fsync=FSYNC_NEVER)
+
+    def fill(self, count):
+        for n in range(count):
+            self.spool.append({'n': n})
+
+    def replay(self, record):
+        if record['n'] == self.fail_at:
+            raise IOError("sink is down")
+        self.replayed.append(record['n'])
+
+    def flush(self):
+        self.flushed += 1
+
+    def drainer(self):
+        return SpoolDrainer(self.spool, self.replay, lambda: True,
+                            flush=self.flush)
+
+    def test_read_does_not_ack(self):
+        self.fill(5)
+        self.assertEqual([record['n'] for record, _ in self.spool.read(3)],
+                         [0, 1, 2])
+        self.spool.close()
+        self.spool = self.open_spool()
+        self.assertEqual(self.spool.read(1)[0][0], {'n': 0})
+
+    def test_commit_survives_restart(self):
+        self.fill(5)
+        entries = self.spool.read(3)
+        self.spool.commit(entries[-1][1], len(entries))
+        self.spool.close()
+        self.spool = self.open_spool()
+        self.assertEqual([record['n'] for record, _ in self.spool.read(10)],
+                         [3, 4])
+
+    def test_failed_replay_stays_unacked(self):
+        self.fill(5)
+        self.fail_at = 2
+        drainer = self.drainer()
+        drainer.drain(10)
+        self.assertEqual(self.replayed, [0, 1])
+        self.assertEqual(self.flushed, 1)
+        self.assertEqual(self.spool.replayed, 2)
+
+        self.fail_at = None
+        drainer.drain(10)
+        self.assertEqual(self.replayed, [0, 1, 2, 3, 4])
+        self.assertEqual(len(self.spool), 1)
+        drainer.drain(10)
+        self.assertEqual(self.spool.read(10), [])
+
+    def test_failed_flush_acks_nothing(self):
+        self.fill(3)
+
+        def flush():
+            raise IOError("database is down")
+        drainer = self.drainer()
+        drainer.flush = flush
+        drainer.drain(10)
+        self.assertEqual(self.spool.replayed, 0)
+        self.assertEqual([record['n'] for record, _ in self.spool.read(10)],
+                         [0, 1, 2])
+
+    def test_replayed_segment_is_removed(self):
+        self.fill(3)
+        self.drainer().drain(10)
+        self.assertEqual(self.replayed, [0, 1, 2])
+        self.spool.close()
+        self.spool = self.open_spool()
+        # the empty segment opened by the read is acked by the next drain
+        self.assertEqual(len(self.spool), 1)
+        self.drainer().drain(10)
+        self.assertEqual(len(self.spool), 0)
+        self.assertEqual(self.replayed, [0, 1, 2])
+        self.spool.append({'n': 3})
+        self.drainer().drain(10)
+        self.assertEqual(self.replayed, [0, 1, 2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from models import Backend, LogEntry
+from writer import LogWriter
+
+
+def entry(n, **kw):
+    return LogEntry(imei='86425102%07d' % n, latitude=31.222073,
+                    longitude=121.354335, altitude=70.0,
+                    gps_utc_time=1234575174, speed=4.3, **kw)
+
+
+class LogWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.backend = Backend('sqlite:///%s' % os.path.join(self.path,
+                                                             'log.db'))
+
+    def tearDown(self):
+        self.backend.engine.dispose()
+        shutil.rmtree(self.path)
+
+    def rows(self):
+        return [row[0] for row in self.backend.engine.execute(
+            'SELECT imei FROM log_entry ORDER BY imei')]
+
+    def test_writes_in_batches(self):
+        writer = LogWriter(backend=self.backend, batch_size=3)
+        self.assertFalse(writer.use_copy)
+        for n in range(5):
+            writer.add(entry(n))
+        self.assertEqual(len(self.rows()), 3)
+        self.assertEqual(writer.pending(), 2)
+
+        writer.stop()
+        self.assertEqual(self.rows(), ['86425102%07d' % n for n in range(5)])
+        self.assertEqual(writer.stats(), {'pending': 0, 'written': 5,
+                                          'failed': 0, 'spooled': 0,
+                                          'batches': 2})
+
+    def test_bad_row_is_dropped_alone(self):
+        writer = LogWriter(backend=self.backend, batch_size=10)
+        writer.add(entry(0, id='duplicate'))
+        writer.flush()
+
+        writer.add(entry(1))
+        writer.add(entry(2, id='duplicate'))
+        writer.add(entry(3))
+        self.assertEqual(writer.flush(), 2)
+        self.assertEqual(self.rows(), ['86425102%07d' % n
+                                       for n in (0, 1, 3)])
+        self.assertEqual(writer.failed, 1)
+        self.assertEqual(writer.spooled, 0)
+        self.assertTrue(writer.healthy)
+
+    def test_drains_on_stop(self):
+        writer = LogWriter(backend=self.backend, batch_size=10, max_age=60)
+        writer.add(entry(0))
+        writer.add(entry(1))
+        self.assertEqual(self.rows(), [])
+
+        writer.stop()
+        self.assertEqual(len(self.rows()), 2)
+        self.assertEqual(writer.pending(), 0)
+        self.assertEqual(writer.stop(), None)
+        self.assertEqual(writer.batches, 1)
+
+    def test_flushes_expired_rows(self):
+        writer = LogWriter(backend=self.backend, batch_size=10, max_age=0)
+        writer.flush_expired()
+        self.assertEqual(writer.batches, 0)
+        writer.add(entry(0))
+        writer.flush_expired()
+        self.assertEqual(len(self.rows()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import math
+
+from tornado import ioloop
+
+from logger import gen_log
+import conf
+
+__all__ = ['TimingWheel', 'Timer']
+
+
+class Timer(object):
+
+    __slots__ = ('expires', 'callback', 'slot')
+
+    def __init__(self, expires, callback):
+        self.expires = expires
+        self.callback = callback
+        self.slot = None
+
+    def active(self):
+        return self.slot is not None
+
+    def cancel(self):
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+
+
+class TimingWheel(object):
+
+    r"""Hierarchical timing wheel shared by all sessions of the process.
+
+    Time is counted in ticks of `tick` seconds. Level 0 has a slot per
+    tick, every next level has a slot per full turn of the previous one,
+    so with 64 slots and 4 levels timers up to ~194 days are kept in
+    wheels and the rest waits in the overflow set. A timer sits in the
+    slot of the highest digit where its expiry differs from the current
+    tick and moves down a level when that digit comes up.
+    Scheduling and cancelling are O(1), one IOLoop callback per tick
+    drives all timers. Lives on the IOLoop thread only."""
+
+    def __init__(self, tick=1.0, slots=64, levels=4, io_loop=None):
+        assert slots & (slots - 1) == 0, "Slots should be a power of 2"
+        self.tick = tick
+        self.bits = int(math.log(slots, 2))
+        self.mask = slots - 1
+        self.wheels = [[set() for _ in xrange(slots)]
+                       for _ in xrange(levels)]
+        self.overflow = set()
+        self.io_loop = io_loop or ioloop.IOLoop.current()
+        self.started = self.io_loop.time()
+        self.current = 0
+        self.scheduled = 0
+        self.expired = 0
+        self._periodic = None
+
+    @classmethod
+    def instance(cls):
+        """Singleton like accessor to instantiate process timing wheel"""
+        if not hasattr(cls, "_instance"):
+            cls._instance = cls(conf.TIMER_TICK, conf.TIMER_SLOTS,
+                                conf.TIMER_LEVELS)
+            cls._instance.start()
+        return cls._instance
+
+    @classmethod
+    def shutdown(cls):
+        if hasattr(cls, "_instance"):
+            cls._instance.stop()
+            del cls._instance
+
+    def start(self):
+        self._periodic = ioloop.PeriodicCallback(
+            self.on_tick, self.tick * 1000, io_loop=self.io_loop)
+        self._periodic.start()
+
+    def stop(self):
+        if self._periodic is not None:
+            self._periodic.stop()
+            self._periodic = None
+
+    def call_later(self, delay, callback):
+        r"""Calls `callback` in `delay` seconds rounded up to a tick.
+        Returns timer to cancel."""
+        ticks = max(int(math.ceil(delay / self.tick)), 1)
+        timer = Timer(self.current + ticks, callback)
+        self.add(timer)
+        self.scheduled += 1
+        return timer
+
+    def deadline(self, future, timeout, exc_factory):
+        r"""Fails `future` with exception made by `exc_factory` unless it
+        is resolved in `timeout` seconds."""
+
+        def expire():
+            if not future.done():
+                future.set_exception(exc_factory())
+
+        timer = self.call_later(timeout, expire)
+        future.add_done_callback(lambda f: timer.cancel())
+        return timer
+
+    def add(self, timer):
+        for level, wheel in enumerate(self.wheels):
+            shift = self.bits * (level + 1)
+            if timer.expires >> shift == self.current >> shift:
+                slot = wheel[(timer.expires >> (shift - self.bits)) &
+                             self.mask]
+                break
+        else:
+            slot = self.overflow
+        slot.add(timer)
+        timer.slot = slot
+
+    def on_tick(self):
+        target = int((self.io_loop.time() - self.started) / self.tick)
+        while self.current < target:
+            self.advance()
+
+    def advance(self):
+        self.current += 1
+        # move timers down from levels whose lower digits turned zero
+        levels = 0
+        while levels < len(self.wheels) and \
+                not self.current & ((1 << self.bits * (levels + 1)) - 1):
+            levels += 1
+        if levels == len(self.wheels):
+            self.cascade(self.overflow)
+        for level in xrange(min(levels, len(self.wheels) - 1), 0, -1):
+            self.cascade(self.wheels[level][
+                (self.current >> self.bits * level) & self.mask])
+        slot = self.wheels[0][self.current & self.mask]
+        timers = list(slot)
+        slot.clear()
+        for timer in timers:
+            timer.slot = None
+            self.expired += 1
+            try:
+                timer.callback()
+            except Exception as e:
+                gen_log.exception(e)
+
+    def cascade(self, slot):
+        timers = list(slot)
+        slot.clear()
+        for timer in timers:
+            self.add(timer)
+
+    def __len__(self):
+        return sum(len(slot) for wheel in self.wheels for slot in wheel) + \
+            len(self.overflow)
+
+    def stats(self):
+        return {'timers': len(self),
+                'scheduled': self.scheduled,
+                'expired': self.expired}
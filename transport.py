@@ -0,0 +1,159 @@
+import errno
+import socket
+from collections import deque
+
+from tornado import ioloop
+from tornado.iostream import StreamClosedError
+
+from logger import gen_log
+import conf
+
+__all__ = ['SocketTransport', 'TORNADO', 'CALLBACK', 'TRANSPORTS']
+
+TRANSPORTS = (TORNADO, CALLBACK) = ('tornado', 'callback')
+
+_ERRNO_WOULDBLOCK = (errno.EWOULDBLOCK, errno.EAGAIN)
+_ERRNO_INTERRUPTED = (errno.EINTR,)
+
+
+class SocketTransport(object):
+
+    r"""Non-blocking socket driven by IOLoop handler callbacks.
+
+    Works like an asyncio transport: whatever one `recv` returns goes to
+    `protocol.data_received(data)` at once, there is no read buffer, no
+    read Futures and no coroutine on the read path. Reading is paused and
+    resumed by the protocol for flow control. Writes go to the socket
+    right away, the rest is buffered until the socket is writable.
+    Supports the part of IOStream interface sessions use, so it can
+    stand in for IOStream."""
+
+    __slots__ = ('socket', 'io_loop', 'read_chunk_size', 'protocol',
+                 'reading', '_write_buffer', '_events', '_closed',
+                 '_close_callback')
+
+    def __init__(self, sock, io_loop=None, read_chunk_size=None):
+        self.socket = sock
+        self.socket.setblocking(0)
+        self.io_loop = io_loop or ioloop.IOLoop.current()
+        self.read_chunk_size = read_chunk_size or conf.READ_CHUNK_SIZE
+        self.protocol = None
+        self.reading = False
+        self._write_buffer = None   # exists while the socket is behind
+        self._events = None
+        self._closed = False
+        self._close_callback = None
+
+    def start(self, protocol):
+        r"""Starts passing data to `protocol`."""
+        self.protocol = protocol
+        self.resume_reading()
+
+    def pause_reading(self):
+        self.reading = False
+        self._update()
+
+    def resume_reading(self):
+        self.reading = True
+        self._update()
+
+    def set_close_callback(self, callback):
+        self._close_callback = callback
+
+    def closed(self):
+        return self._closed
+
+    def write(self, data):
+        assert isinstance(data, bytes), "Data should be bytes"
+        if self._closed:
+            raise StreamClosedError("Stream is closed")
+        if not self._write_buffer:
+            data = data[self._send(data):]
+        if data:
+            if self._write_buffer is None:
+                self._write_buffer = deque()
+            self._write_buffer.append(data)
+            self._update()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._events is not None:
+            self.io_loop.remove_handler(self.socket.fileno())
+            self._events = None
+        self.socket.close()
+        self._write_buffer = None
+        if self._close_callback is not None:
+            callback, self._close_callback = self._close_callback, None
+            self.io_loop.add_callback(callback)
+
+    def _update(self):
+        if self._closed:
+            return
+        events = self.io_loop.ERROR
+        if self.reading:
+            events |= self.io_loop.READ
+        if self._write_buffer:
+            events |= self.io_loop.WRITE
+        if self._events is None:
+            self.io_loop.add_handler(self.socket.fileno(),
+                                     self._handle_events, events)
+        elif events != self._events:
+            self.io_loop.update_handler(self.socket.fileno(), events)
+        self._events = events
+
+    def _handle_events(self, fd, events):
+        if events & self.io_loop.READ:
+            self._read()
+        if self._closed:
+            return
+        if events & self.io_loop.WRITE:
+            self._flush()
+        if self._closed:
+            return
+        if events & self.io_loop.ERROR:
+            self.close()
+
+    def _read(self):
+        # one recv per event keeps connections of the loop fair, the
+        # level triggered poll comes back for the rest
+        try:
+            data = self.socket.recv(self.read_chunk_size)
+        except socket.error as e:
+            if e.args[0] in _ERRNO_WOULDBLOCK + _ERRNO_INTERRUPTED:
+                return
+            self.close()
+            return
+        if not data:
+            self.close()
+            return
+        try:
+            self.protocol.data_received(data)
+        except Exception as e:
+            gen_log.exception(e)
+            self.close()
+
+    def _send(self, data):
+        try:
+            return self.socket.send(data)
+        except socket.error as e:
+            if e.args[0] in _ERRNO_WOULDBLOCK + _ERRNO_INTERRUPTED:
+                return 0
+            self.close()
+            raise StreamClosedError(str(e))
+
+    def _flush(self):
+        while self._write_buffer:
+            data = self._write_buffer[0]
+            try:
+                sent = self._send(data)
+            except StreamClosedError:
+                return
+            if sent < len(data):
+                self._write_buffer[0] = data[sent:]
+                break
+            self._write_buffer.popleft()
+        if not self._write_buffer:
+            self._write_buffer = None
+        self._update()
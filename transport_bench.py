@@ -0,0 +1,140 @@
+r"""Side by side comparison of session transports.
+
+For every transport a server runs in its own process with sinks left
+out, so the numbers are of socket layer, parsing and session pipeline:
+
+    python transport_bench.py [--connections 500] [--frames 200]
+                              [--transport tornado callback]
+
+Memory is RSS growth of the server process per idle open connection,
+throughput is frames per second of wall time and of server CPU time
+while all connections send their frames at once."""
+import gc
+import sys
+import time
+import socket
+import logging
+import argparse
+import resource
+import multiprocessing
+
+from tornado import gen, ioloop
+
+from settings import settings
+from transport import TRANSPORTS
+
+FRI = ('+RESP:GTFRI,1F0106,%s,,gv500,0,0,1,1,4.3,92,70.0,121.354335,'
+       '31.222073,20090214013254,0460,0000,18d8,6141,00,2000.0,12345:12:34,'
+       ',,80,210100,,,,20090214093254,%04X$')
+PAGE_SIZE = resource.getpagesize()
+
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * PAGE_SIZE
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def imei(n):
+    return '86425102%07d' % n
+
+
+def serve(transport, control):
+    r"""Server process. Sends its port, RSS growth per session once
+    all sessions are open, then (wall, cpu) seconds it took to process
+    all frames."""
+    from conn import QueclinkConnection
+    from server import QueclinkServer
+
+    settings.CONFIG_RECONCILE = False
+    counter = {'frames': 0}
+
+    class BenchConnection(QueclinkConnection):
+
+        @gen.coroutine
+        def on_report(self, original_msg, response, sack, from_buffer=False):
+            counter['frames'] += 1
+
+    io_loop = ioloop.IOLoop.instance()
+    server = QueclinkServer(io_loop=io_loop, port=0, transport=transport,
+                            conn=BenchConnection)
+    server.listen(0, '127.0.0.1', backlog=4096)
+    control.send(server._sockets.values()[0].getsockname()[1])
+
+    @gen.coroutine
+    def wait_for(check):
+        while not check():
+            yield gen.Task(io_loop.add_timeout, io_loop.time() + 0.01)
+
+    @gen.coroutine
+    def main():
+        gc.collect()
+        base = rss()
+        count = control.recv()
+        yield wait_for(lambda: len(server.dongles) >= count)
+        yield gen.Task(io_loop.add_timeout, io_loop.time() + 0.5)
+        gc.collect()
+        control.send((rss() - base) / float(count))
+        total = control.recv() + counter['frames']
+        started, cpu = time.time(), cpu_time()
+        control.send('go')
+        yield wait_for(lambda: counter['frames'] >= total)
+        control.send((time.time() - started, cpu_time() - cpu))
+
+    io_loop.run_sync(main)
+
+
+def bench(transport, connections, frames):
+    control, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(transport, child))
+    server.start()
+    port = control.recv()
+    clients = []
+    for n in xrange(connections):
+        sock = socket.create_connection(('127.0.0.1', port))
+        sock.sendall(FRI % (imei(n), 0))
+        clients.append(sock)
+    control.send(connections)
+    per_session = control.recv()
+    payloads = [''.join(FRI % (imei(n), i + 1) for i in xrange(frames))
+                for n in xrange(connections)]
+    control.send(connections * frames)
+    control.recv()
+    for sock, payload in zip(clients, payloads):
+        sock.sendall(payload)
+    wall, cpu = control.recv()
+    for sock in clients:
+        sock.close()
+    server.join()
+    total = connections * frames
+    return {'transport': transport,
+            'rss_per_session': per_session,
+            'frames_per_sec': total / wall,
+            'frames_per_cpu_sec': total / cpu if cpu else float('inf')}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--connections', type=int, default=500)
+    parser.add_argument('--frames', type=int, default=200,
+                        help="frames sent by every connection")
+    parser.add_argument('--transport', nargs='+', choices=TRANSPORTS,
+                        default=list(TRANSPORTS))
+    args = parser.parse_args()
+    # keep per frame logging out of the numbers
+    logging.disable(logging.INFO)
+    print '%-10s %16s %14s %18s' % ('transport', 'RSS/session, KB',
+                                     'frames/s', 'frames/CPU s')
+    for transport in args.transport:
+        result = bench(transport, args.connections, args.frames)
+        print '%-10s %16.1f %14.0f %18.0f' % (
+            transport, result['rss_per_session'] / 1024.,
+            result['frames_per_sec'], result['frames_per_cpu_sec'])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,241 @@
+import time
+import uuid
+import threading
+from datetime import datetime
+from cStringIO import StringIO
+
+import sqlalchemy as sa
+from tornado import ioloop
+
+from executor import SinkExecutor
+from models import Backend, LogEntry
+from spool import Spool
+from metrics import STAGE_SECONDS
+from logger import gen_log
+from settings import settings
+
+__all__ = ['LogWriter']
+
+
+def copy_escape(value):
+    r"""Formats value for PostgreSQL COPY text format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def log_record(row):
+    r"""Spool record of a row. `dt_create` is refilled on replay."""
+    row = dict(row)
+    row.pop('dt_create', None)
+    return {'sink': 'log', 'row': row}
+
+
+class LogWriter(object):
+
+    r"""Process wide batching writer of `LogEntry` rows.
+
+    Rows from all sessions are accumulated in memory and written with a
+    single multi-row insert (COPY on PostgreSQL) when `batch_size` rows
+    are buffered or the oldest row is `max_age` seconds old. If a batch
+    fails, its rows are retried one by one, so a bad row is dropped alone
+    instead of rolling back the whole batch.
+
+    When the database is unreachable rows go to `spool` (if given) and
+    the writer is flagged as not healthy until the next successful write.
+
+    Writes are blocking: `add` is meant to be called from `SinkExecutor`
+    threads and age based flushes are handed to the executor too."""
+
+    def __init__(self, backend=None, batch_size=500, max_age=1.0,
+                 executor=None, spool=None):
+        self.backend = backend or Backend.instance()
+        self.executor = executor
+        self.spool = spool
+        self.healthy = True
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.table = LogEntry.__table__
+        self.columns = [c.name for c in self.table.columns]
+        self.use_copy = self.backend.engine.dialect.name == 'postgresql'
+        self._rows = []
+        self._first_ts = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._timer = None
+        self._flush_scheduled = False
+        self.io_loop = None
+        self.written = 0
+        self.failed = 0
+        self.spooled = 0
+        self.batches = 0
+
+    @classmethod
+    def instance(cls):
+        """Singleton like accessor to instantiate writer object"""
+        if not hasattr(cls, "_instance"):
+            cls._instance = cls(batch_size=settings.DB_BATCH_SIZE,
+                                max_age=settings.DB_FLUSH_INTERVAL,
+                                executor=SinkExecutor.instance(),
+                                spool=Spool.instance())
+            cls._instance.start()
+        return cls._instance
+
+    @classmethod
+    def shutdown(cls):
+        if hasattr(cls, "_instance"):
+            cls._instance.stop()
+
+    def start(self, io_loop=None):
+        r"""Starts age based flushes on the IOLoop."""
+        self.io_loop = io_loop or ioloop.IOLoop.current()
+        self._timer = ioloop.PeriodicCallback(
+            self.flush_expired, self.max_age * 1000 / 2.,
+            io_loop=self.io_loop)
+        self._timer.start()
+
+    def stop(self):
+        r"""Stops the timer and drains everything buffered so far."""
+        if self._timer is not None:
+            self._timer.stop()
+            self._timer = None
+        self.flush()
+
+    def to_row(self, log_entry):
+        r"""Fills in column defaults, so the entry can be serialised
+        before it is written, and returns it as a row dict."""
+        if log_entry.id is None:
+            log_entry.id = uuid.uuid4().hex
+        if log_entry.dt_create is None:
+            log_entry.dt_create = datetime.utcnow()
+        return dict((c, getattr(log_entry, c)) for c in self.columns)
+
+    def add(self, log_entry):
+        r"""Buffers entry, flushes if the batch is full."""
+        self.add_row(self.to_row(log_entry))
+
+    def add_row(self, row):
+        with self._lock:
+            if not self._rows:
+                self._first_ts = time.time()
+            self._rows.append(row)
+            full = len(self._rows) >= self.batch_size
+        if full:
+            self.flush()
+
+    def pending(self):
+        return len(self._rows)
+
+    def is_expired(self):
+        first_ts = self._first_ts
+        return (bool(self._rows) and first_ts is not None and
+                time.time() - first_ts >= self.max_age)
+
+    def flush_expired(self):
+        if not self.is_expired() or self._flush_scheduled:
+            return
+        if self.executor is None:
+            self.flush()
+            return
+        self._flush_scheduled = True
+        self.io_loop.add_future(self.executor.submit(self.flush),
+                                lambda future: future.result())
+
+    def take_rows(self):
+        with self._lock:
+            rows, self._rows = self._rows, []
+            self._first_ts = None
+            self._flush_scheduled = False
+        return rows
+
+    def flush(self):
+        r"""Writes buffered rows. Returns number of rows written. Rows
+        taken by a flush of another thread are written when it returns."""
+        with self._flush_lock:
+            rows = self.take_rows()
+            if not rows:
+                return 0
+            return self.write(rows)
+
+    def write(self, rows):
+        self.batches += 1
+        try:
+            self.write_batch(rows)
+            self.written += len(rows)
+            self.healthy = True
+            return len(rows)
+        except Exception as e:
+            gen_log.warning("failed to write batch of %d rows: %s",
+                            len(rows), e)
+            if self.is_unavailable(e):
+                self.spool_rows(rows)
+                return 0
+        written = 0
+        for i, row in enumerate(rows):
+            try:
+                self.insert_rows([row])
+                written += 1
+            except Exception as e:
+                if self.is_unavailable(e):
+                    self.spool_rows(rows[i:])
+                    break
+                self.failed += 1
+                gen_log.warning("dropped log entry %s: %s", row['id'], e)
+        self.written += written
+        return written
+
+    def is_unavailable(self, exc):
+        r"""Tells connection problems apart from bad rows."""
+        return (self.spool is not None and
+                isinstance(exc, (sa.exc.OperationalError,
+                                 sa.exc.InterfaceError)))
+
+    def spool_rows(self, rows):
+        self.healthy = False
+        for row in rows:
+            self.spool.append(log_record(row))
+        self.spooled += len(rows)
+
+    def write_batch(self, rows):
+        started = time.time()
+        self.backend.create_tables()
+        if self.use_copy:
+            self.copy_rows(rows)
+        else:
+            self.insert_rows(rows)
+        STAGE_SECONDS.labels('db_commit', '').observe(time.time() - started)
+
+    def insert_rows(self, rows):
+        with self.backend.engine.begin() as conn:
+            conn.execute(self.table.insert(), rows)
+
+    def copy_rows(self, rows):
+        buf = StringIO()
+        for row in rows:
+            buf.write('\t'.join(copy_escape(row[c]) for c in self.columns))
+            buf.write('\n')
+        buf.seek(0)
+        sql = 'COPY %s (%s) FROM STDIN' % (self.table.name,
+                                           ', '.join(self.columns))
+        conn = self.backend.engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.copy_expert(sql, buf)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def stats(self):
+        return {'pending': len(self._rows),
+                'written': self.written,
+                'failed': self.failed,
+                'spooled': self.spooled,
+                'batches': self.batches}